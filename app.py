@@ -1,16 +1,59 @@
-from flask import Flask, jsonify, Response
+from flask import Flask, Response, request
 from flask_restful import Resource, Api
-from time import time
+import message
+from message import MESSAGE_PATH, MESSAGE_MIMETYPE, HEALTH_CHECK_PATH, HEALTH_CHECK_BODY, \
+    METRICS_PATH, METRICS_CONTENT_TYPE, message_response
 
 app = Flask(__name__)
 api = Api(app)
 
+class RecordMetrics(object):
+    def __init__(self, wsgi_app):
+        """
+        WSGI middleware recording every request in the metrics.
+
+        :param wsgi_app: The WSGI application to wrap
+        :type wsgi_app: function
+        """
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        recorder = message.metrics
+        start = recorder.begin()
+        status = [500]
+
+        def record_status(status_line, headers, exc_info=None):
+            status[0] = int(status_line[:3])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            return self.wsgi_app(environ, record_status)
+        finally:
+            recorder.end(environ.get('PATH_INFO', ''), status[0], start)
+
+def is_xhr(environ):
+    # Same check as jsonify, without the deprecated Request.is_xhr warning
+    return environ.get('HTTP_X_REQUESTED_WITH', '').lower() == 'xmlhttprequest'
+
 class Message(Resource):
     def get(self):
-        response = {'message':'Automation for the People', 'timestamp': time()}
-        return jsonify(response)
+        environ = request.environ
+        compact = not app.config['JSONIFY_PRETTYPRINT_REGULAR'] or is_xhr(environ)
+        status, body, headers = message_response(compact, environ.get('HTTP_IF_NONE_MATCH'))
+        return Response(body, status, headers, mimetype=MESSAGE_MIMETYPE)
+
+api.add_resource(Message, MESSAGE_PATH)
+
+# Load balancer health checks bypass Flask-RESTful and the message handler
+@app.route(HEALTH_CHECK_PATH)
+def healthz():
+    return Response(HEALTH_CHECK_BODY, mimetype='text/plain')
+
+@app.route(METRICS_PATH)
+def metrics_endpoint():
+    return Response(message.metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
-api.add_resource(Message, '/message')
+app.wsgi_app = RecordMetrics(app.wsgi_app)
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=80)
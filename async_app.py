@@ -0,0 +1,148 @@
+"""
+Asyncio (ASGI) variant of the Message API.
+
+Serves the same /message contract as app.py, but on an event loop so
+a single worker can hold a very large number of keep-alive connections.
+Selected at launch with APP_SERVER_MODE=async (see gunicorn_conf.py).
+"""
+import message
+from message import MESSAGE_PATH, HEALTH_CHECK_PATH, HEALTH_CHECK_BODY, METRICS_PATH, \
+    METRICS_CONTENT_TYPE, message_response
+
+JSON_HEADERS = [(b'content-type', b'application/json')]
+TEXT_HEADERS = [(b'content-type', b'text/plain; charset=utf-8')]
+METRICS_HEADERS = [(b'content-type', METRICS_CONTENT_TYPE.encode('ascii'))]
+
+
+async def send_response(send, status, headers, body, head=False):
+    """
+    Sends a complete HTTP response over the ASGI channel.
+
+    :param send: The ASGI send callable
+    :type send: coroutine function
+
+    :param status: The HTTP status code
+    :type status: int
+
+    :param headers: The response headers, without content-length
+    :type headers: list
+
+    :param body: The response body
+    :type body: bytes
+
+    :param head: Whether to omit the body, for HEAD requests
+    :type head: bool
+
+    :return: The HTTP status code sent, for the metrics
+    :rtype: int
+    """
+    if status != 304:
+        headers = headers + [(b'content-length', str(len(body)).encode('ascii'))]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+    return status
+
+
+async def lifespan(receive, send):
+    """
+    Acknowledges the server's startup and shutdown events.
+    """
+    while True:
+        event = await receive()
+        if event['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif event['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def send_message(scope, send, head=False):
+    """
+    Answers a /message request with the same headers and body as app.py.
+
+    :param scope: The ASGI connection scope
+    :type scope: dict
+
+    :param send: The ASGI send callable
+    :type send: coroutine function
+
+    :param head: Whether to omit the body, for HEAD requests
+    :type head: bool
+
+    :return: The HTTP status code sent
+    :rtype: int
+    """
+    compact = False
+    if_none_match = None
+    for name, value in scope['headers']:
+        if name == b'x-requested-with':
+            compact = value.lower() == b'xmlhttprequest'
+        elif name == b'if-none-match':
+            if_none_match = value.decode('latin-1')
+
+    status, body, headers = message_response(compact, if_none_match)
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+        for name, value in headers]
+    if status == 200:
+        headers = JSON_HEADERS + headers
+    return await send_response(send, status, headers, body, head)
+
+
+async def dispatch(scope, send):
+    """
+    Answers an HTTP request.
+
+    :param scope: The ASGI connection scope
+    :type scope: dict
+
+    :param send: The ASGI send callable
+    :type send: coroutine function
+
+    :return: The HTTP status code sent
+    :rtype: int
+    """
+    method = scope['method']
+    head = method == 'HEAD'
+    path = scope['path']
+    if path == HEALTH_CHECK_PATH and method in ('GET', 'HEAD'):
+        return await send_response(send, 200, TEXT_HEADERS, HEALTH_CHECK_BODY, head)
+    elif path == METRICS_PATH and method in ('GET', 'HEAD'):
+        return await send_response(send, 200, METRICS_HEADERS,
+            message.metrics.render().encode('utf-8'), head)
+    elif path != MESSAGE_PATH:
+        return await send_response(send, 404, TEXT_HEADERS, b'Not Found\n', head)
+    elif method not in ('GET', 'HEAD'):
+        return await send_response(send, 405,
+            TEXT_HEADERS + [(b'allow', b'GET, HEAD')], b'Method Not Allowed\n')
+    return await send_message(scope, send, head)
+
+
+def create_app():
+    """
+    Creates the ASGI application.
+
+    :return: The ASGI application callable
+    :rtype: coroutine function
+    """
+    async def application(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        # Every request is recorded in the metrics, like app.RecordMetrics does
+        recorder = message.metrics
+        start = recorder.begin()
+        status = 500
+        try:
+            status = await dispatch(scope, send)
+        finally:
+            recorder.end(scope['path'], status, start)
+
+    return application
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(create_app(), host='0.0.0.0', port=80)
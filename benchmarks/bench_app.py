@@ -0,0 +1,264 @@
+"""
+Offline micro-benchmarks for the /message handler and serializer.
+
+Runs in-process, without a server or network access, against the Flask
+test client and the asyncio application. Results can be saved as a
+baseline and later compared against it, e.g. in CI:
+
+    python3 benchmarks/bench_app.py --save benchmarks/baseline.json
+    python3 benchmarks/bench_app.py --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import json
+import asyncio
+import argparse
+import platform
+import tracemalloc
+from contextlib import contextmanager
+from statistics import median
+from time import perf_counter, process_time
+
+import app
+import message
+import async_app
+
+DEFAULT_ITERATIONS = 2000
+DEFAULT_REPEATS = 5
+DEFAULT_TOLERANCE = 0.25
+# Metrics compared against a baseline, lower is better for all of them.
+# CPU time is compared relative to a calibration loop run alongside the
+# cases, so a baseline saved on one machine is usable on another.
+COMPARED_METRICS = ['cpu_relative', 'alloc_bytes']
+
+
+@contextmanager
+def cached_timestamps(resolution=0.01):
+    """
+    Temporarily serves /message from a ClockTicker snapshot.
+    """
+    original = message.ticker
+    message.ticker = message.ClockTicker(resolution)
+    try:
+        yield
+    finally:
+        message.ticker.stop()
+        message.ticker = original
+
+
+def calibration_case():
+    data = list(range(100))
+    return lambda: sorted(data, key=str)
+
+
+def flask_case():
+    client = app.app.test_client()
+    return lambda: client.get(message.MESSAGE_PATH)
+
+
+def asgi_case():
+    application = async_app.create_app()
+    scope = {'type': 'http', 'method': 'GET', 'path': message.MESSAGE_PATH, 'headers': []}
+    loop = asyncio.new_event_loop()
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    async def request():
+        await application(scope, receive, send)
+
+    return lambda: loop.run_until_complete(request())
+
+
+def render_case():
+    return lambda: message.render_message(1500000000.123456)
+
+
+def message_response_case():
+    return message.message_response
+
+
+# Name, factory returning a zero-argument callable, and optional context
+CASES = [
+    ('flask', flask_case, None),
+    ('flask_cached', flask_case, cached_timestamps),
+    ('asgi', asgi_case, None),
+    ('render_message', render_case, None),
+    ('message_response', message_response_case, None),
+]
+
+
+def measure(func, iterations=DEFAULT_ITERATIONS, repeats=DEFAULT_REPEATS):
+    """
+    Measures a callable's CPU time, wall time and memory allocation.
+
+    Timing and allocation are measured in separate passes, since tracing
+    allocations slows every call down. The fastest repeat is kept, being
+    the one least disturbed by other processes.
+
+    :param func: The callable to measure
+    :type func: function
+
+    :param iterations: Number of calls per repeat
+    :type iterations: int
+
+    :param repeats: Number of timed repeats
+    :type repeats: int
+
+    :return: CPU microseconds per call, calls per second of wall time and
+        peak bytes allocated per call
+    :rtype: dict
+    """
+    # Warm up caches, lazy imports and the ticker thread
+    for i in range(min(iterations, 100)):
+        func()
+
+    cpu_times = []
+    wall_times = []
+    for i in range(repeats):
+        wall_start = perf_counter()
+        cpu_start = process_time()
+        for j in range(iterations):
+            func()
+        cpu_times.append(process_time() - cpu_start)
+        wall_times.append(perf_counter() - wall_start)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for i in range(min(iterations, 200)):
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'cpu_us': min(cpu_times) / iterations * 1e6,
+        'rps': iterations / min(wall_times),
+        'alloc_bytes': median(peaks),
+    }
+
+
+def run_suite(cases=None, iterations=DEFAULT_ITERATIONS, repeats=DEFAULT_REPEATS):
+    """
+    Runs the benchmark cases.
+
+    :param cases: Names of the cases to run, all of them by default
+    :type cases: list
+
+    :param iterations: Number of calls per repeat
+    :type iterations: int
+
+    :param repeats: Number of timed repeats
+    :type repeats: int
+
+    :return: The results, keyed by case name, and the environment they ran in
+    :rtype: dict
+    """
+    calibration = measure(calibration_case(), iterations, repeats)['cpu_us']
+    results = {}
+    for name, factory, context in CASES:
+        if cases and name not in cases:
+            continue
+        if context:
+            with context():
+                results[name] = measure(factory(), iterations, repeats)
+        else:
+            results[name] = measure(factory(), iterations, repeats)
+        results[name]['cpu_relative'] = results[name]['cpu_us'] / calibration
+    return {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'iterations': iterations,
+        'calibration_cpu_us': calibration,
+        'results': results,
+    }
+
+
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares results against a baseline.
+
+    :param current: Results from run_suite
+    :type current: dict
+
+    :param baseline: Previously saved results from run_suite
+    :type baseline: dict
+
+    :param tolerance: Allowed relative increase, e.g. 0.25 for 25%
+    :type tolerance: float
+
+    :return: Descriptions of the metrics that regressed
+    :rtype: list
+    """
+    regressions = []
+    for name, metrics in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        for metric in COMPARED_METRICS:
+            if base.get(metric) and metrics[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{name} {metric}: {metrics[metric]:.2f} vs " \
+                    f"baseline {base[metric]:.2f} (+{metrics[metric] / base[metric] - 1:.0%})")
+    return regressions
+
+
+def print_results(current, baseline=None):
+    print(f"{'case':<18} {'cpu us/req':>12} {'req/s':>12} {'alloc B/req':>12}")
+    for name, metrics in current['results'].items():
+        line = f"{name:<18} {metrics['cpu_us']:12.2f} {metrics['rps']:12.0f} " \
+            f"{metrics['alloc_bytes']:12.0f}"
+        base = (baseline or {}).get('results', {}).get(name)
+        if base:
+            line += f"   (baseline {base['cpu_us']:.2f} us, {base['alloc_bytes']:.0f} B, " \
+                f"relative cpu {metrics['cpu_relative']:.3f} vs {base['cpu_relative']:.3f})"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('cases', nargs='*', help='Cases to run, all of them by default')
+    parser.add_argument('-i', '--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help='Number of calls per repeat')
+    parser.add_argument('-r', '--repeats', type=int, default=DEFAULT_REPEATS,
+                        help='Number of timed repeats')
+    parser.add_argument('--save', default=None, help='File to save the results to as a baseline')
+    parser.add_argument('--compare', default=None, help='Baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed relative regression before failing, e.g. 0.25')
+    args = parser.parse_args(argv)
+
+    current = run_suite(args.cases, args.iterations, args.repeats)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(current, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.save}")
+
+    if baseline:
+        regressions = compare(current, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,509 @@
-import boto3
+import io
+import os
+import re
+import sys
 import json
+import math
+import base64
+import tarfile
+import hashlib
 import argparse
-import requests
-from botocore import exceptions
-from time import sleep
+import ipaddress
+import tempfile
+import importlib
+import threading
+import subprocess
+import functools
+import itertools
+import traceback
+import contextvars
+from contextlib import contextmanager
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from time import time, sleep, perf_counter, monotonic
 from pathlib import Path
 from pprint import pprint
 
-ALLOWED_ACTIONS = ["build", "destroy", "info", "test"]
+
+class LazyModule(object):
+    def __init__(self, name):
+        """
+        Stands in for a module that is only imported once one of its
+        attributes is used.
+
+        boto3, botocore and requests take most of the script's startup
+        time, and --help, argument errors and cached lookups never use them.
+
+        :param name: The module's full name
+        :type name: str
+        """
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+boto3 = LazyModule('boto3')
+boto3_exceptions = LazyModule('boto3.exceptions')
+s3_transfer = LazyModule('boto3.s3.transfer')
+exceptions = LazyModule('botocore.exceptions')
+botocore_config = LazyModule('botocore.config')
+requests = LazyModule('requests')
+
+ALLOWED_ACTIONS = ["build", "deploy", "refresh", "destroy", "info", "test", "bench", "artifact",
+                   "container"]
 DEFAULT_REGION = 'us-east-1'
 DEFAULT_KEY_PAIR = 'merickson-miniproject'
 DEFAULT_NAME = 'merickson-miniproject'
-DEFAULT_FILES = ['app.py', 'requirements.txt']
+# Files are uploaded in parallel, and in parts once larger than the threshold
+DEFAULT_UPLOAD_WORKERS = 8
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+# S3 accepts up to 1000 keys per DeleteObjects request
+DELETE_BATCH_SIZE = 1000
+DEFAULT_DELETE_WORKERS = 8
+# Independent build phases run at the same time on this many threads
+DEFAULT_PHASE_WORKERS = 4
+# Stack waits poll quickly while events arrive and back off while idle
+DEFAULT_STACK_TIMEOUT = 3600
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 15
+POLL_BACKOFF = 1.5
+# Clients share one connection pool per service, big enough for every upload
+# worker's multipart threads, and back off on their own when throttled
+DEFAULT_MAX_POOL_CONNECTIONS = DEFAULT_UPLOAD_WORKERS * DEFAULT_UPLOAD_WORKERS
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_RETRY_MODE = 'adaptive'
+# Error codes AWS services use when a call is throttled
+THROTTLE_ERROR_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException',
+                        'RequestThrottled', 'RequestLimitExceeded', 'TooManyRequestsException',
+                        'SlowDown', 'RequestThrottledException'}
+DEFAULT_BENCH_CONNECTIONS = 10
+DEFAULT_BENCH_DURATION = 10.0
+# Upper bounds, in milliseconds, of the benchmark latency histogram buckets
+BENCH_HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# Lookups that rarely change are cached on disk between runs, for this long
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'stelligent', 'metadata.json')
+ACCOUNT_CACHE_TTL = 24 * 3600
+AMI_CACHE_TTL = 6 * 3600
+STACK_CACHE_TTL = 3600
+# Stacks are only cached once they are in one of these statuses
+CACHEABLE_STACK_STATUSES = ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']
+# Actions that can run against several regions and stacks at once
+FAN_OUT_ACTIONS = ["build", "deploy", "refresh", "destroy", "info", "test"]
+DEFAULT_TARGET_WORKERS = 5
+# Instances boot from one artifact holding the application and its dependencies,
+# installed for the instances' Python and platform (Amazon Linux 2)
+ARTIFACT_DIR = 'artifacts'
+ARTIFACT_PYTHON_VERSION = '3.7'
+ARTIFACT_PLATFORM = 'manylinux2014_x86_64'
+ARTIFACT_LOCK = threading.Lock()
+# Or they run the application image, built from the Dockerfile and these files
+CONTAINER_FILES = ['Dockerfile', 'requirements.txt', 'app.py', 'async_app.py', 'message.py',
+                   'metrics.py', 'gunicorn_conf.py']
+CONTAINER_REPOSITORY = 'message-api'
+DEFAULT_CONTAINER_PORT = 8080
+CONTAINER_START_TIMEOUT = 30
+# The CloudFormation template, rendered for the number of Availability Zones
+TEMPLATE_FILE = 'app.cf'
+DEFAULT_AZ_COUNT = 2
+MAX_AZ_COUNT = 6
+# Resources and parameters repeated in every Availability Zone, named after the first
+ZONE_RESOURCES = ['PublicSubnet{}', 'PrivateSubnet{}', 'NatGateway{}EIP', 'NatGateway{}',
+                  'PublicSubnet{}RouteTableAssociation', 'PrivateRouteTable{}',
+                  'DefaultPrivateRoute{}', 'PrivateSubnet{}RouteTableAssociation']
+ZONE_PARAMETERS = ['PublicSubnet{}CIDR', 'PrivateSubnet{}CIDR']
+# CloudFormation quotas: larger bodies are uploaded to the stack's bucket and passed by URL
+TEMPLATE_BODY_LIMIT = 51200
+TEMPLATE_URL_LIMIT = 1024 * 1024
+TEMPLATE_PREFIX = 'templates/'
+MAX_TEMPLATE_RESOURCES = 500
+MAX_TEMPLATE_PARAMETERS = 200
+TEMPLATE_SECTIONS = {'AWSTemplateFormatVersion', 'Description', 'Metadata', 'Parameters',
+                     'Rules', 'Mappings', 'Conditions', 'Transform', 'Resources', 'Outputs'}
+PSEUDO_PARAMETERS = {'AWS::AccountId', 'AWS::NoValue', 'AWS::NotificationARNs', 'AWS::Partition',
+                     'AWS::Region', 'AWS::StackId', 'AWS::StackName', 'AWS::URLSuffix'}
+# render_template arguments setting the defaults of template parameters
+TEMPLATE_OPTION_PARAMETERS = {
+    'instance_type': 'InstanceType',
+    'listener_port': 'ListenerPort',
+    'application_port': 'ApplicationPort',
+}
+# Command line arguments passed to the template's AutoScalingGroup parameters
+SCALING_PARAMETERS = {
+    'min_size': 'MinSize',
+    'max_size': 'MaxSize',
+    'desired_capacity': 'DesiredCapacity',
+    'target_requests': 'TargetRequestsPerInstance',
+    'target_cpu': 'TargetCpuUtilization',
+    'instance_warmup': 'InstanceWarmup',
+    'warm_pool_size': 'WarmPoolMinSize',
+}
+# Instance refreshes keep this share of the capacity healthy, and may launch up to the
+# maximum before terminating, so each batch replaces the difference
+DEFAULT_MIN_HEALTHY = 90
+DEFAULT_MAX_HEALTHY = 100
+REFRESH_FINAL_STATUSES = ['Successful', 'Failed', 'Cancelled', 'RollbackSuccessful',
+                          'RollbackFailed']
+DEFAULT_FILES = ['app.py', 'async_app.py', 'message.py', 'metrics.py', 'requirements.txt',
+                 'gunicorn_conf.py', 'app.service']
+
+
+class Tracer(object):
+    def __init__(self):
+        """
+        Records how long deploy phases and AWS API calls take.
+
+        Phases are recorded with span() or the traced decorator. API calls
+        are recorded by attaching the tracer to a boto3 session, including
+        how many times each call was retried and throttled.
+        """
+        self.origin = perf_counter()
+        self.spans = []
+
+    def record(self, name, category, start, end, **details):
+        self.spans.append({'name': name, 'category': category, 'start': start, 'end': end,
+                           'thread': threading.get_ident(), 'details': details})
+
+    @contextmanager
+    def span(self, name, category='phase'):
+        """
+        Records the time spent in a block of code.
+
+        :param name: The name of the span
+        :type name: str
+
+        :param category: The kind of span, e.g. phase or action
+        :type category: str
+        """
+        start = perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(name, category, start, perf_counter(), error=error)
+
+    def attach(self, session):
+        """
+        Records every API call made by clients created from the session.
+
+        :param session: The session to trace
+        :type session: boto3.Session
+        """
+        events = session.events
+
+        def before_call(model, context, **kwargs):
+            context['trace_name'] = f"{model.service_model.service_name}.{model.name}"
+            context['trace_start'] = perf_counter()
+            context['trace_throttles'] = 0
+
+        def needs_retry(response, caught_exception, request_dict, **kwargs):
+            if response is not None:
+                code = response[1].get('Error', {}).get('Code')
+                if code in THROTTLE_ERROR_CODES:
+                    request_dict['context']['trace_throttles'] = \
+                        request_dict['context'].get('trace_throttles', 0) + 1
+
+        def record_call(context, error, retries=0):
+            self.record(context['trace_name'], 'api', context['trace_start'], perf_counter(),
+                error=error, retries=retries, throttles=context.get('trace_throttles', 0))
+
+        def after_call(context, parsed=None, **kwargs):
+            if 'trace_start' not in context:
+                return
+            metadata = (parsed or {}).get('ResponseMetadata', {})
+            record_call(context, (parsed or {}).get('Error', {}).get('Code'),
+                metadata.get('RetryAttempts', 0))
+
+        # Emitted with only the context and exception, e.g. when the endpoint is unreachable
+        def after_call_error(context, exception, **kwargs):
+            if 'trace_start' not in context:
+                return
+            record_call(context, type(exception).__name__)
+
+        # Parameter building is the first event of a call that has the context
+        events.register('before-parameter-build', before_call, unique_id='tracer-before-call')
+        events.register('needs-retry', needs_retry, unique_id='tracer-needs-retry')
+        events.register('after-call', after_call, unique_id='tracer-after-call')
+        events.register('after-call-error', after_call_error,
+            unique_id='tracer-after-call-error')
+
+    def summary(self):
+        """
+        Aggregates the spans by category and name, slowest total first.
+
+        :return: Rows with the count, total, mean and max seconds, and the
+            retries, throttles and errors of each span name
+        :rtype: list
+        """
+        rows = {}
+        for span in self.spans:
+            row = rows.setdefault((span['category'], span['name']), {
+                'category': span['category'], 'name': span['name'], 'count': 0,
+                'total': 0.0, 'max': 0.0, 'retries': 0, 'throttles': 0, 'errors': 0})
+            duration = span['end'] - span['start']
+            row['count'] += 1
+            row['total'] += duration
+            row['max'] = max(row['max'], duration)
+            row['retries'] += span['details'].get('retries', 0)
+            row['throttles'] += span['details'].get('throttles', 0)
+            row['errors'] += 1 if span['details'].get('error') else 0
+        for row in rows.values():
+            row['mean'] = row['total'] / row['count']
+        return sorted(rows.values(), key=lambda row: row['total'], reverse=True)
+
+    def print_summary(self):
+        print(f"{'category':<8} {'name':<45} {'count':>5} {'total s':>9} {'mean ms':>9} " \
+            f"{'max ms':>9} {'retries':>7} {'throttles':>9} {'errors':>6}")
+        for row in self.summary():
+            print(f"{row['category']:<8} {row['name']:<45} {row['count']:>5} " \
+                f"{row['total']:>9.2f} {row['mean'] * 1000:>9.1f} {row['max'] * 1000:>9.1f} " \
+                f"{row['retries']:>7} {row['throttles']:>9} {row['errors']:>6}")
+        print(f"Wall clock: {perf_counter() - self.origin:.2f}s")
+
+    def chrome_trace(self):
+        """
+        Converts the spans to the Chrome trace event format, which can be
+        loaded in chrome://tracing or Perfetto.
+
+        :return: The trace
+        :rtype: dict
+        """
+        events = []
+        for span in self.spans:
+            events.append({
+                'name': span['name'], 'cat': span['category'], 'ph': 'X', 'pid': 1,
+                'tid': span['thread'],
+                'ts': (span['start'] - self.origin) * 1e6,
+                'dur': (span['end'] - span['start']) * 1e6,
+                'args': {k: v for k, v in span['details'].items() if v},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+        print(f"Saved trace to {path}")
+
+
+TRACER = Tracer()
+
+
+def traced(func):
+    """
+    Decorator recording each call of a function as a phase span.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with TRACER.span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def trace_methods(cls):
+    """
+    Class decorator recording each call of the class's public methods.
+    """
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith('_'):
+            setattr(cls, name, traced(value))
+    return cls
+
+
+class MetadataCache(object):
+    def __init__(self, path=DEFAULT_CACHE_FILE, enabled=True):
+        """
+        Keeps the results of slow, rarely changing AWS lookups in a JSON file,
+        each entry until its time to live runs out.
+
+        :param path: The cache file
+        :type path: str
+
+        :param enabled: Whether to use the cache, lookups always miss and
+            nothing is stored when disabled
+        :type enabled: bool
+        """
+        self.path = path
+        self.enabled = enabled
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # A missing or damaged cache is treated as empty
+            return {}
+
+    def save(self, entries):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Replace the file in one step, so other runs never read half of it
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        """
+        Looks up an entry.
+
+        :param key: The entry's key
+        :type key: str
+
+        :return: The cached value, or None if missing or expired
+        :rtype: object
+        """
+        if not self.enabled:
+            return None
+        entry = self.load().get(key)
+        if entry is None or entry['expires'] <= time():
+            return None
+        return entry['value']
+
+    def set(self, key, value, ttl):
+        """
+        Stores an entry.
+
+        :param key: The entry's key
+        :type key: str
+
+        :param value: The value, which must be JSON serializable
+        :type value: object
+
+        :param ttl: Seconds until the entry expires
+        :type ttl: float
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            entries = self.load()
+            now = time()
+            entries = {k: v for k, v in entries.items() if v['expires'] > now}
+            entries[key] = {'value': value, 'expires': now + ttl}
+            self.save(entries)
+
+    def invalidate(self, prefix=''):
+        """
+        Removes the entries whose keys start with a prefix, all of them by default.
+
+        :param prefix: The key prefix
+        :type prefix: str
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            entries = self.load()
+            kept = {k: v for k, v in entries.items() if not k.startswith(prefix)}
+            if kept != entries:
+                self.save(kept)
+
+
+def get_profile(access_key=None, secret_key=None):
+    """
+    Names the credentials in use, without loading them.
+
+    :param access_key: The AWS Access Key Id
+    :type access_key: str
+
+    :param secret_key: The AWS Secret Access Key Id
+    :type secret_key: str
+
+    :return: The access key id when keys are passed in or set in the
+        environment, otherwise the credentials profile name
+    :rtype: str
+    """
+    if access_key and secret_key:
+        return f"key:{access_key}"
+    # Environment keys take precedence over any profile, and may be another account's
+    if os.environ.get('AWS_ACCESS_KEY_ID') and os.environ.get('AWS_SECRET_ACCESS_KEY'):
+        return f"env:{os.environ['AWS_ACCESS_KEY_ID']}"
+    return os.environ.get('AWS_PROFILE') or os.environ.get('AWS_DEFAULT_PROFILE') or 'default'
+
+
+def client_config(max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                  connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS, retry_mode=DEFAULT_RETRY_MODE):
+    """
+    Builds the botocore settings shared by the driver's clients.
+
+    :param max_pool_connections: Connections each client keeps open at most
+    :type max_pool_connections: int
+
+    :param connect_timeout: Seconds to wait for a connection
+    :type connect_timeout: float
+
+    :param read_timeout: Seconds to wait for a response
+    :type read_timeout: float
+
+    :param max_attempts: Attempts per call, including the first one
+    :type max_attempts: int
+
+    :param retry_mode: botocore retry mode, adaptive also rate limits the
+        client once it is throttled
+    :type retry_mode: str
+
+    :return: The client settings
+    :rtype: botocore.config.Config
+    """
+    return botocore_config.Config(max_pool_connections=max_pool_connections,
+        connect_timeout=connect_timeout, read_timeout=read_timeout,
+        retries={'max_attempts': max_attempts, 'mode': retry_mode})
+
+
+def in_context(func):
+    """
+    Wraps a function to run in a copy of the caller's context, so that work
+    handed to a thread pool still writes to the caller's target output.
+    """
+    context = contextvars.copy_context()
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
+
+
+@trace_methods
+class SessionPool(object):
+    def __init__(self):
+        """
+        Shares one checked session per set of credentials between drivers,
+        so acting on several regions and stacks resolves and checks the
+        credentials once. Each driver creates its clients for its own region
+        from the shared session, holding the pool's lock since sessions are
+        not thread safe.
+        """
+        self.sessions = {}
+        self.lock = threading.RLock()
+
+    def get(self, profile, create):
+        """
+        Gets the session for the credentials, creating it on first use.
+
+        :param profile: The credentials, as named by get_profile
+        :type profile: str
+
+        :param create: Creates the session, returning it and the account id
+        :type create: function
+
+        :return: The session and the account id
+        :rtype: tuple
+        """
+        with self.lock:
+            if profile not in self.sessions:
+                self.sessions[profile] = create()
+            return self.sessions[profile]
 
 
 class AwsUtil(object):
-    def get_session(self, access_key=None, secret_key=None, region='us-east-1'):
+    def get_session(self, access_key=None, secret_key=None, region='us-east-1', cache=None):
         """
         Get a valid boto3 session to use for base clients.
         
@@ -31,6 +519,10 @@ class AwsUtil(object):
         :param region: The AWS region to operate in
         :type region: str
 
+        :param cache: Where to look up and keep the account id, which skips
+            checking the credentials while it is cached
+        :type cache: MetadataCache
+
         :return: A session inside the AWS account
         :rtype: boto3.Session
         """
@@ -44,8 +536,15 @@ class AwsUtil(object):
             # Otherwise, try to use other credentials
             else:
                 session = boto3.Session(region_name=region)
-            # Test the session to comfirm valid credentials
-            account = session.client('sts').get_caller_identity()['Account']
+            TRACER.attach(session)
+            account_key = f"{get_profile(access_key, secret_key)}/account"
+            account = cache.get(account_key) if cache else None
+            if account is None:
+                # Test the session to comfirm valid credentials
+                account = session.client('sts').get_caller_identity()['Account']
+                if cache:
+                    cache.set(account_key, account, ACCOUNT_CACHE_TTL)
+            self._account_id = account
         except exceptions.EndpointConnectionError as e:
             print("Unable to create a session. " \
                 "Please check the region and/or credentials passed in.")
@@ -64,27 +563,143 @@ class AwsUtil(object):
         return session
 
 
+@trace_methods
 class AwsDriver(AwsUtil):
-    def __init__(self, access_key=None, secret_key=None, region='us-east-1'):
+    def __init__(self, access_key=None, secret_key=None, region='us-east-1',
+                 s3_endpoint=None, config=None, cache=None, client_settings=None,
+                 sessions=None):
         """
-        Initializes the class. Establishes an AWS session
-        and the many clients used within the class.
+        Initializes the class. The AWS session, and the clients used within
+        the class, are established when first used.
 
         :param access_key: The AWS Access Key Id
         :type access_key: str
 
         :param secret_key: The AWS Secret Access Key Id
         :type secret_key: str
+
+        :param s3_endpoint: An alternative S3 endpoint URL, e.g. a local S3 stand-in
+        :type s3_endpoint: str
+
+        :param config: Connection pool, timeout and retry settings for the
+            clients, client_config() by default
+        :type config: botocore.config.Config
+
+        :param cache: Cache for the account id, AMI and stack lookups, none by default
+        :type cache: MetadataCache
+
+        :param client_settings: Arguments for client_config, used when no
+            config is given. botocore is only loaded once a client is needed.
+        :type client_settings: dict
+
+        :param sessions: Sessions shared with the drivers of other regions and
+            stacks, none by default
+        :type sessions: SessionPool
         """
         super(AwsDriver, self).__init__()
         self.region = region
-        self.session = self.get_session(access_key, secret_key, self.region)
-        self.ec2_client = self.session.client('ec2')
-        self.s3_client = self.session.client('s3')
-        self.kms_client = self.session.client('kms')
-        self.ssm_client = self.session.client('ssm')
-        self.cf_client = self.session.client('cloudformation')
-        self.account_id = self.session.client('sts').get_caller_identity()['Account']
+        self.s3_endpoint = s3_endpoint
+        self._config = config
+        self.client_settings = client_settings or {}
+        self.clients = {}
+        self.sessions = sessions
+        # Reentrant, since creating the first client also creates the session
+        self.clients_lock = sessions.lock if sessions else threading.RLock()
+        self.cache = cache or MetadataCache(enabled=False)
+        self.profile = get_profile(access_key, secret_key)
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self._account_id = None
+        self._session = None
+
+    @property
+    def session(self):
+        # Created on first use, so lookups answered from the cache never load boto3
+        if self._session is None:
+            with self.clients_lock:
+                if self._session is None:
+                    if self.sessions:
+                        self._session, self._account_id = self.sessions.get(self.profile,
+                                                                            self._new_session)
+                    else:
+                        self._session, self._account_id = self._new_session()
+        return self._session
+
+    def _new_session(self):
+        session = self.get_session(self.access_key, self.secret_key, self.region, self.cache)
+        return session, self._account_id
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = client_config(**self.client_settings)
+        return self._config
+
+    def _client(self, service):
+        """
+        Gets the client for a service, creating it on first use.
+
+        :param service: The service name, e.g. s3
+        :type service: str
+
+        :return: The client
+        :rtype: botocore.client.BaseClient
+        """
+        client = self.clients.get(service)
+        if client is None:
+            # Sessions are not thread safe, and build phases run concurrently
+            with self.clients_lock:
+                client = self.clients.get(service)
+                if client is None:
+                    endpoint_url = self.s3_endpoint if service == 's3' else None
+                    client = self.session.client(service, region_name=self.region,
+                                                 endpoint_url=endpoint_url, config=self.config)
+                    self.clients[service] = client
+        return client
+
+    def _cache_key(self, *parts):
+        """
+        Builds a cache key scoped to the credentials and region.
+
+        :return: The key
+        :rtype: str
+        """
+        return '/'.join([str(self.profile), self.region] + list(parts))
+
+    @property
+    def ec2_client(self):
+        return self._client('ec2')
+
+    @property
+    def s3_client(self):
+        return self._client('s3')
+
+    @property
+    def kms_client(self):
+        return self._client('kms')
+
+    @property
+    def ssm_client(self):
+        return self._client('ssm')
+
+    @property
+    def cf_client(self):
+        return self._client('cloudformation')
+
+    @property
+    def autoscaling_client(self):
+        return self._client('autoscaling')
+
+    @property
+    def account_id(self):
+        if self._account_id is None:
+            self._account_id = self.cache.get(f"{self.profile}/account")
+        # Otherwise known once get_session has checked the credentials
+        if self._account_id is None:
+            self.session
+        if self._account_id is None:
+            self._account_id = self._client('sts').get_caller_identity()['Account']
+        return self._account_id
 
     def get_bucket_name(self, stack_name):
         """
@@ -127,34 +742,165 @@ class AwsDriver(AwsUtil):
             print(f"Bucket {bucket_name} already exists, will try to use it")
         return bucket_name
 
-    def upload_files(self, files, bucket):
+    def list_objects(self, bucket, prefix=''):
+        """
+        Lists the objects in the bucket under a prefix.
+
+        :param bucket: The name of the bucket
+        :type bucket: str
+
+        :param prefix: Only list keys starting with this prefix
+        :type prefix: str
+
+        :return: The ETag of each object, keyed by object key
+        :rtype: dict
+        """
+        etags = {}
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                etags[obj['Key']] = obj['ETag']
+        return etags
+
+    def upload_files(self, files, bucket, max_workers=DEFAULT_UPLOAD_WORKERS,
+                     prefix='', delete=False):
         """
-        Uploads the files to S3.
+        Uploads the files to S3, skipping files that are unchanged.
         
         These files are used during bootstrap of new application 
-        servers.
+        servers. Directories are uploaded recursively. A file is skipped 
+        when the ETag S3 would compute for it, or the SHA-256 stored in 
+        the object's metadata, matches the object already in the bucket.
+        Files are streamed from disk in parallel, and files larger than 
+        MULTIPART_THRESHOLD are sent as concurrent parts.
 
-        :param files: The file(s) to upload to S3
+        :param files: The file(s) or directories to upload to S3
         :type files: str or list
 
         :param bucket: The name of the bucket to upload files to
         :type bucket: str
+
+        :param max_workers: Number of files to upload at once
+        :type max_workers: int
+
+        :param prefix: Prefix to add to every object key
+        :type prefix: str
+
+        :param delete: Delete objects under the prefix that are not in files
+        :type delete: bool
+
+        :return: The keys that were uploaded, skipped and deleted
+        :rtype: dict
         """
         # Ensure files is a list to ensure logic works
         if type(files).__name__ == 'str':
             files = [files,]
 
+        keys = {}
+        for path in expand_paths(files):
+            keys[prefix + Path(path).as_posix()] = path
+
+        config = s3_transfer.TransferConfig(multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE, max_concurrency=max_workers)
+
+        def sync(key):
+            path = keys[key]
+            etag, sha256 = file_digests(path)
+            if key in remote:
+                if remote[key] == etag:
+                    return 'skipped'
+                # ETags differ when another tool used a different part size
+                head = self.s3_client.head_object(Bucket=bucket, Key=key)
+                if head.get('Metadata', {}).get('sha256') == sha256:
+                    return 'skipped'
+            self.s3_client.upload_file(path, bucket, key, Config=config,
+                ExtraArgs={'ServerSideEncryption': 'AES256', 'StorageClass': 'STANDARD',
+                           'Metadata': {'sha256': sha256}})
+            print(f"Uploaded file {path} to bucket {bucket}")
+            return 'uploaded'
+
+        report = {'uploaded': [], 'skipped': [], 'deleted': []}
         try:
-            for f in files:
-                body = open(f, 'r').read()
-                self.s3_client.put_object(Body=body, Bucket=bucket, Key=f,
-                    ServerSideEncryption='AES256', StorageClass='STANDARD')
-                print(f"Uploaded file {f} to bucket {bucket}")
-        except exceptions.ClientError:
+            remote = self.list_objects(bucket, prefix)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                # Consume the results so the first failure is raised here
+                for key, result in zip(keys, executor.map(in_context(sync), keys)):
+                    report[result].append(key)
+        except (exceptions.ClientError, boto3_exceptions.S3UploadFailedError):
             print("Failed to upload files to the bucket. Ensure the bucket is in this account")
             exit(1)
 
-    def delete_files(self, files, bucket):
+        if delete:
+            stale = sorted(key for key in remote if key not in keys)
+            if stale:
+                self.delete_files(stale, bucket)
+            report['deleted'] = stale
+
+        print(f"Uploaded {len(report['uploaded'])}, skipped {len(report['skipped'])} " \
+            f"unchanged and deleted {len(report['deleted'])} file(s) in bucket {bucket}")
+        return report
+
+    def delete_objects(self, objects, bucket, max_workers=DEFAULT_DELETE_WORKERS):
+        """
+        Deletes objects from S3 in batches of up to DELETE_BATCH_SIZE keys,
+        spread over concurrent workers.
+
+        Batches are sent as soon as they fill up, so objects can be deleted
+        while a listing is still being paged through.
+
+        :param objects: The objects to delete, as {'Key': ..., 'VersionId': ...}
+            dicts, where the version id is optional
+        :type objects: iterable
+
+        :param bucket: The name of the bucket to delete objects from
+        :type bucket: str
+
+        :param max_workers: Number of batches to delete at once
+        :type max_workers: int
+
+        :return: The objects deleted, and the error for each object that was not
+        :rtype: dict
+        """
+        def label(obj):
+            if obj.get('VersionId'):
+                return f"{obj['Key']} ({obj['VersionId']})"
+            return obj['Key']
+
+        def delete_batch(batch):
+            try:
+                response = self.s3_client.delete_objects(Bucket=bucket,
+                    Delete={'Objects': batch, 'Quiet': True})
+                errors = {label(error): f"{error['Code']}: {error['Message']}"
+                          for error in response.get('Errors', [])}
+            except exceptions.ClientError as e:
+                errors = {label(obj): e.response['Error'].get('Message', str(e))
+                          for obj in batch}
+            return batch, errors
+
+        report = {'deleted': [], 'errors': {}}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            batch = []
+            for obj in objects:
+                batch.append(obj)
+                if len(batch) == DELETE_BATCH_SIZE:
+                    futures.append(executor.submit(in_context(delete_batch), batch))
+                    batch = []
+            if batch:
+                futures.append(executor.submit(in_context(delete_batch), batch))
+
+            for future in futures:
+                batch, errors = future.result()
+                report['errors'].update(errors)
+                report['deleted'].extend(label(obj) for obj in batch
+                                         if label(obj) not in errors)
+
+        for key, error in sorted(report['errors'].items()):
+            print(f"Failed to delete {key} from bucket {bucket}: {error}")
+        print(f"Deleted {len(report['deleted'])} object(s) from bucket {bucket}")
+        return report
+
+    def delete_files(self, files, bucket, max_workers=DEFAULT_DELETE_WORKERS):
         """
         Deletes the files from S3.
 
@@ -163,18 +909,55 @@ class AwsDriver(AwsUtil):
 
         :param bucket: The name of the bucket to delete files from
         :type bucket: str
+
+        :param max_workers: Number of batches to delete at once
+        :type max_workers: int
+
+        :return: The files deleted, and the error for each file that was not
+        :rtype: dict
         """
         # Ensure files is a list to ensure logic works
         if type(files).__name__ == 'str':
             files = [files,]
 
+        report = self.delete_objects(({'Key': f} for f in files), bucket, max_workers)
+        if report['errors']:
+            print("Failed to delete files from the bucket. Ensure the bucket is in this account")
+            exit(1)
+        return report
+
+    def delete_prefix(self, bucket, prefix='', max_workers=DEFAULT_DELETE_WORKERS):
+        """
+        Deletes every object under a prefix, including all of their versions
+        and delete markers.
+
+        :param bucket: The name of the bucket to delete objects from
+        :type bucket: str
+
+        :param prefix: Only delete keys starting with this prefix
+        :type prefix: str
+
+        :param max_workers: Number of batches to delete at once
+        :type max_workers: int
+
+        :return: The objects deleted, and the error for each object that was not
+        :rtype: dict
+        """
+        def list_versions():
+            paginator = self.s3_client.get_paginator('list_object_versions')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Versions', []) + page.get('DeleteMarkers', []):
+                    yield {'Key': obj['Key'], 'VersionId': obj['VersionId']}
+
         try:
-            for f in files:
-                self.s3_client.delete_object(Bucket=bucket, Key=f)
-                print(f"Deleted file {f} from bucket {bucket}")
+            report = self.delete_objects(list_versions(), bucket, max_workers)
         except exceptions.ClientError:
+            print("Failed to list files in the bucket. Ensure the bucket is in this account")
+            exit(1)
+        if report['errors']:
             print("Failed to delete files from the bucket. Ensure the bucket is in this account")
             exit(1)
+        return report
 
     def verify_key_pair(self, kp_name):
         """
@@ -298,7 +1081,40 @@ class AwsDriver(AwsUtil):
         else:
             print("Error downloading key pair. Could not find key pair.")
 
-    def get_cf_stack(self, stack_name):
+    def push_image(self, tag, repository=CONTAINER_REPOSITORY):
+        """
+        Pushes a local image to the account's ECR registry, creating the
+        repository if needed.
+
+        :param tag: The local image tag
+        :type tag: str
+
+        :param repository: The ECR repository name
+        :type repository: str
+
+        :return: The pushed image's URI
+        :rtype: str
+        """
+        ecr_client = self._client('ecr')
+        try:
+            uri = ecr_client.create_repository(repositoryName=repository,
+                imageScanningConfiguration={'scanOnPush': True})['repository']['repositoryUri']
+            print(f"Created ECR repository {repository}")
+        except ecr_client.exceptions.RepositoryAlreadyExistsException:
+            uri = ecr_client.describe_repositories(
+                repositoryNames=[repository])['repositories'][0]['repositoryUri']
+
+        auth = ecr_client.get_authorization_token()['authorizationData'][0]
+        user, password = base64.b64decode(auth['authorizationToken']).decode('utf-8').split(':', 1)
+        docker('login', '--username', user, '--password-stdin', auth['proxyEndpoint'],
+               input=password.encode('utf-8'), capture_output=True)
+        image = f"{uri}:{tag.split(':')[-1]}"
+        docker('tag', tag, image)
+        docker('push', image)
+        print(f"Pushed image {image}")
+        return image
+
+    def get_cf_stack(self, stack_name, cached=False):
         """
         Gets the CF
 
@@ -308,16 +1124,118 @@ class AwsDriver(AwsUtil):
         :param stack_name: The name to use for the CloudFormation stack
         :type stack_name: str
 
+        :param cached: Whether a cached copy of a finished stack will do
+        :type cached: bool
+
         :return: CloudFormation stack id
         :rtype: str
         """
+        key = self._cache_key('stack', stack_name)
+        if cached:
+            stack = self.cache.get(key)
+            if stack is not None:
+                return stack
         try:
-            stack = self.cf_client.describe_stacks(StackName=stack_name)
-            return stack['Stacks'][0]
+            stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
         except exceptions.ClientError as e:
             return None
+        if stack.get('StackStatus') in CACHEABLE_STACK_STATUSES:
+            # Only what info and test use, the rest is not JSON serializable
+            self.cache.set(key, {k: stack[k] for k in
+                ['StackId', 'StackName', 'StackStatus', 'Parameters', 'Outputs'] if k in stack},
+                STACK_CACHE_TTL)
+        return stack
+
+    def invalidate_stack(self, stack_name):
+        """
+        Drops the cached copy of the stack, e.g. when it is about to change.
+
+        :param stack_name: The name of the CloudFormation stack
+        :type stack_name: str
+        """
+        self.cache.invalidate(self._cache_key('stack', stack_name))
+
+    def get_latest_ami(self):
+        """
+        Looks up the latest Amazon Linux 2 AMI for the region.
+
+        :return: The AMI id
+        :rtype: str
+        """
+        key = self._cache_key('ami')
+        ami_id = self.cache.get(key)
+        if ami_id is None:
+            ami_id = self.ssm_client.get_parameter(
+                Name='/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2')['Parameter']['Value']
+            self.cache.set(key, ami_id, AMI_CACHE_TTL)
+        return ami_id
+
+    def load_template(self, ami_id, **options):
+        """
+        Renders the AWS CloudFormation template for the region's AMI,
+        exiting if it fails to validate locally.
+
+        :param ami_id: The AMI id to launch instances from
+        :type ami_id: str
+
+        :param options: Other render_template arguments, e.g. az_count
+        :type options: dict
+
+        :return: The template body
+        :rtype: str
+        """
+        try:
+            return render_template(ami_id, **options)
+        except ValueError as e:
+            print(f"CloudFormation template failed to validate with the following message: \n {e}")
+            exit(1)
+
+    def template_source(self, template_body, stack_name):
+        """
+        Gets the CloudFormation argument passing the template. Templates
+        too large to send inline are uploaded to the stack's bucket, under
+        a key named after their contents, and passed by URL.
+
+        :param template_body: The template body
+        :type template_body: str
+
+        :param stack_name: The stack name, used to find the bucket
+        :type stack_name: str
+
+        :return: The TemplateBody or TemplateURL argument
+        :rtype: dict
+        """
+        body = template_body.encode('utf-8')
+        if len(body) <= TEMPLATE_BODY_LIMIT:
+            return {'TemplateBody': template_body}
+        bucket = self.create_bucket(stack_name)
+        key = f"{TEMPLATE_PREFIX}{hashlib.sha256(body).hexdigest()[:12]}.json"
+        self.s3_client.put_object(Bucket=bucket, Key=key, Body=body,
+                                  ContentType='application/json')
+        url = f"{self.s3_client.meta.endpoint_url}/{bucket}/{key}"
+        print(f"Template is {len(body)} bytes, uploaded it to {url}")
+        return {'TemplateURL': url}
+
+    def validate_template(self, template_body, stack_name=DEFAULT_NAME):
+        """
+        Validates the AWS CloudFormation template with CloudFormation,
+        exiting if it is invalid.
+
+        :param template_body: The template body
+        :type template_body: str
+
+        :param stack_name: The stack name, used to find the bucket to
+            upload large templates to
+        :type stack_name: str
+        """
+        try:
+            self.cf_client.validate_template(**self.template_source(template_body, stack_name))
+        except exceptions.ClientError as e:
+            print(f"CloudFormation template syntax failed to validate with the following message: \n " \
+                f"{e.response['Error']['Message']}")
+            exit(1)
 
-    def create_cf_stack(self, kp_name, stack_name):
+    def create_cf_stack(self, kp_name, stack_name, template_body=None, parameters=None):
         """
         Uploads the AWS CloudFormation template creates the
         application stack in AWS.
@@ -328,6 +1246,13 @@ class AwsDriver(AwsUtil):
         :param stack_name: The name to use for the CloudFormation stack
         :type stack_name: str
 
+        :param template_body: The validated template body, rendered here
+            if not given
+        :type template_body: str
+
+        :param parameters: Other template parameter values, by name
+        :type parameters: dict
+
         :return: CloudFormation stack id
         :rtype: str
         """
@@ -336,110 +1261,603 @@ class AwsDriver(AwsUtil):
             self.cf_client.describe_stacks(StackName=stack_name)
             print(f"CloudFormation stack with name {stack_name} already exists, exiting")
             exit(0)
-        # Get template and update with correct AMI for region
-        template = json.loads(open('app.cf', 'r').read())
-        ami_id = self.ssm_client.get_parameter(
-            Name='/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2')['Parameter']['Value']
-        template['Resources']['LaunchConfiguration']['Properties']['ImageId'] = ami_id
-        # Validate template
-        try:
-            self.cf_client.validate_template(TemplateBody=json.dumps(template))
-        except exceptions.ClientError as e:
-            print(f"CloudFormation template syntax failed to validate with the following message: \n " \
-                f"{e.response['Error']['Message']}")
+        if template_body is None:
+            template_body = self.load_template(self.get_latest_ami())
         # Create stack in AWS
+        self.invalidate_stack(stack_name)
         try:
             stack_id = self.cf_client.create_stack(
-                StackName=stack_name, TemplateBody=json.dumps(template),
-                Parameters=[{'ParameterKey': 'KeyPairName', 'ParameterValue': kp_name}], 
+                StackName=stack_name, **self.template_source(template_body, stack_name),
+                Parameters=[{'ParameterKey': 'KeyPairName', 'ParameterValue': kp_name}] + \
+                    [{'ParameterKey': key, 'ParameterValue': str(value)}
+                     for key, value in (parameters or {}).items()],
                 Capabilities=['CAPABILITY_IAM'])
         except exceptions.ClientError as e:
             print(f"Cloud Formation Stack creation FAILED: " \
                 f"{e.response['Error']['Message']}")
+            exit(1)
         print(f"Initiated creation of cloudformation stack {stack_name}")
         return stack_id['StackId']
 
-    def wait_for_stack_completion(self, stack_id):
+    def get_new_stack_events(self, stack_id, seen):
         """
-        Waits for the specified stack to either complete or fail.
+        Gets the stack events that have not been seen yet, oldest first.
+
+        Events are paged newest first, so paging stops at the first event
+        already seen. On the first call, it stops at the event that started
+        the stack's current operation instead, skipping older history.
 
         :param stack_id: CloudFormation stack id
         :type stack_id: str
+
+        :param seen: Ids of the events already returned, updated in place
+        :type seen: set
+
+        :return: The new events
+        :rtype: list
         """
-        keep_waiting = True
-        while keep_waiting:
-            for i in range(30):
-                cf_stack = self.cf_client.describe_stacks(StackName=stack_id)['Stacks'][0]
-                if cf_stack['StackStatus'] == 'CREATE_IN_PROGRESS':
-                    print("Waiting for stack to complete")
-                    sleep(15)
-                elif cf_stack['StackStatus'] == 'CREATE_COMPLETE':
-                    print("CloudFormation stack completed")
-                    for output in cf_stack['Outputs']:
-                        if output['OutputKey'] == 'URL':
-                            url = output['OutputValue']
-                    print(f"Message API URL: \n{url}")
-                    keep_waiting = False
-                    return url
-                else:
-                    print(f"CloudFormation stack had the following code: " \
-                        f"{cf_stack['StackStatus']}")
-                    exit(1)
+        events = []
+        first = not seen
+        kwargs = {'StackName': stack_id}
+        while True:
+            page = self.cf_client.describe_stack_events(**kwargs)
+            for event in page.get('StackEvents', []):
+                if event['EventId'] in seen:
+                    break
+                events.append(event)
+                if first and event.get('ResourceType') == 'AWS::CloudFormation::Stack' \
+                        and event.get('PhysicalResourceId') == stack_id \
+                        and event.get('ResourceStatus', '').endswith('_IN_PROGRESS') \
+                        and event.get('ResourceStatusReason') == 'User Initiated':
+                    break
             else:
-                print(f"Creation of the CloudFormation stack is taking too long, exiting.")
-                exit(0)
+                if page.get('NextToken'):
+                    kwargs['NextToken'] = page['NextToken']
+                    continue
+            break
+        seen.update(event['EventId'] for event in events)
+        return list(reversed(events))
+
+    def wait_for_stack(self, stack_id, success_statuses, timeout=DEFAULT_STACK_TIMEOUT):
+        """
+        Waits for a stack operation to finish, printing resource events and
+        per-resource timings as they happen.
 
-    def delete_cf_stack(self, stack_name):
+        Polls every MIN_POLL_INTERVAL seconds while events are arriving and
+        backs off to MAX_POLL_INTERVAL while nothing changes.
+
+        :param stack_id: CloudFormation stack id. Use the id rather than the
+            name to follow a deletion until the end
+        :type stack_id: str
+
+        :param success_statuses: Stack statuses that mean the operation succeeded
+        :type success_statuses: list
+
+        :param timeout: Seconds to wait before giving up
+        :type timeout: float
+
+        :return: The stack once it reached a final status, or None on timeout
+        :rtype: dict
         """
-        Deletes the CloudFormation stack.
+        deadline = monotonic() + timeout
+        interval = MIN_POLL_INTERVAL
+        seen = set()
+        started = {}
+        while True:
+            events = self.get_new_stack_events(stack_id, seen)
+            for event in events:
+                resource = event['LogicalResourceId']
+                status = event['ResourceStatus']
+                line = f"{event['Timestamp']:%H:%M:%S} {resource} " \
+                    f"({event['ResourceType']}) {status}"
+                if status.endswith('_IN_PROGRESS'):
+                    started.setdefault(resource, event['Timestamp'])
+                elif resource in started:
+                    elapsed = (event['Timestamp'] - started.pop(resource)).total_seconds()
+                    line += f" after {elapsed:.0f}s"
+                if event.get('ResourceStatusReason') and 'FAILED' in status:
+                    line += f": {event['ResourceStatusReason']}"
+                print(line)
+
+            cf_stack = self.cf_client.describe_stacks(StackName=stack_id)['Stacks'][0]
+            status = cf_stack['StackStatus']
+            if not status.endswith('_IN_PROGRESS'):
+                if status not in success_statuses:
+                    print(f"CloudFormation stack had the following code: {status}")
+                return cf_stack
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            interval = MIN_POLL_INTERVAL if events else min(interval * POLL_BACKOFF,
+                                                              MAX_POLL_INTERVAL)
+            sleep(min(interval, remaining))
+
+    def wait_for_stack_completion(self, stack_id, timeout=DEFAULT_STACK_TIMEOUT,
+                                  success_status='CREATE_COMPLETE'):
+        """
+        Waits for the specified stack to either complete or fail.
+
+        :param stack_id: CloudFormation stack id
+        :type stack_id: str
+
+        :param timeout: Seconds to wait before giving up
+        :type timeout: float
+
+        :param success_status: The stack status that means the operation
+            succeeded, e.g. UPDATE_COMPLETE
+        :type success_status: str
+
+        :return: The Message API URL
+        :rtype: str
+        """
+        cf_stack = self.wait_for_stack(stack_id, [success_status], timeout)
+        if cf_stack is None:
+            print(f"The CloudFormation stack is taking too long, exiting.")
+            exit(1)
+        if cf_stack['StackStatus'] != success_status:
+            exit(1)
+        print("CloudFormation stack completed")
+        for output in cf_stack['Outputs']:
+            if output['OutputKey'] == 'URL':
+                url = output['OutputValue']
+        print(f"Message API URL: \n{url}")
+        return url
+
+    def create_change_set(self, stack_name, template_body, parameters=None, previous=()):
+        """
+        Creates a change set updating the stack to the template.
 
         :param stack_name: The name of the CloudFormation stack
         :type stack_name: str
+
+        :param template_body: The validated template body
+        :type template_body: str
+
+        :param parameters: Template parameter values to change, by name
+        :type parameters: dict
+
+        :param previous: Names of the stack's current parameters. Those the
+            template still declares and are not changed keep their values
+        :type previous: list
+
+        :return: The change set id
+        :rtype: str
         """
+        parameters = parameters or {}
+        declared = json.loads(template_body).get('Parameters', {})
+        values = [{'ParameterKey': key, 'ParameterValue': str(parameters[key])}
+                  if key in parameters else {'ParameterKey': key, 'UsePreviousValue': True}
+                  for key in declared if key in parameters or key in previous]
         try:
-            self.cf_client.delete_stack(StackName=stack_name)
+            change_set = self.cf_client.create_change_set(
+                StackName=stack_name, ChangeSetName=f"{stack_name}-{int(time())}",
+                ChangeSetType='UPDATE', **self.template_source(template_body, stack_name),
+                Parameters=values, Capabilities=['CAPABILITY_IAM'])
         except exceptions.ClientError as e:
-            print(f"Cloud Formation Stack deletion FAILED: " \
+            print(f"Cloud Formation change set creation FAILED: " \
                 f"{e.response['Error']['Message']}")
-        print(f"Initated deletion of cloudformation stack {stack_name}")
+            exit(1)
+        return change_set['Id']
 
-    def wait_for_stack_deletion(self, stack_name):
+    def wait_for_change_set(self, change_set_id, timeout=DEFAULT_STACK_TIMEOUT):
         """
-        Waits for the specified stack to either complete or fail.
+        Waits for a change set to be ready to execute.
 
-        :param stack_name: CloudFormation stack name
-        :type stack_name: str
+        A change set that would not change anything is deleted.
+
+        :param change_set_id: The change set id
+        :type change_set_id: str
+
+        :param timeout: Seconds to wait before giving up
+        :type timeout: float
+
+        :return: The change set with all of its changes, or None if it has
+            nothing to change
+        :rtype: dict
         """
-        keep_waiting = True
-        while keep_waiting:
-            for i in range(30):
-                try:
-                    cf_stack = self.cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
-                except exceptions.ClientError as e:
-                    if 'exist' in e.response['Error']['Message']:
-                        print("CloudFormation stack deleted")
-                        keep_waiting = False
-                        break
-                if cf_stack['StackStatus'] == 'DELETE_IN_PROGRESS':
-                    print("Waiting for stack to delete")
-                    sleep(15)
-                elif cf_stack['StackStatus'] == 'DELETE_COMPLETE':
-                    print("CloudFormation stack deleted")
-                    keep_waiting = False
-                    break
-                else:
-                    print(f"CloudFormation stack had the following code: " \
-                          f"{cf_stack['StackStatus']}")
-                    exit(1)
-            else:
-                print(f"Creation of the CloudFormation stack is taking too long, exiting.")
-                exit(0)
+        deadline = monotonic() + timeout
+        interval = MIN_POLL_INTERVAL
+        while True:
+            change_set = self.cf_client.describe_change_set(ChangeSetName=change_set_id)
+            status = change_set['Status']
+            if status == 'CREATE_COMPLETE':
+                break
+            if status == 'FAILED':
+                reason = change_set.get('StatusReason', '')
+                if "didn't contain changes" in reason or 'No updates' in reason:
+                    self.cf_client.delete_change_set(ChangeSetName=change_set_id)
+                    return None
+                print(f"Cloud Formation change set FAILED: {reason}")
+                exit(1)
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                print(f"The change set is taking too long, exiting.")
+                exit(1)
+            sleep(min(interval, remaining))
+            interval = min(interval * POLL_BACKOFF, MAX_POLL_INTERVAL)
 
-def test_api(url):
-    """
-    Get request against api url.
+        page = change_set
+        while page.get('NextToken'):
+            page = self.cf_client.describe_change_set(ChangeSetName=change_set_id,
+                NextToken=page['NextToken'])
+            change_set['Changes'] = change_set.get('Changes', []) + page.get('Changes', [])
+        return change_set
 
-    :param url: URL of the API
+    def execute_change_set(self, change_set, stack_name):
+        """
+        Executes a change set that is ready.
+
+        :param change_set: The change set, as returned by wait_for_change_set
+        :type change_set: dict
+
+        :param stack_name: The name of the CloudFormation stack
+        :type stack_name: str
+
+        :return: CloudFormation stack id
+        :rtype: str
+        """
+        self.invalidate_stack(stack_name)
+        try:
+            self.cf_client.execute_change_set(ChangeSetName=change_set['ChangeSetId'])
+        except exceptions.ClientError as e:
+            print(f"Cloud Formation change set execution FAILED: " \
+                f"{e.response['Error']['Message']}")
+            exit(1)
+        print(f"Initiated update of cloudformation stack {stack_name}")
+        return change_set['StackId']
+
+    def get_stack_resource(self, stack_name, logical_id):
+        """
+        Gets the physical id of a stack's resource, e.g. the name of the
+        AutoScalingGroup.
+
+        :param stack_name: The name of the CloudFormation stack
+        :type stack_name: str
+
+        :param logical_id: The resource's name in the template
+        :type logical_id: str
+
+        :return: The physical resource id, or None if there is no such stack
+            or resource
+        :rtype: str
+        """
+        try:
+            resource = self.cf_client.describe_stack_resource(StackName=stack_name,
+                LogicalResourceId=logical_id)
+        except exceptions.ClientError as e:
+            return None
+        return resource['StackResourceDetail'].get('PhysicalResourceId')
+
+    def start_instance_refresh(self, group_name, min_healthy=DEFAULT_MIN_HEALTHY,
+                               max_healthy=DEFAULT_MAX_HEALTHY, instance_warmup=None):
+        """
+        Starts replacing the AutoScalingGroup's instances in batches.
+
+        :param group_name: The name of the AutoScalingGroup
+        :type group_name: str
+
+        :param min_healthy: Percentage of the capacity kept in service
+        :type min_healthy: int
+
+        :param max_healthy: Percentage of the capacity that may be in service
+            at once, above 100 to launch replacements before terminating
+        :type max_healthy: int
+
+        :param instance_warmup: Seconds a new instance is given to warm up
+            before the next batch, the group's default warmup if not given
+        :type instance_warmup: int
+
+        :return: The instance refresh id
+        :rtype: str
+        """
+        preferences = {'MinHealthyPercentage': min_healthy, 'MaxHealthyPercentage': max_healthy}
+        if instance_warmup is not None:
+            preferences['InstanceWarmup'] = instance_warmup
+        try:
+            refresh = self.autoscaling_client.start_instance_refresh(
+                AutoScalingGroupName=group_name, Strategy='Rolling', Preferences=preferences)
+        except exceptions.ClientError as e:
+            print(f"Instance refresh FAILED to start: {e.response['Error']['Message']}")
+            exit(1)
+        print(f"Started instance refresh {refresh['InstanceRefreshId']} of {group_name}")
+        return refresh['InstanceRefreshId']
+
+    def wait_for_instance_refresh(self, group_name, refresh_id, timeout=DEFAULT_STACK_TIMEOUT):
+        """
+        Waits for an instance refresh to finish, printing its progress.
+
+        :param group_name: The name of the AutoScalingGroup
+        :type group_name: str
+
+        :param refresh_id: The instance refresh id
+        :type refresh_id: str
+
+        :param timeout: Seconds to wait before giving up
+        :type timeout: float
+
+        :return: The instance refresh once it reached a final status, or
+            None on timeout
+        :rtype: dict
+        """
+        deadline = monotonic() + timeout
+        interval = MIN_POLL_INTERVAL
+        progress = None
+        while True:
+            refresh = self.autoscaling_client.describe_instance_refreshes(
+                AutoScalingGroupName=group_name, InstanceRefreshIds=[refresh_id]
+                )['InstanceRefreshes'][0]
+            changed = (refresh['Status'], refresh.get('PercentageComplete'),
+                       refresh.get('InstancesToUpdate')) != progress
+            if changed:
+                progress = (refresh['Status'], refresh.get('PercentageComplete'),
+                            refresh.get('InstancesToUpdate'))
+                line = f"Instance refresh {refresh['Status']}, " \
+                    f"{refresh.get('PercentageComplete', 0)}% complete, " \
+                    f"{refresh.get('InstancesToUpdate', 0)} instances to go"
+                if refresh.get('StatusReason'):
+                    line += f": {refresh['StatusReason']}"
+                print(line)
+            if refresh['Status'] in REFRESH_FINAL_STATUSES:
+                return refresh
+
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return None
+            interval = MIN_POLL_INTERVAL if changed else min(interval * POLL_BACKOFF,
+                                                               MAX_POLL_INTERVAL)
+            sleep(min(interval, remaining))
+
+    def delete_cf_stack(self, stack_name):
+        """
+        Deletes the CloudFormation stack.
+
+        :param stack_name: The name of the CloudFormation stack
+        :type stack_name: str
+        """
+        self.invalidate_stack(stack_name)
+        try:
+            self.cf_client.delete_stack(StackName=stack_name)
+        except exceptions.ClientError as e:
+            print(f"Cloud Formation Stack deletion FAILED: " \
+                f"{e.response['Error']['Message']}")
+        print(f"Initated deletion of cloudformation stack {stack_name}")
+
+    def wait_for_stack_deletion(self, stack_name, timeout=DEFAULT_STACK_TIMEOUT):
+        """
+        Waits for the specified stack to either complete or fail.
+
+        :param stack_name: CloudFormation stack name
+        :type stack_name: str
+
+        :param timeout: Seconds to wait before giving up
+        :type timeout: float
+        """
+        cf_stack = self.get_cf_stack(stack_name)
+        if cf_stack is not None:
+            # Deleted stacks can only be described by id
+            cf_stack = self.wait_for_stack(cf_stack['StackId'], ['DELETE_COMPLETE'], timeout)
+            if cf_stack is None:
+                print(f"Deletion of the CloudFormation stack is taking too long, exiting.")
+                exit(1)
+            if cf_stack['StackStatus'] != 'DELETE_COMPLETE':
+                exit(1)
+        print("CloudFormation stack deleted")
+
+def template_references(node):
+    """
+    Finds the names a template node refers to.
+
+    :param node: Any part of a template
+    :type node: dict
+
+    :return: The kind of reference, 'Ref', 'Fn::GetAtt', 'Fn::Sub' or
+        'Fn::If', and the name referred to, for every reference
+    :rtype: generator
+    """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Ref' and isinstance(value, str):
+                yield key, value
+            elif key == 'Fn::GetAtt' and isinstance(value, list):
+                yield key, value[0]
+            elif key == 'Fn::If' and isinstance(value, list):
+                yield key, value[0]
+                yield from template_references(value[1:])
+            elif key == 'Fn::Sub':
+                text, variables = (value[0], value[1]) if isinstance(value, list) else (value, {})
+                for name in re.findall(r'\$\{([^!}][^}]*)\}', text):
+                    if name not in variables:
+                        yield key, name.split('.')[0]
+                yield from template_references(variables)
+            else:
+                yield from template_references(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from template_references(value)
+
+def check_template(template):
+    """
+    Checks a template's structure locally, without calling CloudFormation.
+
+    Catches the mistakes a rendered template can make: unknown sections,
+    resources without a type, references to names that do not exist and
+    parameter defaults that break their own constraints.
+
+    :param template: The parsed template
+    :type template: dict
+
+    :return: A description of every problem found
+    :rtype: list
+    """
+    problems = [f"Unknown template section {section}"
+                for section in sorted(set(template) - TEMPLATE_SECTIONS)]
+    parameters = template.get('Parameters', {})
+    resources = template.get('Resources', {})
+    conditions = template.get('Conditions', {})
+    if not resources:
+        problems.append("The template has no resources")
+    if len(resources) > MAX_TEMPLATE_RESOURCES:
+        problems.append(f"The template has {len(resources)} resources, " \
+            f"at most {MAX_TEMPLATE_RESOURCES} are allowed")
+    if len(parameters) > MAX_TEMPLATE_PARAMETERS:
+        problems.append(f"The template has {len(parameters)} parameters, " \
+            f"at most {MAX_TEMPLATE_PARAMETERS} are allowed")
+
+    for name, parameter in parameters.items():
+        default = parameter.get('Default')
+        if 'Type' not in parameter:
+            problems.append(f"Parameter {name} has no Type")
+        if default is None:
+            continue
+        if parameter.get('Type') == 'Number' and \
+                not parameter.get('MinValue', default) <= default <= parameter.get('MaxValue', default):
+            problems.append(f"Parameter {name} default {default} is out of range")
+        if 'AllowedPattern' in parameter and \
+                not re.fullmatch(parameter['AllowedPattern'], str(default)):
+            problems.append(f"Parameter {name} default {default!r} does not match its pattern")
+        if 'AllowedValues' in parameter and default not in parameter['AllowedValues']:
+            problems.append(f"Parameter {name} default {default!r} is not an allowed value")
+
+    names = set(parameters) | set(resources) | PSEUDO_PARAMETERS
+    for section in ['Resources', 'Outputs']:
+        for name, node in template.get(section, {}).items():
+            if section == 'Resources' and not re.fullmatch(r'(AWS|Custom)::\w+(::\w+)*',
+                                                           str(node.get('Type'))):
+                problems.append(f"Resource {name} has an invalid Type {node.get('Type')!r}")
+            if 'Condition' in node and node['Condition'] not in conditions:
+                problems.append(f"{name} uses the unknown condition {node['Condition']}")
+            depends_on = node.get('DependsOn', [])
+            for dependency in [depends_on] if isinstance(depends_on, str) else depends_on:
+                if dependency not in resources:
+                    problems.append(f"{name} depends on the unknown resource {dependency}")
+            for kind, target in template_references(node):
+                known = conditions if kind == 'Fn::If' else \
+                    resources if kind == 'Fn::GetAtt' else names
+                if target not in known:
+                    problems.append(f"{name} refers to the unknown {target} with {kind}")
+    return problems
+
+def copy_zone(node, names, zone):
+    """
+    Copies a part of the template for the first Availability Zone to
+    another zone.
+
+    :param node: The part of the template to copy
+    :type node: dict
+
+    :param names: The other zone's names, keyed by the first zone's
+    :type names: dict
+
+    :param zone: The other zone's number, counting from 1
+    :type zone: int
+
+    :return: The copy
+    :rtype: dict
+    """
+    if isinstance(node, dict):
+        copied = {}
+        for key, value in node.items():
+            if key == 'Ref':
+                copied[key] = names.get(value, value)
+            elif key == 'Fn::GetAtt':
+                copied[key] = [names.get(value[0], value[0])] + value[1:]
+            elif key == 'Fn::Select' and value[1] == {'Fn::GetAZs': ''}:
+                copied[key] = [zone - 1, value[1]]
+            else:
+                copied[key] = copy_zone(value, names, zone)
+        return copied
+    if isinstance(node, list):
+        return [copy_zone(value, names, zone) for value in node]
+    if isinstance(node, str):
+        return node.replace('(AZ1)', f'(AZ{zone})') \
+            .replace('the first Availability Zone', f'Availability Zone {zone}')
+    return node
+
+@functools.lru_cache(maxsize=None)
+def _render_template(path, modified, ami_id, az_count, instance_type, listener_port,
+                     application_port):
+    with open(path, 'r') as f:
+        template = json.loads(f.read())
+    parameters = template['Parameters']
+    resources = template['Resources']
+
+    # Every zone after the second gets its own subnets, NAT gateway and routes,
+    # with the next unused subnet ranges of the VPC
+    vpc = ipaddress.ip_network(parameters['VpcCIDR']['Default'])
+    prefix = ipaddress.ip_network(parameters['PublicSubnet1CIDR']['Default']).prefixlen
+    ranges = list(vpc.subnets(new_prefix=prefix))
+    for zone in range(3, az_count + 1):
+        names = {name.format(1): name.format(zone) for name in ZONE_RESOURCES + ZONE_PARAMETERS}
+        for name in ZONE_RESOURCES:
+            resources[name.format(zone)] = copy_zone(resources[name.format(1)], names, zone)
+        for name, cidr in zip(ZONE_PARAMETERS, ranges[2 * zone - 2:2 * zone]):
+            parameters[name.format(zone)] = copy_zone(parameters[name.format(1)], names, zone)
+            parameters[name.format(zone)]['Default'] = str(cidr)
+    zones = range(1, az_count + 1)
+    resources['ApplicationLoadBalancer']['Properties']['Subnets'] = [
+        {'Ref': f'PublicSubnet{zone}'} for zone in zones]
+    resources['AutoScalingGroup']['Properties']['VPCZoneIdentifier'] = [
+        {'Ref': f'PrivateSubnet{zone}'} for zone in zones]
+
+    resources['LaunchConfiguration']['Properties']['ImageId'] = ami_id
+    options = {'instance_type': instance_type, 'listener_port': listener_port,
+               'application_port': application_port}
+    for option, name in TEMPLATE_OPTION_PARAMETERS.items():
+        if options[option] is not None:
+            parameters[name]['Default'] = options[option]
+
+    problems = check_template(template)
+    body = json.dumps(template, separators=(',', ':'))
+    if len(body.encode('utf-8')) > TEMPLATE_URL_LIMIT:
+        problems.append(f"The template is {len(body)} bytes, " \
+            f"at most {TEMPLATE_URL_LIMIT} are allowed")
+    if problems:
+        raise ValueError('\n '.join(problems))
+    return body
+
+def render_template(ami_id, az_count=DEFAULT_AZ_COUNT, instance_type=None, listener_port=None,
+                    application_port=None, path=TEMPLATE_FILE):
+    """
+    Renders the AWS CloudFormation template and checks it locally.
+
+    The template is rendered once per process for each set of arguments,
+    and again only when the template file changes. Arguments left unset
+    keep the template's defaults.
+
+    :param ami_id: The AMI id to launch instances from
+    :type ami_id: str
+
+    :param az_count: Number of Availability Zones to spread the subnets,
+        NAT gateways and instances across
+    :type az_count: int
+
+    :param instance_type: The EC2 instance type to run the application on
+    :type instance_type: str
+
+    :param listener_port: The port the load balancer accepts requests on
+    :type listener_port: int
+
+    :param application_port: The port the application listens on
+    :type application_port: int
+
+    :param path: The template file to render
+    :type path: str
+
+    :return: The compact template body
+    :rtype: str
+    """
+    if not 2 <= az_count <= MAX_AZ_COUNT:
+        # Application load balancers need subnets in at least two zones
+        raise ValueError(f"The Availability Zone count must be between 2 and {MAX_AZ_COUNT}")
+    return _render_template(path, os.stat(path).st_mtime_ns, ami_id, az_count, instance_type,
+                            listener_port, application_port)
+
+def test_api(url):
+    """
+    Get request against api url.
+
+    :param url: URL of the API
     :type url: str
     """
     response = requests.get(url=url).json()
@@ -447,14 +1865,549 @@ def test_api(url):
     pprint(response, indent=2)
     return response
 
+def expand_paths(paths):
+    """
+    Expands directories into the files they contain, recursively.
+
+    :param paths: File and directory paths
+    :type paths: list
+
+    :return: The file paths, in a stable order
+    :rtype: list
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        else:
+            files.append(path)
+    return files
+
+def file_digests(path):
+    """
+    Computes the ETag S3 will report for a file uploaded by upload_files,
+    along with its SHA-256, in a single pass.
+
+    Files uploaded in parts get an ETag made of the MD5 of each part's MD5,
+    followed by the number of parts.
+
+    :param path: The path of the file
+    :type path: str
+
+    :return: The quoted ETag and the hex SHA-256 digest
+    :rtype: tuple
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    parts = []
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MULTIPART_CHUNKSIZE), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+            size += len(chunk)
+    if size >= MULTIPART_THRESHOLD:
+        etag = f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+    else:
+        etag = md5.hexdigest()
+    return f'"{etag}"', sha256.hexdigest()
+
+def artifact_version(paths, python_version, platform):
+    """
+    Versions an artifact by its contents, so unchanged builds reuse it.
+
+    :param paths: The files going into the artifact
+    :type paths: list
+
+    :param python_version: The Python version the dependencies are for
+    :type python_version: str
+
+    :param platform: The platform the dependencies are for
+    :type platform: str
+
+    :return: The version
+    :rtype: str
+    """
+    digest = hashlib.sha256(f"{python_version} {platform}\n".encode('utf-8'))
+    for path in paths:
+        digest.update(f"{Path(path).as_posix()} {file_digests(path)[1]}\n".encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+def install_dependencies(requirements, target, python_version, platform):
+    """
+    Installs requirements into a directory, for another Python and platform.
+
+    Requirements only published as source are built into wheels locally
+    first, which works for the pure Python ones.
+
+    :param requirements: The requirements file
+    :type requirements: str
+
+    :param target: The directory to install into
+    :type target: str
+
+    :param python_version: The Python version to install for, e.g. 3.7
+    :type python_version: str
+
+    :param platform: The platform to install for, e.g. manylinux2014_x86_64
+    :type platform: str
+    """
+    pip = [sys.executable, '-m', 'pip', '--disable-pip-version-check', '--quiet']
+    with tempfile.TemporaryDirectory() as wheelhouse:
+        try:
+            subprocess.run(pip + ['wheel', '--no-deps', '-r', requirements, '-w', wheelhouse],
+                check=True)
+            subprocess.run(pip + ['install', '-r', requirements, '--target', target,
+                '--find-links', wheelhouse, '--only-binary=:all:', '--no-compile',
+                '--implementation', 'cp', '--python-version', python_version,
+                '--platform', platform], check=True)
+        except subprocess.CalledProcessError:
+            print(f"Failed to install {requirements} for Python {python_version} on {platform}")
+            exit(1)
+
+def build_artifact(files, output_dir=ARTIFACT_DIR, python_version=ARTIFACT_PYTHON_VERSION,
+                   platform=ARTIFACT_PLATFORM):
+    """
+    Builds the tarball instances boot from: the application files, and
+    their requirements installed in a lib directory.
+
+    An artifact with the same version already in the output directory is
+    reused.
+
+    :param files: The application files and directories
+    :type files: list
+
+    :param output_dir: The directory to write the artifact to
+    :type output_dir: str
+
+    :param python_version: The Python version to install the requirements for
+    :type python_version: str
+
+    :param platform: The platform to install the requirements for
+    :type platform: str
+
+    :return: The artifact's path
+    :rtype: str
+    """
+    paths = expand_paths(files)
+    version = artifact_version(paths, python_version, platform)
+    path = os.path.join(output_dir, f"app-{version}.tar.gz")
+
+    def reset_owner(info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        return info
+
+    # Targets built side by side share the artifact
+    with ARTIFACT_LOCK:
+        if os.path.exists(path):
+            print(f"Artifact {path} is up to date")
+            return path
+        os.makedirs(output_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory() as lib:
+            requirements = [p for p in paths if os.path.basename(p) == 'requirements.txt']
+            if requirements:
+                install_dependencies(requirements[0], lib, python_version, platform)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with tarfile.open(tmp_path, 'w:gz') as tar:
+                for p in paths:
+                    tar.add(p, arcname=Path(p).as_posix(), filter=reset_owner)
+                tar.add(lib, arcname='lib', filter=reset_owner)
+            os.replace(tmp_path, path)
+    print(f"Built artifact {path}")
+    return path
+
+def docker(*args, **kwargs):
+    """
+    Runs a docker command, exiting if it fails.
+
+    :return: The completed process
+    :rtype: subprocess.CompletedProcess
+    """
+    try:
+        return subprocess.run(['docker'] + list(args), check=True, **kwargs)
+    except FileNotFoundError:
+        print("Docker is not installed, it is needed to build and run the container image")
+        exit(1)
+    except subprocess.CalledProcessError:
+        print(f"docker {args[0]} failed")
+        exit(1)
+
+def build_image(repository=CONTAINER_REPOSITORY):
+    """
+    Builds the application image, tagged with a hash of the files it is
+    built from.
+
+    :param repository: The image repository name
+    :type repository: str
+
+    :return: The image tag
+    :rtype: str
+    """
+    tag = f"{repository}:{artifact_version(expand_paths(CONTAINER_FILES), 'docker', 'linux/amd64')}"
+    docker('build', '--platform', 'linux/amd64', '--tag', tag, '.')
+    print(f"Built image {tag}")
+    return tag
+
+def run_container(tag, port=DEFAULT_CONTAINER_PORT, timeout=CONTAINER_START_TIMEOUT):
+    """
+    Runs the application image locally, replacing a container already
+    running it, and waits until it passes its health check.
+
+    :param tag: The image tag
+    :type tag: str
+
+    :param port: The local port to publish the application on
+    :type port: int
+
+    :param timeout: Seconds to wait for the application to start
+    :type timeout: float
+
+    :return: The URL of the message API
+    :rtype: str
+    """
+    name = tag.split(':')[0].rsplit('/', 1)[-1]
+    subprocess.run(['docker', 'rm', '--force', name], capture_output=True)
+    start = perf_counter()
+    docker('run', '--detach', '--name', name, '--publish', f"{port}:80", tag,
+           capture_output=True)
+    url = f"http://127.0.0.1:{port}"
+    while perf_counter() - start < timeout:
+        try:
+            if requests.get(f"{url}/healthz", timeout=1).ok:
+                print(f"Container {name} started in {perf_counter() - start:.2f}s, " \
+                    f"stop it with: docker stop -t 35 {name}")
+                return f"{url}/message"
+        except requests.RequestException:
+            pass
+        sleep(0.1)
+    print(f"Container {name} did not pass its health check within {timeout}s, " \
+        f"see: docker logs {name}")
+    exit(1)
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+
+    :param sorted_values: The values, sorted ascending
+    :type sorted_values: list
+
+    :param pct: The percentile to return, between 0 and 100
+    :type pct: float
+
+    :return: The percentile value, or None if there are no values
+    :rtype: float
+    """
+    if not sorted_values:
+        return None
+    # The smallest value with at least pct percent of the values at or below it
+    rank = max(math.ceil(pct * len(sorted_values) / 100) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+def summarize_latencies(latencies):
+    """
+    Summarizes request latencies into percentiles and a histogram.
+
+    :param latencies: Request latencies in milliseconds
+    :type latencies: list
+
+    :return: The latency summary
+    :rtype: dict
+    """
+    latencies = sorted(latencies)
+    summary = {
+        'min': latencies[0] if latencies else None,
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'p99.9': percentile(latencies, 99.9),
+        'max': latencies[-1] if latencies else None,
+    }
+    histogram = []
+    index = 0
+    for bound in BENCH_HISTOGRAM_BUCKETS + [None]:
+        start = index
+        while index < len(latencies) and (bound is None or latencies[index] <= bound):
+            index += 1
+        histogram.append({'le_ms': bound, 'count': index - start})
+    summary['histogram'] = histogram
+    return summary
+
+def run_benchmark(url, connections=DEFAULT_BENCH_CONNECTIONS,
+        duration=DEFAULT_BENCH_DURATION, total_requests=None, timeout=10):
+    """
+    Drives GET requests against a URL and measures throughput and latency.
+
+    Each connection is a thread with its own pooled session, so connections
+    are kept alive between requests.
+
+    :param url: The URL to request
+    :type url: str
+
+    :param connections: Number of concurrent connections
+    :type connections: int
+
+    :param duration: Seconds to run for, ignored when total_requests is set
+    :type duration: float
+
+    :param total_requests: Number of requests to send across all connections
+    :type total_requests: int
+
+    :param timeout: Seconds to wait for each response
+    :type timeout: float
+
+    :return: The benchmark results
+    :rtype: dict
+    """
+    tickets = count()
+    latencies = []
+    errors = {}
+    lock = threading.Lock()
+    deadline = None if total_requests else perf_counter() + duration
+
+    def worker():
+        thread_latencies = []
+        thread_errors = {}
+        with requests.Session() as session:
+            while True:
+                if total_requests:
+                    if next(tickets) >= total_requests:
+                        break
+                elif perf_counter() >= deadline:
+                    break
+                start = perf_counter()
+                try:
+                    response = session.get(url, timeout=timeout)
+                    response.content
+                    if response.status_code >= 400:
+                        error = f'HTTP {response.status_code}'
+                    else:
+                        error = None
+                except requests.RequestException as e:
+                    error = type(e).__name__
+                thread_latencies.append((perf_counter() - start) * 1000)
+                if error:
+                    thread_errors[error] = thread_errors.get(error, 0) + 1
+        with lock:
+            latencies.extend(thread_latencies)
+            for error, error_count in thread_errors.items():
+                errors[error] = errors.get(error, 0) + error_count
+
+    started = perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - started
+
+    return {
+        'url': url,
+        'connections': connections,
+        'duration': elapsed,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': summarize_latencies(latencies),
+    }
+
+def print_benchmark(results):
+    """
+    Prints benchmark results as a readable report.
+
+    :param results: The results returned by run_benchmark
+    :type results: dict
+    """
+    latency = results['latency_ms']
+    print(f"Benchmark of {results['url']} with {results['connections']} connections")
+    print(f"  Requests: {results['requests']} in {results['duration']:.2f}s " \
+        f"({results['rps']:.1f} req/s)")
+    print(f"  Errors:   {sum(results['errors'].values())} {results['errors'] or ''}")
+    if not results['requests']:
+        return
+    print("  Latency (ms):")
+    for key in ['min', 'mean', 'p50', 'p90', 'p99', 'p99.9', 'max']:
+        print(f"    {key:>6} {latency[key]:10.2f}")
+    print("  Histogram (ms):")
+    largest = max(bucket['count'] for bucket in latency['histogram'])
+    for bucket in latency['histogram']:
+        label = f"<= {bucket['le_ms']}" if bucket['le_ms'] is not None else 'more'
+        bar = '#' * int(40 * bucket['count'] / largest) if largest else ''
+        print(f"    {label:>8} {bucket['count']:8} {bar}")
+
+def print_changes(changes):
+    """
+    Prints the resources a change set adds, modifies or removes.
+
+    :param changes: The change set's changes
+    :type changes: list
+    """
+    print(f"{'action':<8} {'resource':<36} {'type':<44} {'replacement':<11} changes")
+    for change in changes:
+        change = change['ResourceChange']
+        details = sorted({detail['Target'].get('Name') or detail['Target']['Attribute']
+                          for detail in change.get('Details', [])})
+        print(f"{change['Action']:<8} {change['LogicalResourceId']:<36} " \
+            f"{change['ResourceType']:<44} {change.get('Replacement', ''):<11} " \
+            f"{', '.join(details)}")
+
+def run_phases(phases, max_workers=DEFAULT_PHASE_WORKERS):
+    """
+    Runs phases concurrently, each as soon as the phases it requires are done.
+
+    Each phase is a (name, function, requires) tuple. The function is called
+    with the results of the required phases, in order. When a phase fails,
+    no further phases are started, the running ones are waited for and the
+    error is raised.
+
+    :param phases: The phases to run
+    :type phases: list
+
+    :param max_workers: Number of phases to run at once
+    :type max_workers: int
+
+    :return: The result of each phase, by name
+    :rtype: dict
+    """
+    requires = {name: list(deps) for name, func, deps in phases}
+    funcs = {name: func for name, func, deps in phases}
+    for name, deps in requires.items():
+        for dep in deps:
+            if dep not in requires:
+                raise ValueError(f"Phase {name} requires unknown phase {dep}")
+
+    results = {}
+    pending = dict(requires)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, deps in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    del pending[name]
+                    running[executor.submit(in_context(funcs[name]),
+                        *[results[dep] for dep in deps])] = name
+            if not running:
+                raise ValueError(f"Phases {sorted(pending)} have circular requirements")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    if not (isinstance(error, SystemExit) and not error.code):
+                        print(f"Build phase {name} failed, not starting " \
+                            f"{', '.join(sorted(pending)) or 'any further phases'}")
+                    if running:
+                        print(f"Waiting for {', '.join(sorted(running.values()))} to finish")
+                    # Only phases already submitted can be waiting, and
+                    # cancel_futures needs Python 3.9
+                    for queued in running:
+                        queued.cancel()
+                    executor.shutdown(wait=True)
+                    raise error
+                results[name] = future.result()
+    return results
+
+def ensure_key_pair(setobj, kp_name):
+    """
+    Creates the key pair if it does not exist yet.
+
+    :param setobj: The AWS driver
+    :type setobj: AwsDriver
+
+    :param kp_name: The name of the key pair
+    :type kp_name: str
+    """
+    if setobj.verify_key_pair(kp_name) is False:
+        setobj.create_key_pair(kp_name)
+
+def scaling_parameters(args):
+    """
+    Gets the AutoScalingGroup template parameters set on the command line.
+
+    Arguments left unset are not passed, so the template defaults apply.
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :return: The template parameter values, keyed by parameter name
+    :rtype: dict
+    """
+    return {parameter: str(getattr(args, name)) for name, parameter in SCALING_PARAMETERS.items()
+            if getattr(args, name, None) is not None}
+
+def template_options(args):
+    """
+    Gets the render_template arguments set on the command line.
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :return: The arguments, keyed by name
+    :rtype: dict
+    """
+    return {'az_count': args.az_count or DEFAULT_AZ_COUNT, 'instance_type': args.instance_type,
+            'listener_port': args.listener_port, 'application_port': args.app_port}
+
+def stack_az_count(parameters):
+    """
+    Counts the Availability Zones a stack was rendered for.
+
+    :param parameters: Names of the stack's parameters
+    :type parameters: list
+
+    :return: The number of zones
+    :rtype: int
+    """
+    subnets = ZONE_PARAMETERS[0]
+    return sum(1 for zone in range(1, MAX_AZ_COUNT + 1) if subnets.format(zone) in parameters)
+
+def template_parameters(args):
+    """
+    Gets the template parameters set on the command line, through the
+    template options or the AutoScalingGroup arguments.
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :return: The template parameter values, keyed by parameter name
+    :rtype: dict
+    """
+    options = template_options(args)
+    parameters = {name: str(options[option]) for option, name in TEMPLATE_OPTION_PARAMETERS.items()
+                  if options[option] is not None}
+    parameters.update(scaling_parameters(args))
+    return parameters
+
+def get_driver(args):
+    """
+    Creates the AWS driver for the command line arguments.
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :return: The driver
+    :rtype: AwsDriver
+    """
+    return AwsDriver(access_key=args.id, secret_key=args.secret, region=args.region,
+                     s3_endpoint=args.s3_endpoint,
+                     client_settings={'max_pool_connections': args.max_pool_connections,
+                                      'connect_timeout': args.connect_timeout,
+                                      'read_timeout': args.read_timeout},
+                     cache=MetadataCache(args.cache_file, enabled=not args.no_cache),
+                     sessions=args.sessions)
+
 def setup(access_key, secret_key, kp_name, region, stack_name):
     # Initialize the AwsSetup class
     setobj = AwsDriver(access_key=access_key, secret_key=secret_key, region=region)
 
     # Create the bucket and upload the app files
     bucket = setobj.create_bucket(stack_name)
-    files = ['app.py', 'requirements.txt']
-    setobj.upload_files(files, bucket)
+    setobj.upload_files(DEFAULT_FILES, bucket)
 
     # Validate key pair and create if needed
     kp_exists = setobj.verify_key_pair(kp_name)
@@ -465,22 +2418,70 @@ def setup(access_key, secret_key, kp_name, region, stack_name):
     stack_id = setobj.create_cf_stack(kp_name, stack_name)
     setobj.wait_for_stack_completion(stack_id)
 
-def build(args):
-    # Initialize the AwsSetup class
-    setobj = AwsDriver(access_key=args.id, secret_key=args.secret, region=args.region)
+def bootstrap_phases(setobj, args):
+    """
+    Gets the phases preparing what the instances boot from: the artifact
+    and its bucket, or the image pushed to ECR.
 
-    # Create the bucket and upload the app files
-    bucket = setobj.create_bucket(args.name)
-    setobj.upload_files(DEFAULT_FILES, bucket)
+    :param setobj: The AWS driver
+    :type setobj: AwsDriver
 
-    # Validate key pair and create if needed
-    kp_exists = setobj.verify_key_pair(args.key_pair)
-    if kp_exists is False:
-            kp_material = setobj.create_key_pair(args.key_pair)
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
 
-    # Create CloudFormation stack
-    stack_id = setobj.create_cf_stack(args.key_pair, args.name)
-    url = setobj.wait_for_stack_completion(stack_id)
+    :return: The phases, the names of the phases whose results the template
+        parameters are made from, and the function making them
+    :rtype: tuple
+    """
+    if args.container:
+        bootstrap = [
+            ('build_image', build_image, []),
+            ('push_image', setobj.push_image, ['build_image']),
+        ]
+        # The artifact parameters are cleared, so a stack switching from the
+        # artifact does not keep its previous values
+        parameters = lambda image: {'ContainerImage': image, 'ArtifactBucket': '', 'ArtifactKey': ''}
+        return bootstrap, ['push_image'], parameters
+    bootstrap = [
+        ('create_bucket', lambda: setobj.create_bucket(args.name), []),
+        ('build_artifact', lambda: build_artifact(args.files, args.artifact_dir,
+            args.python_version, args.platform), []),
+        ('upload_artifact', lambda bucket, artifact: setobj.upload_files(artifact, bucket),
+            ['create_bucket', 'build_artifact']),
+    ]
+    # The instances prefer a non-empty image, so it is cleared for the artifact to be used
+    parameters = lambda bucket, artifact, uploaded: {
+        'ArtifactBucket': bucket, 'ArtifactKey': Path(artifact).as_posix(), 'ContainerImage': ''}
+    return bootstrap, ['create_bucket', 'build_artifact', 'upload_artifact'], parameters
+
+def build(args):
+    # Initialize the AwsSetup class
+    setobj = get_driver(args)
+
+    # The bucket and artifact (or image), key pair and template do not depend on
+    # each other, so they run at the same time. The stack is created once all are ready.
+    bootstrap, bootstrap_outputs, parameters = bootstrap_phases(setobj, args)
+    phases = bootstrap + [
+        ('key_pair', lambda: ensure_key_pair(setobj, args.key_pair), []),
+        ('get_latest_ami', setobj.get_latest_ami, []),
+        ('load_template', lambda ami_id: setobj.load_template(ami_id, **template_options(args)),
+            ['get_latest_ami']),
+    ]
+    requires = ['load_template', 'key_pair'] + bootstrap_outputs
+    # The template is checked locally as it is rendered, CloudFormation only validates it on request
+    if args.validate:
+        phases.append(('validate_template',
+            lambda template: setobj.validate_template(template, args.name), ['load_template']))
+        requires.append('validate_template')
+    phases.append(('create_cf_stack',
+        lambda template, key_pair, *outputs: setobj.create_cf_stack(
+            args.key_pair, args.name, template,
+            dict(parameters(*outputs[:len(bootstrap_outputs)]), **template_parameters(args))),
+        requires))
+
+    results = run_phases(phases, args.workers)
+    stack_id = results['create_cf_stack']
+    url = setobj.wait_for_stack_completion(stack_id, args.timeout)
     for i in range(30):
         try:
             response = test_api(url)
@@ -489,28 +2490,86 @@ def build(args):
             print("Waiting for servers to spin up..")
             sleep(10)
 
+def deploy(args):
+    setobj = get_driver(args)
+    cf_stack = setobj.get_cf_stack(args.name)
+    if not cf_stack:
+        print(f"Could not find the CloudFormation stack {args.name}, build it first. Exiting.")
+        exit(1)
+
+    # Only the changed parameters are sent, the rest keep their current values. A new
+    # artifact or image only replaces the launch configuration, which rolls the instances.
+    bootstrap, bootstrap_outputs, parameters = bootstrap_phases(setobj, args)
+    previous = [parameter['ParameterKey'] for parameter in cf_stack.get('Parameters', [])]
+    # The template is rendered for the zones the stack spans, rendering it for another
+    # number would add or delete whole zones of subnets, NAT gateways and instances
+    az_count = stack_az_count(previous)
+    if args.az_count is None:
+        args.az_count = az_count
+    elif args.az_count != az_count:
+        print(f"CloudFormation stack {args.name} spans {az_count} Availability Zones, " \
+            f"deploy does not change that to {args.az_count}. Exiting.")
+        exit(1)
+    results = run_phases(bootstrap + [
+        ('get_latest_ami', setobj.get_latest_ami, []),
+        ('load_template', lambda ami_id: setobj.load_template(ami_id, **template_options(args)),
+            ['get_latest_ami']),
+        ('create_change_set',
+            lambda template, *outputs: setobj.create_change_set(args.name, template,
+                dict(parameters(*outputs), **template_parameters(args)), previous),
+            ['load_template'] + bootstrap_outputs),
+    ], args.workers)
+
+    change_set = setobj.wait_for_change_set(results['create_change_set'], args.timeout)
+    if change_set is None:
+        print(f"CloudFormation stack {args.name} is up to date")
+        return
+    print_changes(change_set['Changes'])
+    if args.dry_run:
+        print(f"Left change set {change_set['ChangeSetName']} to review, not executing it")
+        return
+    stack_id = setobj.execute_change_set(change_set, args.name)
+    url = setobj.wait_for_stack_completion(stack_id, args.timeout, 'UPDATE_COMPLETE')
+    test_api(url)
+
+def refresh(args):
+    setobj = get_driver(args)
+    group_name = setobj.get_stack_resource(args.name, 'AutoScalingGroup')
+    if not group_name:
+        print(f"Could not find the AutoScalingGroup of the CloudFormation stack {args.name}. Exiting.")
+        exit(1)
+
+    refresh_id = setobj.start_instance_refresh(group_name, args.min_healthy, args.max_healthy,
+                                               args.instance_warmup)
+    instance_refresh = setobj.wait_for_instance_refresh(group_name, refresh_id, args.timeout)
+    if instance_refresh is None:
+        print(f"The instance refresh is taking too long, exiting.")
+        exit(1)
+    if instance_refresh['Status'] != 'Successful':
+        exit(1)
+
 def destroy(args):
     # Initialize the AwsSetup class
-    setobj = AwsDriver(access_key=args.id, secret_key=args.secret, region=args.region)
+    setobj = get_driver(args)
 
     # The bucket will not be deleted - if setup and teardown are run repeatedly, it would 
     # start throwing errors since AWS S3 name space is unique and deletion of buckets takes
     # time to propogate. 
 
-    # The files inside the bucket will be deleted
+    # The files inside the bucket will be deleted, with all of their versions
     bucket = setobj.get_bucket_name(args.name)
-    setobj.delete_files(DEFAULT_FILES, bucket)
+    setobj.delete_prefix(bucket, args.prefix)
 
     # The key pair will not be deleted - this is debatable and something easy to change.
     # The KMS and SSM parameters will also not be delted at this time.
 
     # Delete the CloudFormation stack
     setobj.delete_cf_stack(args.name)
-    setobj.wait_for_stack_deletion(args.name)
+    setobj.wait_for_stack_deletion(args.name, args.timeout)
 
 def info(args):
-    setobj = AwsDriver(access_key=args.id, secret_key=args.secret, region=args.region)
-    cf_stack = setobj.get_cf_stack(args.name)
+    setobj = get_driver(args)
+    cf_stack = setobj.get_cf_stack(args.name, cached=True)
     if cf_stack:
         pprint(cf_stack['Parameters'], indent=2)
         pprint(cf_stack['Outputs'], indent=2)
@@ -519,18 +2578,231 @@ def info(args):
         exit(1)
 
 def test(args):
-    setobj = AwsDriver(access_key=args.id, secret_key=args.secret, region=args.region)
-    cf_stack = setobj.get_cf_stack(args.name)
+    setobj = get_driver(args)
+    cf_stack = setobj.get_cf_stack(args.name, cached=True)
     if cf_stack:
         for output in cf_stack['Outputs']:
             if output['OutputKey'] == 'URL':
                 url = output['OutputValue']
-        response = test_api(url)
+        try:
+            response = test_api(url)
+        except requests.exceptions.RequestException:
+            # The cached URL may be out of date, look the stack up again next time
+            setobj.invalidate_stack(args.name)
+            raise
     else:
         print("Could not find the CloudFormation stack. Exiting.")
         exit(1)
 
-def main():
+def artifact(args):
+    return build_artifact(args.files, args.artifact_dir, args.python_version, args.platform)
+
+def container(args):
+    url = run_container(build_image(), args.port)
+    print(f"Benchmark it with: python3 go.py bench -u {url}")
+    return url
+
+def bench(args):
+    if args.url:
+        url = args.url
+    else:
+        setobj = get_driver(args)
+        cf_stack = setobj.get_cf_stack(args.name, cached=True)
+        if not cf_stack:
+            print("Could not find the CloudFormation stack. Exiting.")
+            exit(1)
+        for output in cf_stack['Outputs']:
+            if output['OutputKey'] == 'URL':
+                url = output['OutputValue']
+    results = run_benchmark(url, connections=args.connections,
+        duration=args.duration, total_requests=args.requests)
+    print_benchmark(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved benchmark results to {args.output}")
+    return results
+
+TARGET_OUTPUT = contextvars.ContextVar('target_output', default=None)
+
+
+class TargetOutput(object):
+    def __init__(self, stream):
+        """
+        Stands in for stdout while actions run against several targets,
+        sending what each target prints to its own buffer.
+
+        :param stream: Where output outside of a target goes
+        :type stream: file
+        """
+        self.stream = stream
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = TARGET_OUTPUT.get()
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    @contextmanager
+    def capture(self):
+        """
+        Sends the current thread's output, and that of the pools it starts,
+        to a new buffer.
+        """
+        buffer = io.StringIO()
+        token = TARGET_OUTPUT.set(buffer)
+        try:
+            yield buffer
+        finally:
+            TARGET_OUTPUT.reset(token)
+
+
+def load_manifest(path):
+    """
+    Loads the targets to run an action against from a manifest file.
+
+    The manifest is a JSON object with a list of targets, each with a
+    region, a stack name and optionally a key pair name:
+    {"targets": [{"region": "us-east-1", "name": "app"}, ...]}
+
+    :param path: The manifest file
+    :type path: str
+
+    :return: The targets
+    :rtype: list
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    targets = []
+    for target in manifest['targets']:
+        unknown = set(target) - {'region', 'name', 'key_pair'}
+        if unknown or 'region' not in target or 'name' not in target:
+            raise ValueError(f"Manifest targets need a region and a name, and may have " \
+                f"a key_pair, got {target}")
+        targets.append(dict(target))
+    return targets
+
+
+def get_targets(args):
+    """
+    Lists the regions and stacks to run an action against, from the manifest
+    or every combination of the regions and names passed in.
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :return: The targets, each a dict of the arguments to override
+    :rtype: list
+    """
+    if args.manifest:
+        return load_manifest(args.manifest)
+    return [{'region': region, 'name': name}
+            for region, name in itertools.product(args.region, args.name)]
+
+
+def run_target(func, args, target, output):
+    """
+    Runs an action against one target, capturing its output and exit status.
+
+    :param func: The action
+    :type func: function
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :param target: The arguments to override for this target
+    :type target: dict
+
+    :param output: The stdout stand-in
+    :type output: TargetOutput
+
+    :return: The target, its exit status, output and duration in seconds
+    :rtype: dict
+    """
+    target_args = argparse.Namespace(**{**vars(args), **target})
+    label = f"{target_args.region}/{target_args.name}"
+    start = perf_counter()
+    with output.capture() as buffer:
+        try:
+            with TRACER.span(f"{args.action} {label}", 'target'):
+                func(target_args)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc(file=buffer)
+            status = 1
+    return {'target': label, 'status': status, 'output': buffer.getvalue(),
+            'duration': perf_counter() - start}
+
+
+def fan_out(func, args, targets, max_workers=DEFAULT_TARGET_WORKERS):
+    """
+    Runs an action against several targets at once.
+
+    Each target's output is printed as one block when it finishes, followed
+    by a summary of all targets.
+
+    :param func: The action
+    :type func: function
+
+    :param args: The parsed command line arguments
+    :type args: argparse.Namespace
+
+    :param targets: The arguments to override for each target
+    :type targets: list
+
+    :param max_workers: Number of targets to run at once
+    :type max_workers: int
+
+    :return: 0 if the action succeeded for every target, 1 otherwise
+    :rtype: int
+    """
+    stdout = sys.stdout
+    output = TargetOutput(stdout)
+    sys.stdout = output
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(run_target, func, args, target, output)
+                       for target in targets]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                with output.lock:
+                    stdout.write(f"=== {args.action} {result['target']} ===\n")
+                    stdout.write(result['output'])
+    finally:
+        sys.stdout = stdout
+
+    print(f"{'target':<45} {'status':>8} {'seconds':>9}")
+    for result in sorted(results, key=lambda result: result['target']):
+        status = 'ok' if result['status'] == 0 else f"exit {result['status']}"
+        print(f"{result['target']:<45} {status:>8} {result['duration']:>9.1f}")
+    failed = sum(1 for result in results if result['status'] != 0)
+    print(f"{len(results) - failed} of {len(results)} targets succeeded")
+    return 1 if failed else 0
+
+
+def comma_list(value):
+    """
+    Splits a command line value on commas.
+
+    :param value: The value passed in
+    :type value: str
+
+    :return: The non-empty items
+    :rtype: list
+    """
+    return [item for item in value.split(',') if item]
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
 
     parser.add_argument("action", choices=ALLOWED_ACTIONS, 
@@ -539,23 +2811,139 @@ def main():
     parser.add_argument('-s', '--secret', required=False, help='AWS Secret Access Key')
     parser.add_argument('-k', '--key_pair', default=DEFAULT_KEY_PAIR, 
                         help='Name of AWS Key Pair to use for EC2 Instance to allow SSH login')
-    parser.add_argument('-r', '--region', default=DEFAULT_REGION, help='AWS Region ID')
-    parser.add_argument('-n', '--name', default=DEFAULT_NAME,
-                        help='The name to use for the CloudFormation stack')
-
-    args = parser.parse_args()
-    # Strips spaces from the name passed in, since AWS name space does not allow spaces
-    (args.name).replace(" ", "")
-    (args.key_pair).replace(" ", "")
-
-    if args.action == 'build':
-        build(args)
-    elif args.action == 'destroy':
-        destroy(args)
-    elif args.action == 'info':
-        info(args)
-    elif args.action == 'test':
-        test(args)
+    # Repeated or comma separated rather than nargs='+', which would take the action too
+    parser.add_argument('-r', '--region', action='append', type=comma_list, default=None,
+                        help='AWS Region ID(s), repeated or separated by commas')
+    parser.add_argument('-n', '--name', action='append', type=comma_list, default=None,
+                        help='The name(s) to use for the CloudFormation stack, repeated or '
+                             'separated by commas')
+    parser.add_argument('-m', '--manifest', default=None,
+                        help='JSON file listing the regions and stacks to act on')
+    parser.add_argument('-p', '--parallel', type=int, default=DEFAULT_TARGET_WORKERS,
+                        help='Number of regions and stacks to act on at once')
+    parser.add_argument('-f', '--files', nargs='+', default=DEFAULT_FILES,
+                        help='Application files and directories to bundle in the artifact')
+    parser.add_argument('--artifact-dir', default=ARTIFACT_DIR,
+                        help='Directory to build the application artifact in')
+    parser.add_argument('--python-version', default=ARTIFACT_PYTHON_VERSION,
+                        help='Python version to install the artifact dependencies for')
+    parser.add_argument('--platform', default=ARTIFACT_PLATFORM,
+                        help='Platform to install the artifact dependencies for')
+    parser.add_argument('--container', action='store_true',
+                        help='Run the application image on the instances, pushed to ECR on build')
+    parser.add_argument('--port', type=int, default=DEFAULT_CONTAINER_PORT,
+                        help='Local port to run the application image on')
+    # Unset on deploy keeps the stack's zones
+    parser.add_argument('--az-count', type=int, default=None,
+                        choices=range(2, MAX_AZ_COUNT + 1), metavar=f'{{2..{MAX_AZ_COUNT}}}',
+                        help='Number of Availability Zones to spread the stack across')
+    parser.add_argument('--instance-type', default=None,
+                        help='EC2 instance type to run the application on, t2.micro by default')
+    parser.add_argument('--listener-port', type=int, default=None,
+                        help='Port the load balancer accepts requests on, 80 by default')
+    parser.add_argument('--app-port', type=int, default=None,
+                        help='Port the application listens on, on the instances, 80 by default')
+    parser.add_argument('--validate', action='store_true',
+                        help='Also validate the template with CloudFormation before building')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Show the changes deploy would make, without making them')
+    parser.add_argument('--min-size', type=int, default=None,
+                        help='Fewest instances to scale in to, 2 by default')
+    parser.add_argument('--max-size', type=int, default=None,
+                        help='Most instances to scale out to, 6 by default')
+    parser.add_argument('--desired-capacity', type=int, default=None,
+                        help='Instances to start with, the minimum by default')
+    parser.add_argument('--target-requests', type=int, default=None,
+                        help='Requests per instance per minute to scale to, 3000 by default')
+    parser.add_argument('--target-cpu', type=int, default=None,
+                        help='Average CPU utilization percentage to scale to, 60 by default')
+    parser.add_argument('--instance-warmup', type=int, default=None,
+                        help='Seconds before a new instance counts towards scaling, 120 by default')
+    parser.add_argument('--warm-pool-size', type=int, default=None,
+                        help='Stopped, bootstrapped instances to keep ready to scale out to, 0 by default')
+    parser.add_argument('--min-healthy', type=int, default=DEFAULT_MIN_HEALTHY,
+                        help='Percentage of the instances refresh keeps in service')
+    parser.add_argument('--max-healthy', type=int, default=DEFAULT_MAX_HEALTHY,
+                        help='Percentage of the instances that may be in service during a refresh, '
+                             'above 100 to launch replacements first')
+    parser.add_argument('--prefix', default='',
+                        help='Only delete bucket objects under this prefix on destroy')
+    parser.add_argument('--s3-endpoint', default=None,
+                        help='Alternative S3 endpoint URL, e.g. a local S3 stand-in')
+    parser.add_argument('--max-pool-connections', type=int, default=DEFAULT_MAX_POOL_CONNECTIONS,
+                        help='Connections each AWS client keeps open at most')
+    parser.add_argument('--connect-timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                        help='Seconds to wait for a connection to AWS')
+    parser.add_argument('--read-timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='Seconds to wait for a response from AWS')
+    parser.add_argument('--cache-file', default=DEFAULT_CACHE_FILE,
+                        help='File caching the account id, AMI and stack lookups between runs')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Look everything up again, without reading or writing the cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Empty the cache before running the action')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_PHASE_WORKERS,
+                        help='Number of independent build phases to run at once')
+    parser.add_argument('-t', '--timeout', type=float, default=DEFAULT_STACK_TIMEOUT,
+                        help='Seconds to wait for the CloudFormation stack to finish')
+    parser.add_argument('-u', '--url', default=None,
+                        help='URL to benchmark instead of the stack URL, e.g. a local app.py')
+    parser.add_argument('-c', '--connections', type=int, default=DEFAULT_BENCH_CONNECTIONS,
+                        help='Number of concurrent connections to benchmark with')
+    parser.add_argument('-d', '--duration', type=float, default=DEFAULT_BENCH_DURATION,
+                        help='Seconds to run the benchmark for')
+    parser.add_argument('--requests', type=int, default=None,
+                        help='Number of requests to benchmark with, instead of a duration')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to write the benchmark results to as JSON')
+    parser.add_argument('--trace', action='store_true',
+                        help='Print how long each phase and AWS API call took')
+    parser.add_argument('--trace-file', default=None,
+                        help='File to write a Chrome trace of the phases and API calls to')
+
+    args = parser.parse_args(argv)
+    args.region = list(itertools.chain.from_iterable(args.region or [[DEFAULT_REGION]]))
+    args.name = list(itertools.chain.from_iterable(args.name or [[DEFAULT_NAME]]))
+    # Strips spaces from the names passed in, since AWS name space does not allow spaces
+    args.name = [name.replace(" ", "") for name in args.name]
+    args.key_pair = args.key_pair.replace(" ", "")
+
+    sizes = [size for size in (args.min_size, args.desired_capacity, args.max_size)
+             if size is not None]
+    if sizes != sorted(sizes):
+        parser.error("the sizes must satisfy --min-size <= --desired-capacity <= --max-size")
+    if not 0 <= args.min_healthy <= 100 <= args.max_healthy <= min(args.min_healthy + 100, 200):
+        parser.error("the percentages must satisfy 0 <= --min-healthy <= 100 <= --max-healthy "
+                     "<= 200, at most 100 apart")
+
+    if args.clear_cache:
+        MetadataCache(args.cache_file).invalidate()
+
+    actions = {'build': build, 'deploy': deploy, 'refresh': refresh, 'destroy': destroy, 'info': info, 'test': test, 'bench': bench,
+               'artifact': artifact, 'container': container}
+    targets = get_targets(args)
+    # Every target's driver shares the session of its credentials
+    args.sessions = SessionPool()
+    if len(targets) > 1 and args.action not in FAN_OUT_ACTIONS:
+        parser.error(f"{args.action} runs against a single region and stack")
+
+    status = 0
+    try:
+        with TRACER.span(args.action, 'action'):
+            if len(targets) == 1:
+                for key, value in targets[0].items():
+                    setattr(args, key, value)
+                actions[args.action](args)
+            else:
+                status = fan_out(actions[args.action], args, targets, args.parallel)
+    finally:
+        # Report even when the action failed and exited early
+        if args.trace:
+            TRACER.print_summary()
+        if args.trace_file:
+            TRACER.save(args.trace_file)
+    if status:
+        exit(status)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,137 @@
+"""
+Gunicorn settings for serving app.py in production.
+
+Every value can be overridden with an environment variable so the same
+file is used by the Dockerfile and the EC2 bootstrap (see app.service).
+The application itself is chosen here too, so start Gunicorn without an
+application argument: `gunicorn -c gunicorn_conf.py`.
+"""
+import os
+import shutil
+import logging
+import tempfile
+from multiprocessing import cpu_count
+
+from gunicorn.glogging import Logger
+
+from metrics import archive_metrics
+
+# The ALB keeps idle connections open for 60 seconds by default. The
+# application must hold them longer than that, otherwise the ALB may reuse
+# a connection the server has just closed and return a 502 to the client.
+ALB_IDLE_TIMEOUT = 60
+
+# Load balancer health checks are not written to the access log. This must
+# match message.HEALTH_CHECK_PATH.
+HEALTH_CHECK_PATH = '/healthz'
+
+
+def env_int(name, default):
+    """
+    Reads an integer setting from the environment.
+
+    :param name: The environment variable name
+    :type name: str
+
+    :param default: The value to use when the variable is unset or empty
+    :type default: int
+
+    :return: The configured value
+    :rtype: int
+    """
+    value = os.environ.get(name)
+    if value in (None, ''):
+        return default
+    return int(value)
+
+
+# The metrics directory created for the workers, removed again on exit
+created_metrics_dir = None
+
+
+def on_starting(server):
+    """
+    Gives the workers a fresh directory to share their metrics through,
+    unless APP_METRICS_DIR names one. Workers inherit the environment.
+    """
+    global created_metrics_dir
+    if not os.environ.get('APP_METRICS_DIR'):
+        created_metrics_dir = tempfile.mkdtemp(prefix='app-metrics-')
+        os.environ['APP_METRICS_DIR'] = created_metrics_dir
+
+
+def child_exit(server, worker):
+    """
+    Merges an exited worker's metrics into the archive, so the directory
+    does not grow as workers are recycled.
+    """
+    directory = os.environ.get('APP_METRICS_DIR')
+    if directory:
+        archive_metrics(directory, worker.pid)
+
+
+def on_exit(server):
+    """
+    Removes the metrics directory created in on_starting.
+    """
+    if created_metrics_dir:
+        shutil.rmtree(created_metrics_dir, ignore_errors=True)
+
+
+class AccessLogger(Logger):
+    """
+    Gunicorn logger that leaves health checks out of the access log.
+    """
+    def access(self, resp, req, environ, request_time):
+        if environ.get('PATH_INFO') == HEALTH_CHECK_PATH:
+            return
+        super(AccessLogger, self).access(resp, req, environ, request_time)
+
+
+class HealthCheckFilter(logging.Filter):
+    """
+    Drops Uvicorn access log records for health checks.
+    """
+    def filter(self, record):
+        # uvicorn.access records: (client, method, path, http version, status)
+        args = record.args
+        return not (isinstance(args, tuple) and len(args) > 2 and
+            args[2] == HEALTH_CHECK_PATH)
+
+
+# The application to serve, picked by APP_SERVER_MODE
+SERVER_MODES = {
+    # Flask app on threaded workers: each process serves `threads` requests
+    # at once, so a t2.micro gets real concurrency without many interpreters.
+    'sync': ('app:app', 'gthread'),
+    # ASGI app on event loop workers, for very many concurrent connections
+    'async': ('async_app:create_app()', 'uvicorn.workers.UvicornWorker'),
+}
+
+server_mode = os.environ.get('APP_SERVER_MODE', 'sync')
+if server_mode not in SERVER_MODES:
+    raise ValueError(f"APP_SERVER_MODE must be one of {sorted(SERVER_MODES)}, "
+        f"got {server_mode!r}")
+wsgi_app, worker_class = SERVER_MODES[server_mode]
+
+bind = os.environ.get('APP_BIND', '0.0.0.0:80')
+
+workers = env_int('APP_WORKERS', cpu_count() * 2 + 1)
+threads = env_int('APP_THREADS', 4)
+
+keepalive = env_int('APP_KEEPALIVE', ALB_IDLE_TIMEOUT + 5)
+timeout = env_int('APP_TIMEOUT', 30)
+
+# On SIGTERM workers stop accepting new connections and get this long to
+# finish in-flight requests before they are killed.
+graceful_timeout = env_int('APP_GRACEFUL_TIMEOUT', 30)
+
+# Recycle workers periodically, with jitter so they do not restart together
+max_requests = env_int('APP_MAX_REQUESTS', 0)
+max_requests_jitter = env_int('APP_MAX_REQUESTS_JITTER', max_requests // 10)
+
+accesslog = os.environ.get('APP_ACCESS_LOG', '-') or None
+logger_class = AccessLogger
+logging.getLogger('uvicorn.access').addFilter(HealthCheckFilter())
+errorlog = '-'
+loglevel = os.environ.get('APP_LOG_LEVEL', 'info')
@@ -0,0 +1,280 @@
+"""
+The /message contract shared by app.py and async_app.py.
+
+Renders the message, its caching headers and conditional responses, and
+holds the process's metrics. Kept free of Flask, so the asyncio variant
+does not load it.
+"""
+import os
+import json
+import threading
+from collections import namedtuple
+from decimal import Decimal
+from email.utils import formatdate
+from functools import lru_cache
+from time import time
+from metrics import Metrics
+
+MESSAGE = 'Automation for the People'
+MESSAGE_PATH = '/message'
+MESSAGE_MIMETYPE = 'application/json'
+HEALTH_CHECK_PATH = '/healthz'
+HEALTH_CHECK_BODY = b'ok\n'
+METRICS_PATH = '/metrics'
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Set APP_JSON_ENCODER=orjson to encode timestamps with orjson, if installed
+JSON_ENCODER = os.environ.get('APP_JSON_ENCODER', 'json')
+# Seconds between timestamp refreshes, e.g. 0.001 or 0.01. 0 is exact.
+TIMESTAMP_RESOLUTION = float(os.environ.get('APP_TIMESTAMP_RESOLUTION', 0))
+# Cache-Control policy. By default caches must revalidate every time (no-cache), since the
+# timestamp changes more often than the one second max-age can express.
+CACHE_MAX_AGE = int(os.environ.get('APP_CACHE_MAX_AGE', 0))
+CACHE_STALE_WHILE_REVALIDATE = int(os.environ.get('APP_CACHE_STALE_WHILE_REVALIDATE', 0))
+# Directory the worker processes share their metrics through, each writing its own file.
+# Unset keeps the metrics in memory, covering the current process only.
+METRICS_DIR = os.environ.get('APP_METRICS_DIR') or None
+# Requests are counted by path, other paths together
+METRIC_PATHS = (MESSAGE_PATH, HEALTH_CHECK_PATH, METRICS_PATH)
+
+def split_body(**dumps_kwargs):
+    """
+    Pre-encodes the constant parts of the message body.
+
+    The body is rendered the way Flask's jsonify does, with a placeholder
+    for the timestamp, and split around it. Only the timestamp then has to
+    be encoded per request.
+
+    :return: The encoded text before and after the timestamp
+    :rtype: tuple
+    """
+    body = json.dumps({'message': MESSAGE, 'timestamp': None},
+        sort_keys=True, **dumps_kwargs) + '\n'
+    prefix, _, suffix = body.rpartition('null')
+    return prefix.encode('utf-8'), suffix.encode('utf-8')
+
+# jsonify pretty prints unless the request comes from XMLHttpRequest
+PRETTY_BODY = split_body(indent=2, separators=(', ', ': '))
+COMPACT_BODY = split_body(separators=(',', ':'))
+
+def repr_timestamp(timestamp):
+    return repr(timestamp).encode('ascii')
+
+if JSON_ENCODER == 'orjson':
+    from orjson import dumps as encode_timestamp
+elif JSON_ENCODER == 'json':
+    encode_timestamp = repr_timestamp
+else:
+    raise ValueError(f"APP_JSON_ENCODER must be 'json' or 'orjson', got {JSON_ENCODER!r}")
+
+def render_message(timestamp, compact=False):
+    """
+    Renders the message body for a timestamp.
+
+    :param timestamp: The timestamp to include in the message
+    :type timestamp: float
+
+    :param compact: Whether to render without indentation
+    :type compact: bool
+
+    :return: The encoded response body, identical to jsonify's output
+    :rtype: bytes
+    """
+    prefix, suffix = COMPACT_BODY if compact else PRETTY_BODY
+    return prefix + encode_timestamp(timestamp) + suffix
+
+def cache_control(max_age, stale_while_revalidate):
+    """
+    Builds the Cache-Control header value for the message.
+
+    :param max_age: Seconds a cache may serve the message without revalidating
+    :type max_age: int
+
+    :param stale_while_revalidate: Seconds a stale message may be served
+        while the cache revalidates it in the background
+    :type stale_while_revalidate: int
+
+    :return: The header value
+    :rtype: str
+    """
+    if max_age <= 0 and stale_while_revalidate <= 0:
+        # Caches may store the message but must revalidate it every time
+        return 'no-cache'
+    value = f'public, max-age={max(max_age, 0)}'
+    if stale_while_revalidate > 0:
+        value += f', stale-while-revalidate={stale_while_revalidate}'
+    return value
+
+CACHE_CONTROL = cache_control(CACHE_MAX_AGE, CACHE_STALE_WHILE_REVALIDATE)
+
+def make_etags(encoded_timestamp):
+    """
+    Builds the entity tags for the pretty and compact bodies of a timestamp.
+
+    :param encoded_timestamp: The timestamp as encoded in the body
+    :type encoded_timestamp: bytes
+
+    :return: The pretty and compact entity tags
+    :rtype: tuple
+    """
+    tag = encoded_timestamp.decode('ascii')
+    return f'"{tag}"', f'"{tag}-c"'
+
+@lru_cache(maxsize=4)
+def http_date(seconds):
+    return formatdate(seconds, usegmt=True)
+
+def etag_matches(if_none_match, etag):
+    """
+    Checks an If-None-Match header against an entity tag, using weak comparison.
+
+    :param if_none_match: The If-None-Match header value
+    :type if_none_match: str
+
+    :param etag: The current entity tag
+    :type etag: str
+
+    :return: Whether the client's copy is current
+    :rtype: bool
+    """
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+Snapshot = namedtuple('Snapshot', ['timestamp', 'bodies', 'etags', 'last_modified'])
+
+def take_snapshot(timestamp):
+    """
+    Renders everything needed to answer /message for a timestamp.
+
+    The bodies and entity tags are pairs indexed by the `compact` flag.
+
+    :param timestamp: The timestamp to include in the message
+    :type timestamp: float
+
+    :return: The timestamp, its rendered bodies, entity tags and HTTP date
+    :rtype: Snapshot
+    """
+    return Snapshot(timestamp, (render_message(timestamp), render_message(timestamp, True)),
+        make_etags(encode_timestamp(timestamp)), http_date(int(timestamp)))
+
+class ClockTicker(object):
+    def __init__(self, resolution):
+        """
+        Keeps a shared, pre-rendered timestamp snapshot up to date.
+
+        A background thread refreshes the snapshot once per resolution
+        interval, so request handlers only read an attribute. Timestamps
+        are truncated to the resolution, which keeps them identical across
+        worker processes.
+
+        :param resolution: Seconds between refreshes
+        :type resolution: float
+        """
+        if resolution <= 0:
+            raise ValueError("The timestamp resolution must be positive")
+        self.resolution = resolution
+        self.digits = max(0, -Decimal(str(resolution)).as_tuple().exponent)
+        self.snapshot = None
+        self.pid = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def tick(self):
+        """
+        Refreshes the snapshot from the current time.
+        """
+        now = time()
+        timestamp = round(now - now % self.resolution, self.digits)
+        if self.snapshot is None or self.snapshot.timestamp != timestamp:
+            self.snapshot = take_snapshot(timestamp)
+
+    def run(self):
+        """
+        Refreshes the snapshot at every resolution boundary, until stopped.
+        """
+        while not self.stopped.is_set():
+            self.tick()
+            self.stopped.wait(self.resolution - time() % self.resolution)
+
+    def start(self):
+        """
+        Starts the refresh thread for the current process.
+
+        Threads do not survive a fork, so this runs again in every worker.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.tick()
+            self.thread = threading.Thread(target=self.run, name='clock-ticker', daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        """
+        Stops the refresh thread and waits for it to exit. The snapshot is
+        no longer refreshed afterwards.
+        """
+        self.stopped.set()
+        if self.thread is not None and self.pid == os.getpid():
+            self.thread.join()
+
+    def current(self):
+        """
+        Gets the latest snapshot, starting the refresh thread if needed.
+
+        :return: The latest timestamp snapshot
+        :rtype: Snapshot
+        """
+        if self.pid != os.getpid():
+            self.start()
+        return self.snapshot
+
+ticker = ClockTicker(TIMESTAMP_RESOLUTION) if TIMESTAMP_RESOLUTION > 0 else None
+
+metrics = Metrics(METRICS_DIR, METRIC_PATHS)
+
+def message_response(compact=False, if_none_match=None):
+    """
+    Builds the /message response for the current time, at the configured
+    resolution. Conditional requests are answered before any body is built.
+
+    :param compact: Whether to render without indentation
+    :type compact: bool
+
+    :param if_none_match: The request's If-None-Match header, if any
+    :type if_none_match: str
+
+    :return: The status code, body and headers
+    :rtype: tuple
+    """
+    if ticker is None:
+        timestamp = time()
+        encoded = encode_timestamp(timestamp)
+        etag = make_etags(encoded)[compact]
+        snapshot = None
+    else:
+        snapshot = ticker.current()
+        etag = snapshot.etags[compact]
+
+    # Werkzeug drops Last-Modified from a 304, so it is left out for every server
+    headers = [('Cache-Control', CACHE_CONTROL), ('ETag', etag), ('Vary', 'X-Requested-With')]
+    if if_none_match and etag_matches(if_none_match, etag):
+        return 304, b'', headers
+    if snapshot is None:
+        prefix, suffix = COMPACT_BODY if compact else PRETTY_BODY
+        body = prefix + encoded + suffix
+        last_modified = http_date(int(timestamp))
+    else:
+        body = snapshot.bodies[compact]
+        last_modified = snapshot.last_modified
+    headers.insert(2, ('Last-Modified', last_modified))
+    return 200, body, headers
@@ -0,0 +1,303 @@
+"""
+Request metrics shared by the worker processes of app.py and async_app.py.
+
+Each process counts into a memory mapped file of its own in a shared
+directory, so recording a request never waits on another process. A
+scrape adds up the files of every process. Kept free of Flask, so the
+Gunicorn arbiter can archive the files of exited workers (see
+gunicorn_conf.py).
+"""
+import os
+import mmap
+import fcntl
+import weakref
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+# Label of the requests to paths that are not counted on their own
+OTHER_PATH = 'other'
+# Totals of the exited processes, merged into one file
+ARCHIVE_NAME = 'metrics-archive.db'
+
+
+def worker_file(directory, pid):
+    return os.path.join(directory, f'metrics-{pid}.db')
+
+
+def file_in_use(fd):
+    """
+    Tells whether a live process holds the lock on a metrics file. The
+    lock is released when its process exits, even before it is reaped.
+
+    :param fd: A file descriptor of the file
+    :type fd: int
+
+    :return: Whether the file is in use
+    :rtype: bool
+    """
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    return False
+
+
+@contextmanager
+def locked_archive(directory, operation):
+    """
+    Opens the archive, locked for reading or for merging into it. Readers
+    hold the lock while reading the worker files too, so a file being
+    merged is never counted twice.
+
+    :param directory: The metrics directory
+    :type directory: str
+
+    :param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+    :type operation: int
+    """
+    fd = os.open(os.path.join(directory, ARCHIVE_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.lockf(fd, operation)
+        yield fd
+    finally:
+        # Closing the descriptor releases the lock
+        os.close(fd)
+
+
+def archive_metrics(directory, pid):
+    """
+    Merges the file of an exited process into the archive and removes it,
+    so the directory does not grow as workers are replaced. Files still
+    in use, e.g. after the pid has been reused, are left alone.
+
+    :param directory: The metrics directory
+    :type directory: str
+
+    :param pid: The process id of the exited process
+    :type pid: int
+    """
+    path = worker_file(directory, pid)
+    with locked_archive(directory, fcntl.LOCK_EX) as archive:
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            if file_in_use(f.fileno()):
+                return
+            data = f.read()
+        if data and len(data) % 8 == 0:
+            totals = memoryview(bytearray(data)).cast('d')
+            archived = os.pread(archive, len(data) + 1, 0)
+            if len(archived) == len(data):
+                for i, value in enumerate(memoryview(archived).cast('d')):
+                    totals[i] += value
+            # Nothing is in flight in an exited process
+            totals[0] = 0
+            os.pwrite(archive, totals.tobytes(), 0)
+            os.ftruncate(archive, len(data))
+        os.unlink(path)
+
+
+class Metrics(object):
+    def __init__(self, directory=None, paths=()):
+        """
+        Counts requests and their latencies in fixed slots, cheap enough to
+        record around every request.
+
+        The slots are doubles in a memory mapped file of the directory, one
+        file per process, locked for as long as the process lives. A lock
+        guards updates from the process's threads. Files of exited processes
+        keep counting towards the totals, but not towards the requests in
+        flight, until they are merged into the archive.
+
+        :param directory: The directory shared by the worker processes, or
+            None to keep the metrics of this process in memory
+        :type directory: str
+
+        :param paths: The request paths counted on their own, requests to
+            any other path are counted together
+        :type paths: tuple
+        """
+        self.directory = directory
+        self.labels = tuple(paths) + (OTHER_PATH,)
+        self.paths = {path: i for i, path in enumerate(paths)}
+        # Per path: a count per status class, a count per bucket and +Inf, and the sum
+        self.stride = len(STATUS_CLASSES) + len(LATENCY_BUCKETS) + 2
+        # The first slot counts the requests in flight
+        self.size = 1 + len(self.labels) * self.stride
+        self.fd = None
+        self.open()
+        METRICS_INSTANCES.add(self)
+
+    def open(self):
+        """
+        Starts this process's metrics from zero, e.g. in a forked worker.
+        """
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        if self.fd is not None:
+            # Inherited from the parent, whose lock is not
+            os.close(self.fd)
+            self.fd = None
+        if not self.directory:
+            self.buffer = bytearray(self.size * 8)
+            self.values = memoryview(self.buffer).cast('d')
+            return
+
+        # A file left by an earlier process with the same pid keeps its counts
+        archive_metrics(self.directory, self.pid)
+        # Locked before it appears under its name, so it is never taken for a dead file
+        path = worker_file(self.directory, self.pid)
+        fd = os.open(path + '.new', os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.size * 8)
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            self.buffer = mmap.mmap(fd, self.size * 8)
+            os.rename(path + '.new', path)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        self.values = memoryview(self.buffer).cast('d')
+
+    def close(self):
+        """
+        Releases this process's file, leaving it to be archived.
+        """
+        if self.fd is not None:
+            self.values.release()
+            self.buffer.close()
+            os.close(self.fd)
+            self.fd = None
+
+    def begin(self):
+        """
+        Records the start of a request.
+
+        :return: The start time, to pass to end
+        :rtype: float
+        """
+        with self.lock:
+            self.values[0] += 1
+        return perf_counter()
+
+    def end(self, path, status, start):
+        """
+        Records the end of a request.
+
+        :param path: The request path
+        :type path: str
+
+        :param status: The response status code
+        :type status: int
+
+        :param start: The start time returned by begin
+        :type start: float
+        """
+        seconds = perf_counter() - start
+        offset = 1 + self.paths.get(path, len(self.labels) - 1) * self.stride
+        status_class = status // 100 - 1
+        if not 0 <= status_class < len(STATUS_CLASSES):
+            status_class = len(STATUS_CLASSES) - 1
+        bucket = offset + len(STATUS_CLASSES) + bisect_left(LATENCY_BUCKETS, seconds)
+        values = self.values
+        with self.lock:
+            values[0] -= 1
+            values[offset + status_class] += 1
+            values[bucket] += 1
+            values[offset + self.stride - 1] += seconds
+
+    def collect(self):
+        """
+        Adds up the metrics of every process sharing the directory.
+
+        :return: The summed slots
+        :rtype: list
+        """
+        with self.lock:
+            totals = self.values.tolist()
+        if not self.directory:
+            return totals
+
+        with locked_archive(self.directory, fcntl.LOCK_SH) as archive:
+            data = os.pread(archive, self.size * 8 + 1, 0)
+            if len(data) == self.size * 8:
+                for i, value in enumerate(memoryview(data).cast('d')):
+                    totals[i] += value
+            for name in os.listdir(self.directory):
+                pid = name[len('metrics-'):-len('.db')]
+                if not (name.startswith('metrics-') and name.endswith('.db') and pid.isdigit()) \
+                        or int(pid) == self.pid:
+                    continue
+                try:
+                    with open(os.path.join(self.directory, name), 'rb') as f:
+                        data = f.read()
+                        in_use = file_in_use(f.fileno())
+                except OSError:
+                    continue
+                if len(data) != self.size * 8:
+                    continue
+                values = memoryview(data).cast('d')
+                if in_use:
+                    totals[0] += values[0]
+                for i in range(1, self.size):
+                    totals[i] += values[i]
+        return totals
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text format.
+
+        :return: The exposition
+        :rtype: str
+        """
+        values = self.collect()
+        lines = [
+            '# HELP http_requests_in_flight Requests being answered.',
+            '# TYPE http_requests_in_flight gauge',
+            f'http_requests_in_flight {values[0]:.0f}',
+            '# HELP http_requests_total Requests answered, by path and status class.',
+            '# TYPE http_requests_total counter',
+        ]
+        for i, path in enumerate(self.labels):
+            offset = 1 + i * self.stride
+            for j, status_class in enumerate(STATUS_CLASSES):
+                lines.append(f'http_requests_total{{path="{path}",status="{status_class}"}} '
+                    f'{values[offset + j]:.0f}')
+        lines += [
+            '# HELP http_request_duration_seconds Time taken to answer requests, by path.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for i, path in enumerate(self.labels):
+            offset = 1 + i * self.stride + len(STATUS_CLASSES)
+            count = 0
+            for j, bound in enumerate(LATENCY_BUCKETS + ('+Inf',)):
+                count += values[offset + j]
+                lines.append(f'http_request_duration_seconds_bucket{{path="{path}",le="{bound}"}} '
+                    f'{count:.0f}')
+            lines.append(f'http_request_duration_seconds_sum{{path="{path}"}} '
+                f'{values[offset + len(LATENCY_BUCKETS) + 1]!r}')
+            lines.append(f'http_request_duration_seconds_count{{path="{path}"}} {count:.0f}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS_INSTANCES = weakref.WeakSet()
+
+
+def reopen_metrics():
+    # A forked process must not write to its parent's file
+    for instance in list(METRICS_INSTANCES):
+        try:
+            instance.open()
+        except OSError:
+            instance.directory = None
+            instance.open()
+
+
+os.register_at_fork(after_in_child=reopen_metrics)
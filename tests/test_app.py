@@ -6,18 +6,222 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
-from unittest import TestCase, mock, main
-from time import time
+from unittest import TestCase, mock, main, skipUnless
+from flask import jsonify
+from time import time, sleep
 import app
+import message
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def jsonify_body(timestamp, headers=None):
+    """
+    Renders the payload the way Message.get did before the fast path.
+    """
+    with app.app.test_request_context(message.MESSAGE_PATH, headers=headers):
+        return jsonify({'message':'Automation for the People', 'timestamp': timestamp}).get_data()
 
 class test_message(TestCase):
-    @mock.patch('app.jsonify')
-    def test_get(self, mock_jsonify):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    @mock.patch('message.time')
+    def test_get(self, mock_time):
+        timestamp = time()
+        mock_time.return_value = timestamp
+        response = self.client.get('/message')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/json')
+        self.assertEqual(response.get_data(), jsonify_body(timestamp))
+        self.assertEqual(response.headers['Content-Length'], str(len(response.get_data())))
+
+    @mock.patch('message.time')
+    def test_get_xhr(self, mock_time):
         timestamp = time()
-        mock_jsonify.return_value = {'message':'Automation for the People', 'timestamp': timestamp}
-        message = app.Message()
-        response = message.get()
-        self.assertEqual(response, {'message':'Automation for the People', 'timestamp': timestamp})
+        mock_time.return_value = timestamp
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        response = self.client.get('/message', headers=headers)
+
+        self.assertEqual(response.get_data(), jsonify_body(timestamp, headers))
+
+    def test_render_message(self):
+        for timestamp in [0.0, 1.5, 1500000000.123456, time()]:
+            self.assertEqual(message.render_message(timestamp), jsonify_body(timestamp))
+            self.assertEqual(message.render_message(timestamp, compact=True),
+                jsonify_body(timestamp, {'X-Requested-With': 'XMLHttpRequest'}))
+
+    @skipUnless(orjson, 'orjson is not installed')
+    def test_orjson_timestamp(self):
+        for timestamp in [0.0, 1.5, 1500000000.123456, time()]:
+            self.assertEqual(orjson.dumps(timestamp), message.repr_timestamp(timestamp))
+
+class test_healthz(TestCase):
+    @mock.patch('message.message_response')
+    def test_healthz(self, mock_message_response):
+        response = app.app.test_client().get('/healthz')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), b'ok\n')
+        self.assertFalse(mock_message_response.called)
+
+class test_http_caching(TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+
+    def test_cache_control(self):
+        self.assertEqual(message.cache_control(0, 0), 'no-cache')
+        self.assertEqual(message.cache_control(1, 0), 'public, max-age=1')
+        self.assertEqual(message.cache_control(0, 30), 'public, max-age=0, stale-while-revalidate=30')
+        self.assertEqual(message.cache_control(5, 30), 'public, max-age=5, stale-while-revalidate=30')
+
+    def test_etag_matches(self):
+        self.assertTrue(message.etag_matches('"1.5"', '"1.5"'))
+        self.assertTrue(message.etag_matches('W/"1.5"', '"1.5"'))
+        self.assertTrue(message.etag_matches('"1.4", "1.5"', '"1.5"'))
+        self.assertTrue(message.etag_matches('*', '"1.5"'))
+        self.assertFalse(message.etag_matches('"1.4"', '"1.5"'))
+        self.assertFalse(message.etag_matches('"1.5-c"', '"1.5"'))
+
+    @mock.patch('message.time')
+    def test_get_headers(self, mock_time):
+        mock_time.return_value = 1500000000.5
+        response = self.client.get('/message')
+
+        self.assertEqual(response.headers['ETag'], '"1500000000.5"')
+        self.assertEqual(response.headers['Last-Modified'], 'Fri, 14 Jul 2017 02:40:00 GMT')
+        self.assertEqual(response.headers['Cache-Control'], message.CACHE_CONTROL)
+        self.assertEqual(response.headers['Vary'], 'X-Requested-With')
+
+        response = self.client.get('/message', headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertEqual(response.headers['ETag'], '"1500000000.5-c"')
+
+    @mock.patch('message.time')
+    def test_not_modified(self, mock_time):
+        mock_time.return_value = 1500000000.5
+        with mock.patch('message.PRETTY_BODY') as mock_body:
+            response = self.client.get('/message', headers={'If-None-Match': '"1500000000.5"'})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], '"1500000000.5"')
+        self.assertEqual(response.headers['Cache-Control'], message.CACHE_CONTROL)
+        self.assertEqual(response.headers['Vary'], 'X-Requested-With')
+        self.assertNotIn('Last-Modified', response.headers)
+        # The body is never built
+        self.assertEqual(mock_body.mock_calls, [])
+
+        response = self.client.get('/message', headers={'If-None-Match': '"1500000000.4"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), jsonify_body(1500000000.5))
+
+    @mock.patch('message.ticker')
+    def test_not_modified_cached(self, mock_ticker):
+        snapshot = message.take_snapshot(1500000000.12)
+        bodies = mock.MagicMock()
+        mock_ticker.current.return_value = snapshot._replace(bodies=bodies)
+        response = self.client.get('/message', headers={'If-None-Match': 'W/"1500000000.12"'})
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(bodies.mock_calls, [])
+
+    def test_not_modified_headers(self):
+        status, body, headers = message.message_response(if_none_match='*')
+
+        self.assertEqual(status, 304)
+        self.assertEqual([name for name, value in headers], ['Cache-Control', 'ETag', 'Vary'])
+
+class test_clock_ticker(TestCase):
+    def test_invalid_resolution(self):
+        self.assertRaises(ValueError, message.ClockTicker, 0)
+
+    @mock.patch('message.time')
+    def test_tick(self, mock_time):
+        ticker = message.ClockTicker(0.01)
+        mock_time.return_value = 1500000000.123456
+        ticker.tick()
+
+        self.assertEqual(ticker.snapshot.timestamp, 1500000000.12)
+        self.assertEqual(ticker.snapshot.bodies[False], jsonify_body(1500000000.12))
+        self.assertEqual(ticker.snapshot.bodies[True],
+            jsonify_body(1500000000.12, {'X-Requested-With': 'XMLHttpRequest'}))
+        self.assertEqual(ticker.snapshot.etags, ('"1500000000.12"', '"1500000000.12-c"'))
+        self.assertEqual(ticker.snapshot.last_modified, 'Fri, 14 Jul 2017 02:40:00 GMT')
+
+        # Snapshots are only rendered again once the timestamp changes
+        snapshot = ticker.snapshot
+        mock_time.return_value = 1500000000.129
+        ticker.tick()
+        self.assertIs(ticker.snapshot, snapshot)
+
+        mock_time.return_value = 1500000000.131
+        ticker.tick()
+        self.assertEqual(ticker.snapshot.timestamp, 1500000000.13)
+
+    @mock.patch('message.threading.Thread')
+    def test_current(self, mock_thread):
+        ticker = message.ClockTicker(0.001)
+        snapshot = ticker.current()
+
+        self.assertEqual(mock_thread.call_count, 1)
+        self.assertLessEqual(snapshot.timestamp, time())
+        self.assertEqual(ticker.pid, os.getpid())
+
+        # Already running in this process
+        ticker.current()
+        self.assertEqual(mock_thread.call_count, 1)
+
+        # Restarted after a fork
+        ticker.pid = -1
+        ticker.current()
+        self.assertEqual(mock_thread.call_count, 2)
+
+    @mock.patch('message.ticker')
+    def test_get_cached(self, mock_ticker):
+        mock_ticker.current.return_value = message.take_snapshot(1500000000.12)
+        response = app.app.test_client().get('/message')
+
+        self.assertEqual(response.get_data(), jsonify_body(1500000000.12))
+
+    def test_thread(self):
+        ticker = message.ClockTicker(0.001)
+        self.addCleanup(ticker.stop)
+        first = ticker.current().timestamp
+        sleep(0.05)
+        self.assertGreater(ticker.current().timestamp, first)
+
+        ticker.stop()
+        self.assertFalse(ticker.thread.is_alive())
+
+def sample(exposition, name):
+    """
+    Reads a sample's value from a Prometheus text exposition.
+    """
+    for line in exposition.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    raise KeyError(name)
+
+class test_metrics(TestCase):
+    def test_endpoint(self):
+        with mock.patch('message.metrics', message.Metrics(paths=message.METRIC_PATHS)):
+            client = app.app.test_client()
+            client.get('/message')
+            client.get('/bogus')
+            response = client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Type'], message.METRICS_CONTENT_TYPE)
+        exposition = response.get_data(as_text=True)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="2xx"}'), 1)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="other",status="4xx"}'), 1)
+        # The scrape itself is still in flight
+        self.assertEqual(sample(exposition, 'http_requests_in_flight'), 1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,123 @@
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import asyncio
+import json
+import subprocess
+from unittest import TestCase, mock, main
+import message
+import async_app
+
+
+def call(asgi_app, path, method='GET', headers=()):
+    """
+    Runs a single HTTP request through an ASGI app and collects the messages sent.
+    """
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers)}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app(scope, receive, send))
+    return sent
+
+
+class test_async_app(TestCase):
+    @mock.patch('message.time')
+    def test_get_message(self, mock_time):
+        mock_time.return_value = 1500000000.5
+        start, body = call(async_app.create_app(), '/message')
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'application/json'), start['headers'])
+        self.assertIn((b'content-length', str(len(body['body'])).encode()), start['headers'])
+        self.assertEqual(json.loads(body['body']),
+            {'message': 'Automation for the People', 'timestamp': 1500000000.5})
+        self.assertEqual(body['body'], message.render_message(1500000000.5))
+
+    @mock.patch('message.time')
+    def test_get_message_xhr(self, mock_time):
+        mock_time.return_value = 1500000000.5
+        start, body = call(async_app.create_app(), '/message',
+            headers=[(b'x-requested-with', b'XMLHttpRequest')])
+
+        self.assertEqual(body['body'], message.render_message(1500000000.5, compact=True))
+        self.assertIn((b'etag', b'"1500000000.5-c"'), start['headers'])
+
+    @mock.patch('message.time')
+    def test_not_modified(self, mock_time):
+        mock_time.return_value = 1500000000.5
+        start, body = call(async_app.create_app(), '/message',
+            headers=[(b'if-none-match', b'"1500000000.5"')])
+
+        self.assertEqual(start['status'], 304)
+        self.assertEqual(body['body'], b'')
+        self.assertIn((b'etag', b'"1500000000.5"'), start['headers'])
+        self.assertIn((b'cache-control', message.CACHE_CONTROL.encode()), start['headers'])
+        self.assertNotIn(b'content-length', dict(start['headers']))
+        self.assertNotIn(b'last-modified', dict(start['headers']))
+
+    def test_head_message(self):
+        start, body = call(async_app.create_app(), '/message', 'HEAD')
+
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(body['body'], b'')
+
+    def test_healthz(self):
+        start, body = call(async_app.create_app(), '/healthz')
+
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(body['body'], b'ok\n')
+
+    def test_not_found(self):
+        start, body = call(async_app.create_app(), '/missing')
+        self.assertEqual(start['status'], 404)
+
+    def test_method_not_allowed(self):
+        start, body = call(async_app.create_app(), '/message', 'POST')
+        self.assertEqual(start['status'], 405)
+
+    def test_metrics(self):
+        with mock.patch('message.metrics', message.Metrics(paths=message.METRIC_PATHS)):
+            call(async_app.create_app(), '/message')
+            call(async_app.create_app(), '/bogus')
+            start, body = call(async_app.create_app(), '/metrics')
+
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', message.METRICS_CONTENT_TYPE.encode()), start['headers'])
+        exposition = body['body'].decode()
+        self.assertIn('http_requests_total{path="/message",status="2xx"} 1\n', exposition)
+        self.assertIn('http_requests_total{path="other",status="4xx"} 1\n', exposition)
+
+    def test_lifespan(self):
+        application = async_app.create_app()
+        events = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return events.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, [{'type': 'lifespan.startup.complete'},
+            {'type': 'lifespan.shutdown.complete'}])
+
+    def test_without_flask(self):
+        # A fresh interpreter, since this one has already imported app.py
+        code = 'import sys, async_app; print("flask" in sys.modules)'
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=parentdir)
+        self.assertEqual(output, b'False\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import json
+import tempfile
+from unittest import TestCase, mock, main
+import message
+from benchmarks import bench_app
+
+class test_bench_app(TestCase):
+    def test_measure(self):
+        func = mock.MagicMock()
+        metrics = bench_app.measure(func, iterations=10, repeats=2)
+
+        self.assertEqual(func.call_count, 10 + 2 * 10 + 10)
+        self.assertGreaterEqual(metrics['cpu_us'], 0)
+        self.assertGreater(metrics['rps'], 0)
+        self.assertGreaterEqual(metrics['alloc_bytes'], 0)
+
+    def test_run_suite(self):
+        results = bench_app.run_suite(iterations=5, repeats=1)
+
+        self.assertEqual(set(results['results']),
+            {'flask', 'flask_cached', 'asgi', 'render_message', 'message_response'})
+        for metrics in results['results'].values():
+            self.assertIn('cpu_relative', metrics)
+        # The cached case must not leak its ticker
+        self.assertIsNone(message.ticker)
+
+        results = bench_app.run_suite(['render_message'], iterations=5, repeats=1)
+        self.assertEqual(list(results['results']), ['render_message'])
+
+    def test_compare(self):
+        baseline = {'results': {'flask': {'cpu_relative': 10.0, 'alloc_bytes': 1000}}}
+        current = {'results': {'flask': {'cpu_relative': 11.0, 'alloc_bytes': 1000},
+                               'asgi': {'cpu_relative': 1.0, 'alloc_bytes': 100}}}
+        self.assertEqual(bench_app.compare(current, baseline, 0.25), [])
+
+        current['results']['flask']['alloc_bytes'] = 2000
+        regressions = bench_app.compare(current, baseline, 0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertIn('flask alloc_bytes', regressions[0])
+
+    @mock.patch('benchmarks.bench_app.print_results')
+    @mock.patch('benchmarks.bench_app.run_suite')
+    def test_main(self, mock_run_suite, mock_print_results):
+        mock_run_suite.return_value = {'results': {'flask': {'cpu_relative': 10.0,
+                                                             'alloc_bytes': 1000}}}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'baseline.json')
+            self.assertEqual(bench_app.main(['--save', path]), 0)
+            with open(path) as f:
+                self.assertEqual(json.load(f), mock_run_suite.return_value)
+            self.assertEqual(bench_app.main(['--compare', path]), 0)
+
+            mock_run_suite.return_value = {'results': {'flask': {'cpu_relative': 20.0,
+                                                                 'alloc_bytes': 1000}}}
+            self.assertEqual(bench_app.main(['--compare', path]), 1)
+
+if __name__ == '__main__':
+    main()
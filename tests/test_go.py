@@ -7,8 +7,26 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
 import go
-from unittest import TestCase, mock, main
+import io
+import json
+import socket
+import tempfile
+import subprocess
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase, mock, main, skipUnless
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
 from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+from requests import RequestException
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
 
 
 class test_AwsDriver(TestCase):
@@ -25,6 +43,61 @@ class test_AwsDriver(TestCase):
         # Test with region
         setobj.get_session(region='us-west-1')
 
+    @mock.patch('go.boto3')
+    def test_clients(self, mock_boto3):
+        session = mock_boto3.Session()
+        session.client().get_caller_identity.return_value = {'Account':'012345678901'}
+        session.client.reset_mock()
+
+        config = go.client_config(max_pool_connections=4, read_timeout=5)
+        setobj = go.AwsDriver(s3_endpoint='http://localhost:9000', config=config)
+        # Nothing is loaded or checked until it is needed
+        self.assertFalse(session.client.called)
+
+        self.assertIs(setobj.s3_client, setobj.s3_client)
+        setobj.cf_client
+        self.assertEqual(setobj.account_id, '012345678901')
+        session.client.assert_has_calls([
+            mock.call('sts'), mock.call().get_caller_identity(),
+            mock.call('s3', region_name='us-east-1', endpoint_url='http://localhost:9000',
+                      config=config),
+            mock.call('cloudformation', region_name='us-east-1', endpoint_url=None,
+                      config=config)])
+        self.assertEqual(session.client.call_count, 3)
+        self.assertEqual(session.client().get_caller_identity.call_count, 1)
+
+        self.assertEqual(config.max_pool_connections, 4)
+        self.assertEqual(config.read_timeout, 5)
+        self.assertEqual(config.retries, {'max_attempts': go.DEFAULT_MAX_ATTEMPTS,
+                                          'mode': 'adaptive'})
+
+    @mock.patch('go.boto3')
+    def test_session_pool(self, mock_boto3):
+        session = mock_boto3.Session()
+        session.client().get_caller_identity.return_value = {'Account': '012345678901'}
+        mock_boto3.Session.reset_mock()
+        session.client.reset_mock()
+        sessions = go.SessionPool()
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            drivers = [go.AwsDriver(region=region, sessions=sessions)
+                       for region in ['us-east-1', 'eu-west-1']]
+            for driver in drivers:
+                driver.cf_client
+                self.assertEqual(driver.account_id, '012345678901')
+            # The credentials are checked once, the clients are made per region
+            self.assertEqual(session.client().get_caller_identity.call_count, 1)
+            self.assertEqual(mock_boto3.Session.call_count, 1)
+            # Other credentials get their own session
+            go.AwsDriver(access_key='id', secret_key='secret', sessions=sessions).session
+
+        self.assertEqual(mock_boto3.Session.call_count, 2)
+        session.client.assert_any_call('cloudformation', region_name='us-east-1',
+            endpoint_url=None, config=drivers[0].config)
+        session.client.assert_any_call('cloudformation', region_name='eu-west-1',
+            endpoint_url=None, config=drivers[1].config)
+        self.assertEqual(len(sessions.sessions), 2)
+
     @mock.patch('go.AwsUtil.get_session')
     def test_get_bucket_name(self, mock_get_session):
         client_mock = mock.MagicMock()
@@ -57,48 +130,311 @@ class test_AwsDriver(TestCase):
         client_mock.create_bucket.assert_called_with(Bucket='012345678901-test', 
             CreateBucketConfiguration={'LocationConstraint': 'us-west-1'})
 
-    @mock.patch('go.open')
     @mock.patch('go.AwsUtil.get_session')
-    def test_upload_files(self, mock_get_session, mock_open):
-        open_mock = mock.MagicMock()
-        open_mock.read.side_effect = ['test-data', 'testing-data', 'single-test-data']
-        mock_open.return_value = open_mock
-
+    def test_upload_files(self, mock_get_session):
         client_mock = mock.MagicMock()
-        client_mock.put_object.return_value = True
+        client_mock.upload_file.return_value = None
         mock_get_session().client.return_value = client_mock
 
         setobj = go.AwsDriver()
 
         files = ['test', 'testing']
-        setobj.upload_files(files, 'test')
-
-        client_mock.put_object.assert_any_call(Body='test-data', Bucket='test', Key='test', ServerSideEncryption='AES256', StorageClass='STANDARD')
-        client_mock.put_object.assert_any_call(Body='testing-data', Bucket='test', Key='testing', ServerSideEncryption='AES256', StorageClass='STANDARD')
+        with mock.patch('go.file_digests', return_value=('"etag"', 'sha')):
+            setobj.upload_files(files, 'test')
+
+        extra_args = {'ServerSideEncryption': 'AES256', 'StorageClass': 'STANDARD',
+                      'Metadata': {'sha256': 'sha'}}
+        client_mock.upload_file.assert_any_call('test', 'test', 'test',
+            Config=mock.ANY, ExtraArgs=extra_args)
+        client_mock.upload_file.assert_any_call('testing', 'test', 'testing',
+            Config=mock.ANY, ExtraArgs=extra_args)
+        config = client_mock.upload_file.call_args[1]['Config']
+        self.assertEqual(config.multipart_threshold, go.MULTIPART_THRESHOLD)
+        self.assertEqual(config.max_concurrency, go.DEFAULT_UPLOAD_WORKERS)
 
         files = 'single-test'
-        setobj.upload_files(files, 'test')
+        with mock.patch('go.file_digests', return_value=('"etag"', 'sha')):
+            setobj.upload_files(files, 'test')
+
+            client_mock.upload_file.assert_any_call('single-test', 'test', 'single-test',
+                Config=mock.ANY, ExtraArgs=extra_args)
+
+            client_mock.upload_file.side_effect = S3UploadFailedError('failed')
+            self.assertRaises(SystemExit, setobj.upload_files, files, 'test')
+
+    @mock.patch('go.file_digests')
+    @mock.patch('go.AwsDriver.list_objects')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_upload_files_incremental(self, mock_get_session, mock_list_objects,
+        mock_file_digests):
+        client_mock = mock.MagicMock()
+        client_mock.head_object.side_effect = [{'Metadata': {'sha256': 'sha-b'}},
+                                               {'Metadata': {}}]
+        mock_get_session().client.return_value = client_mock
+        mock_list_objects.return_value = {'a': '"etag-a"', 'b': '"other"', 'c': '"other"',
+                                          'stale': '"etag"'}
+        digests = {'a': ('"etag-a"', 'sha-a'), 'b': ('"etag-b"', 'sha-b'),
+                   'c': ('"etag-c"', 'sha-c'), 'd': ('"etag-d"', 'sha-d')}
+        mock_file_digests.side_effect = lambda path: digests[path]
+
+        setobj = go.AwsDriver()
+        with mock.patch('go.AwsDriver.delete_files') as mock_delete_files:
+            report = setobj.upload_files(['a', 'b', 'c', 'd'], 'test', delete=True)
+            mock_delete_files.assert_called_with(['stale'], 'test')
+
+        # a matches by ETag, b by the SHA-256 in its metadata
+        self.assertEqual(report, {'uploaded': ['c', 'd'], 'skipped': ['a', 'b'],
+                                  'deleted': ['stale']})
+        self.assertEqual(client_mock.upload_file.call_count, 2)
+
+    def test_file_digests(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'file')
+            with open(path, 'wb') as f:
+                f.write(b'test')
+            etag, sha256 = go.file_digests(path)
+            self.assertEqual(etag, '"098f6bcd4621d373cade4e832627b4f6"')
+            self.assertEqual(sha256,
+                '9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08')
+
+            with mock.patch('go.MULTIPART_THRESHOLD', 4), mock.patch('go.MULTIPART_CHUNKSIZE', 2):
+                etag, sha256 = go.file_digests(path)
+            parts = go.hashlib.md5(b'te').digest() + go.hashlib.md5(b'st').digest()
+            self.assertEqual(etag, f'"{go.hashlib.md5(parts).hexdigest()}-2"')
+
+    @mock.patch('go.install_dependencies')
+    def test_build_artifact(self, mock_install_dependencies):
+        def install(requirements, target, python_version, platform):
+            Path(target, 'flask').mkdir()
+            Path(target, 'flask', '__init__.py').write_text('')
+        mock_install_dependencies.side_effect = install
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                Path('app.py').write_text('app = None\n')
+                Path('requirements.txt').write_text('Flask==0.12\n')
+                path = go.build_artifact(['app.py', 'requirements.txt'], 'out')
+                mock_install_dependencies.assert_called_with('requirements.txt', mock.ANY,
+                    go.ARTIFACT_PYTHON_VERSION, go.ARTIFACT_PLATFORM)
+                with go.tarfile.open(path) as tar:
+                    self.assertEqual(sorted(tar.getnames()), ['app.py', 'lib', 'lib/flask',
+                        'lib/flask/__init__.py', 'requirements.txt'])
+                    self.assertEqual({member.uid for member in tar.getmembers()}, {0})
+
+                # Unchanged files reuse the artifact, changed ones get a new version
+                self.assertEqual(go.build_artifact(['app.py', 'requirements.txt'], 'out'), path)
+                self.assertEqual(mock_install_dependencies.call_count, 1)
+                self.assertNotEqual(go.build_artifact(['app.py', 'requirements.txt'], 'out',
+                    python_version='3.11'), path)
+                Path('app.py').write_text('app = 1\n')
+                self.assertNotEqual(go.build_artifact(['app.py', 'requirements.txt'], 'out'), path)
+            finally:
+                os.chdir(cwd)
+
+    @mock.patch('go.subprocess.run')
+    def test_build_image(self, mock_run):
+        tag = go.build_image()
+        self.assertTrue(tag.startswith('message-api:'))
+        mock_run.assert_called_with(['docker', 'build', '--platform', 'linux/amd64',
+            '--tag', tag, '.'], check=True)
+
+        mock_run.side_effect = FileNotFoundError
+        with self.assertRaises(SystemExit):
+            go.build_image()
+
+    def test_container_files(self):
+        # The image version covers everything the Dockerfile copies
+        dockerfile = Path(parentdir, 'Dockerfile').read_text()
+        copied = set()
+        for line in dockerfile.splitlines():
+            if line.startswith('COPY') and '--from' not in line:
+                copied.update(Path(name).name for name in line.split()[1:-1])
+        self.assertLessEqual(copied, set(go.CONTAINER_FILES))
+        allowed = {line[1:] for line in
+                   Path(parentdir, '.dockerignore').read_text().splitlines()
+                   if line.startswith('!')}
+        self.assertLessEqual(copied, allowed)
+
+    @mock.patch('go.sleep')
+    @mock.patch('go.requests')
+    @mock.patch('go.subprocess.run')
+    def test_run_container(self, mock_run, mock_requests, mock_sleep):
+        mock_requests.RequestException = RequestException
+        mock_requests.get.side_effect = [RequestException(), mock.MagicMock(ok=False),
+                                         mock.MagicMock(ok=True)]
+
+        url = go.run_container('message-api:123', 8081)
+        self.assertEqual(url, 'http://127.0.0.1:8081/message')
+        mock_run.assert_any_call(['docker', 'rm', '--force', 'message-api'], capture_output=True)
+        mock_run.assert_called_with(['docker', 'run', '--detach', '--name', 'message-api',
+            '--publish', '8081:80', 'message-api:123'], check=True, capture_output=True)
+        mock_requests.get.assert_called_with('http://127.0.0.1:8081/healthz', timeout=1)
+        self.assertEqual(mock_requests.get.call_count, 3)
+
+        mock_requests.get.side_effect = RequestException()
+        with mock.patch('go.perf_counter', side_effect=[0, 1, 2, 40]):
+            with self.assertRaises(SystemExit):
+                go.run_container('message-api:123', 8081)
+
+    @mock.patch('go.docker')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_push_image(self, mock_get_session, mock_docker):
+        client_mock = mock.MagicMock()
+        client_mock.exceptions.RepositoryAlreadyExistsException = ValueError
+        client_mock.create_repository.side_effect = ValueError
+        client_mock.describe_repositories.return_value = {'repositories': [
+            {'repositoryUri': '012345678901.dkr.ecr.us-east-1.amazonaws.com/message-api'}]}
+        client_mock.get_authorization_token.return_value = {'authorizationData': [{
+            'authorizationToken': go.base64.b64encode(b'AWS:secret').decode(),
+            'proxyEndpoint': 'https://012345678901.dkr.ecr.us-east-1.amazonaws.com'}]}
+        mock_get_session().client.return_value = client_mock
 
-        client_mock.put_object.assert_any_call(Body='single-test-data', Bucket='test', Key='single-test', ServerSideEncryption='AES256', StorageClass='STANDARD')
+        setobj = go.AwsDriver()
+        image = setobj.push_image('message-api:123')
+
+        self.assertEqual(image, '012345678901.dkr.ecr.us-east-1.amazonaws.com/message-api:123')
+        mock_docker.assert_any_call('login', '--username', 'AWS', '--password-stdin',
+            'https://012345678901.dkr.ecr.us-east-1.amazonaws.com', input=b'secret',
+            capture_output=True)
+        mock_docker.assert_any_call('tag', 'message-api:123', image)
+        mock_docker.assert_called_with('push', image)
+
+    @mock.patch('go.subprocess.run')
+    def test_install_dependencies(self, mock_run):
+        go.install_dependencies('requirements.txt', 'lib', '3.7', 'manylinux2014_x86_64')
+        command = mock_run.call_args[0][0]
+        self.assertIn('--only-binary=:all:', command)
+        self.assertEqual(command[command.index('--python-version') + 1], '3.7')
+        self.assertEqual(command[command.index('--target') + 1], 'lib')
+
+        mock_run.side_effect = go.subprocess.CalledProcessError(1, 'pip')
+        with self.assertRaises(SystemExit):
+            go.install_dependencies('requirements.txt', 'lib', '3.7', 'manylinux2014_x86_64')
+
+    def test_expand_paths(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'static', 'css'))
+            for name in ['static/b.js', 'static/a.js', 'static/css/site.css']:
+                open(os.path.join(tmp, name), 'w').close()
+            paths = go.expand_paths(['app.py', os.path.join(tmp, 'static')])
+        self.assertEqual(paths, ['app.py', os.path.join(tmp, 'static', 'a.js'),
+            os.path.join(tmp, 'static', 'b.js'), os.path.join(tmp, 'static', 'css', 'site.css')])
+
+    @skipUnless(mock_aws, 'moto is not installed')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_upload_files_local_s3(self, mock_get_session):
+        with mock_aws():
+            session = go.boto3.Session(aws_access_key_id='testing',
+                aws_secret_access_key='testing', region_name='us-east-1')
+            mock_get_session.return_value = session
+            setobj = go.AwsDriver()
+            setobj.s3_client.create_bucket(Bucket='test')
+
+            with tempfile.TemporaryDirectory() as tmp:
+                small = os.path.join(tmp, 'small.txt')
+                large = os.path.join(tmp, 'large.bin')
+                with open(small, 'wb') as f:
+                    f.write(b'small file')
+                with open(large, 'wb') as f:
+                    f.write(os.urandom(go.MULTIPART_THRESHOLD + 1024))
+                setobj.upload_files([small, large], 'test')
+
+                body = setobj.s3_client.get_object(Bucket='test', Key=small)['Body'].read()
+                self.assertEqual(body, b'small file')
+                # Multipart uploads have an ETag suffixed with the part count
+                head = setobj.s3_client.head_object(Bucket='test', Key=large)
+                self.assertTrue(head['ETag'].endswith('-2"'))
+                self.assertEqual(head['ContentLength'], go.MULTIPART_THRESHOLD + 1024)
+
+                # Unchanged files are skipped, both single part and multipart
+                report = setobj.upload_files([small, large], 'test')
+                self.assertEqual(report['uploaded'], [])
+                self.assertEqual(len(report['skipped']), 2)
+
+                with open(small, 'wb') as f:
+                    f.write(b'changed file')
+                setobj.s3_client.put_object(Bucket='test', Key='stale', Body=b'')
+                report = setobj.upload_files([small, large], 'test', delete=True)
+                self.assertEqual(report['uploaded'], [Path(small).as_posix()])
+                self.assertEqual(report['deleted'], ['stale'])
 
     @mock.patch('go.AwsUtil.get_session')
     def test_delete_files(self, mock_get_session):
         client_mock = mock.MagicMock()
-        client_mock.delete_object.return_value = True
+        client_mock.delete_objects.return_value = {}
         mock_get_session().client.return_value = client_mock
 
         setobj = go.AwsDriver()
 
         files = ['test', 'testing']
-        setobj.delete_files(files, 'test')
+        report = setobj.delete_files(files, 'test')
 
-        client_mock.delete_object.assert_any_call(Bucket='test', Key='test')
-        client_mock.delete_object.assert_any_call(Bucket='test', Key='testing')
+        client_mock.delete_objects.assert_called_with(Bucket='test',
+            Delete={'Objects': [{'Key': 'test'}, {'Key': 'testing'}], 'Quiet': True})
+        self.assertEqual(report['deleted'], ['test', 'testing'])
 
         files = 'single-test'
         setobj.delete_files(files, 'test')
 
-        client_mock.delete_object.assert_any_call(Bucket='test', Key='single-test')
+        client_mock.delete_objects.assert_called_with(Bucket='test',
+            Delete={'Objects': [{'Key': 'single-test'}], 'Quiet': True})
+
+        client_mock.delete_objects.return_value = {'Errors': [
+            {'Key': 'single-test', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+        self.assertRaises(SystemExit, setobj.delete_files, files, 'test')
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_delete_objects(self, mock_get_session):
+        client_mock = mock.MagicMock()
+        client_mock.delete_objects.side_effect = lambda Bucket, Delete: {'Errors': [
+            {'Key': obj['Key'], 'VersionId': obj['VersionId'], 'Code': 'AccessDenied',
+             'Message': 'Access Denied'} for obj in Delete['Objects'] if obj['Key'] == 'key-5']}
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        objects = ({'Key': f'key-{i}', 'VersionId': 'v1'} for i in range(2500))
+        report = setobj.delete_objects(objects, 'test')
+
+        # Batches of up to 1000 keys
+        sizes = sorted(len(call[1]['Delete']['Objects'])
+                       for call in client_mock.delete_objects.call_args_list)
+        self.assertEqual(sizes, [500, 1000, 1000])
+        self.assertEqual(len(report['deleted']), 2499)
+        self.assertEqual(report['errors'], {'key-5 (v1)': 'AccessDenied: Access Denied'})
+
+        # A failed request marks every key in its batch as failed
+        client_mock.delete_objects.side_effect = ClientError(
+            {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'DeleteObjects')
+        report = setobj.delete_objects([{'Key': 'a'}, {'Key': 'b'}], 'test')
+        self.assertEqual(report, {'deleted': [],
+                                  'errors': {'a': 'Access Denied', 'b': 'Access Denied'}})
+
+    @skipUnless(mock_aws, 'moto is not installed')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_delete_prefix(self, mock_get_session):
+        with mock_aws():
+            session = go.boto3.Session(aws_access_key_id='testing',
+                aws_secret_access_key='testing', region_name='us-east-1')
+            mock_get_session.return_value = session
+            setobj = go.AwsDriver()
+            s3 = setobj.s3_client
+            s3.create_bucket(Bucket='test')
+            s3.put_bucket_versioning(Bucket='test',
+                VersioningConfiguration={'Status': 'Enabled'})
+            for i in range(3):
+                s3.put_object(Bucket='test', Key='app/app.py', Body=str(i).encode())
+            s3.delete_object(Bucket='test', Key='app/app.py')
+            s3.put_object(Bucket='test', Key='keep.txt', Body=b'')
+
+            report = setobj.delete_prefix('test', 'app/')
+
+            # Three versions and a delete marker
+            self.assertEqual(len(report['deleted']), 4)
+            versions = s3.list_object_versions(Bucket='test')
+            self.assertEqual([v['Key'] for v in versions.get('Versions', [])], ['keep.txt'])
+            self.assertNotIn('DeleteMarkers', versions)
 
     @mock.patch('go.AwsUtil.get_session')
     def test_verify_key_pair(self, mock_get_session):
@@ -189,42 +525,288 @@ class test_AwsDriver(TestCase):
         self.assertTrue(client_mock.describe_stacks.called)
         self.assertEqual(cf_stack, stack)
 
-    @mock.patch('go.open')
-    @mock.patch('go.json')
+    @mock.patch('go.render_template', return_value='{"MyTemplate":"Values"}')
     @mock.patch('go.AwsUtil.get_session')
-    def test_create_cf_stack(self, mock_get_session, mock_json, mock_open):
+    def test_create_cf_stack(self, mock_get_session, mock_render_template):
         client_mock = mock.MagicMock()
         client_mock.describe_stacks.side_effect = [ClientError({'Error': {'Message': ''}}, 'DescribeStacks'), True]
         client_mock.get_parameter.return_value = {'Parameter':{'Value':'ami-123'}}
-        client_mock.validate_template.return_value = True
         client_mock.create_stack.return_value = {'StackId':'789'}
         mock_get_session().client.return_value = client_mock
 
-        mock_json.loads.return_value = {'Resources':{'LaunchConfiguration':{'Properties':{'ImageId':'ami-0'}}}}
-        mock_json.dumps.return_value = {'MyTemplate':'Values'}
-        mock_open.read.return_value = ''
-
         setobj = go.AwsDriver()
         stack_id = setobj.create_cf_stack('test-kp', 'test-stack')
 
-        self.assertTrue(mock_json.loads.called)
+        mock_render_template.assert_called_with('ami-123')
+        # Checked locally, not by CloudFormation
+        self.assertFalse(client_mock.validate_template.called)
         client_mock.create_stack.assert_called_with(Capabilities=['CAPABILITY_IAM'], 
             Parameters=[{'ParameterKey': 'KeyPairName', 'ParameterValue': 'test-kp'}], 
-            StackName='test-stack', TemplateBody={'MyTemplate': 'Values'})
+            StackName='test-stack', TemplateBody='{"MyTemplate":"Values"}')
         self.assertEqual(stack_id, '789')
 
+    @skipUnless(mock_aws, 'moto is not installed')
     @mock.patch('go.AwsUtil.get_session')
-    def test_wait_for_stack_completion(self, mock_get_session):
+    def test_template_source(self, mock_get_session):
+        with mock_aws():
+            session = go.boto3.Session(aws_access_key_id='testing',
+                aws_secret_access_key='testing', region_name='us-east-1')
+            mock_get_session.return_value = session
+            setobj = go.AwsDriver()
+
+            small = '{"Resources":{}}'
+            self.assertEqual(setobj.template_source(small, 'test'), {'TemplateBody': small})
+            self.assertEqual(setobj.s3_client.list_buckets()['Buckets'], [])
+
+            large = json.dumps({'Description': 'x' * go.TEMPLATE_BODY_LIMIT})
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                source = setobj.template_source(large, 'test')
+            bucket = setobj.get_bucket_name('test')
+            self.assertRegex(source['TemplateURL'],
+                rf'^https://.+/{bucket}/templates/[0-9a-f]{{12}}\.json$')
+            key = source['TemplateURL'].split(f'/{bucket}/')[1]
+            body = setobj.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+            self.assertEqual(body.decode('utf-8'), large)
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_validate_template(self, mock_get_session):
+        client_mock = mock.MagicMock()
+        client_mock.get_parameter.return_value = {'Parameter':{'Value':'ami-123'}}
+        client_mock.validate_template.side_effect = [True,
+            ClientError({'Error': {'Message': 'Template format error'}}, 'ValidateTemplate')]
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        self.assertEqual(setobj.get_latest_ami(), 'ami-123')
+        template = setobj.load_template('ami-123')
+        self.assertEqual(
+            go.json.loads(template)['Resources']['LaunchConfiguration']['Properties']['ImageId'],
+            'ami-123')
+
+        setobj.validate_template(template)
+        client_mock.validate_template.assert_called_with(TemplateBody=template)
+        with self.assertRaises(SystemExit):
+            setobj.validate_template(template)
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                setobj.load_template('ami-123', az_count=1)
+
+    @mock.patch('go.sleep')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_wait_for_stack_completion(self, mock_get_session, mock_sleep):
         client_mock = mock.MagicMock()
         client_mock.describe_stacks.side_effect = [{'Stacks':[{'StackStatus':'CREATE_IN_PROGRESS'}]},
             {'Stacks':[{'StackStatus':'CREATE_COMPLETE', 'Outputs':[{'OutputKey': 'URL', 
             'OutputValue': 'http://link.com'}]}]}]
+        client_mock.describe_stack_events.return_value = {'StackEvents': []}
         mock_get_session().client.return_value = client_mock
 
         setobj = go.AwsDriver()
-        setobj.wait_for_stack_completion('test-stack')
+        url = setobj.wait_for_stack_completion('test-stack')
 
         self.assertTrue(client_mock.describe_stacks.called)
+        self.assertEqual(url, 'http://link.com')
+
+        client_mock.describe_stacks.side_effect = [{'Stacks':[{'StackStatus':'ROLLBACK_COMPLETE'}]}]
+        self.assertRaises(SystemExit, setobj.wait_for_stack_completion, 'test-stack')
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_create_change_set(self, mock_get_session):
+        client_mock = mock.MagicMock()
+        client_mock.create_change_set.return_value = {'Id': 'cs-1'}
+        mock_get_session().client.return_value = client_mock
+        template = json.dumps({'Parameters': {'KeyPairName': {}, 'ArtifactKey': {},
+            'MinSize': {}, 'ListenerPort': {}}})
+
+        setobj = go.AwsDriver()
+        with mock.patch('go.time', return_value=1600000000.5):
+            change_set_id = setobj.create_change_set('test-stack', template,
+                {'ArtifactKey': 'artifacts/app-2.tar.gz'}, ['KeyPairName', 'ArtifactKey', 'MinSize',
+                 'Removed'])
+
+        self.assertEqual(change_set_id, 'cs-1')
+        # New parameters without a value keep their defaults, removed ones are left out
+        client_mock.create_change_set.assert_called_with(StackName='test-stack',
+            ChangeSetName='test-stack-1600000000', ChangeSetType='UPDATE', TemplateBody=template,
+            Parameters=[{'ParameterKey': 'KeyPairName', 'UsePreviousValue': True},
+                        {'ParameterKey': 'ArtifactKey', 'ParameterValue': 'artifacts/app-2.tar.gz'},
+                        {'ParameterKey': 'MinSize', 'UsePreviousValue': True}],
+            Capabilities=['CAPABILITY_IAM'])
+
+        client_mock.create_change_set.side_effect = ClientError(
+            {'Error': {'Message': 'Stack is in UPDATE_IN_PROGRESS state'}}, 'CreateChangeSet')
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                setobj.create_change_set('test-stack', template)
+
+    @mock.patch('go.sleep')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_wait_for_change_set(self, mock_get_session, mock_sleep):
+        client_mock = mock.MagicMock()
+        change = lambda resource: {'ResourceChange': {'LogicalResourceId': resource}}
+        client_mock.describe_change_set.side_effect = [
+            {'Status': 'CREATE_PENDING'},
+            {'Status': 'CREATE_IN_PROGRESS'},
+            {'Status': 'CREATE_COMPLETE', 'ChangeSetId': 'cs-1', 'StackId': 'stack-1',
+             'Changes': [change('LaunchConfiguration')], 'NextToken': 'next'},
+            {'Status': 'CREATE_COMPLETE', 'Changes': [change('AutoScalingGroup')]},
+        ]
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        change_set = setobj.wait_for_change_set('cs-1')
+
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual([c['ResourceChange']['LogicalResourceId'] for c in change_set['Changes']],
+            ['LaunchConfiguration', 'AutoScalingGroup'])
+        client_mock.describe_change_set.assert_called_with(ChangeSetName='cs-1', NextToken='next')
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertEqual(setobj.execute_change_set(change_set, 'test-stack'), 'stack-1')
+        client_mock.execute_change_set.assert_called_with(ChangeSetName='cs-1')
+
+        # Nothing to change
+        client_mock.describe_change_set.side_effect = [{'Status': 'FAILED', 'StatusReason':
+            "The submitted information didn't contain changes. Submit different information " \
+            "to create a change set."}]
+        self.assertIsNone(setobj.wait_for_change_set('cs-2'))
+        client_mock.delete_change_set.assert_called_with(ChangeSetName='cs-2')
+
+        client_mock.describe_change_set.side_effect = [{'Status': 'FAILED',
+            'StatusReason': 'Template error'}]
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(SystemExit):
+                setobj.wait_for_change_set('cs-3')
+        self.assertIn('Template error', stdout.getvalue())
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_start_instance_refresh(self, mock_get_session):
+        client_mock = mock.MagicMock()
+        client_mock.describe_stack_resource.side_effect = [
+            {'StackResourceDetail': {'PhysicalResourceId': 'test-stack-AutoScalingGroup-1'}},
+            ClientError({'Error': {'Message': 'Stack does not exist'}}, 'DescribeStackResource')]
+        client_mock.start_instance_refresh.return_value = {'InstanceRefreshId': 'refresh-1'}
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        group_name = setobj.get_stack_resource('test-stack', 'AutoScalingGroup')
+        self.assertEqual(group_name, 'test-stack-AutoScalingGroup-1')
+        client_mock.describe_stack_resource.assert_called_with(StackName='test-stack',
+            LogicalResourceId='AutoScalingGroup')
+        self.assertIsNone(setobj.get_stack_resource('test-stack', 'AutoScalingGroup'))
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertEqual(setobj.start_instance_refresh(group_name, 50, 150, 60), 'refresh-1')
+        client_mock.start_instance_refresh.assert_called_with(AutoScalingGroupName=group_name,
+            Strategy='Rolling', Preferences={'MinHealthyPercentage': 50,
+            'MaxHealthyPercentage': 150, 'InstanceWarmup': 60})
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            setobj.start_instance_refresh(group_name)
+        client_mock.start_instance_refresh.assert_called_with(AutoScalingGroupName=group_name,
+            Strategy='Rolling', Preferences={'MinHealthyPercentage': go.DEFAULT_MIN_HEALTHY,
+            'MaxHealthyPercentage': go.DEFAULT_MAX_HEALTHY})
+
+        client_mock.start_instance_refresh.side_effect = ClientError({'Error': {'Message':
+            'An Instance Refresh is already in progress'}}, 'StartInstanceRefresh')
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(SystemExit):
+                setobj.start_instance_refresh(group_name)
+        self.assertIn('already in progress', stdout.getvalue())
+
+    @mock.patch('go.sleep')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_wait_for_instance_refresh(self, mock_get_session, mock_sleep):
+        client_mock = mock.MagicMock()
+        refresh = lambda status, done, to_go: {'InstanceRefreshes': [{'Status': status,
+            'PercentageComplete': done, 'InstancesToUpdate': to_go}]}
+        client_mock.describe_instance_refreshes.side_effect = [
+            refresh('Pending', 0, 4), refresh('InProgress', 0, 4), refresh('InProgress', 0, 4),
+            refresh('InProgress', 50, 2), refresh('Successful', 100, 0)]
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            result = setobj.wait_for_instance_refresh('group', 'refresh-1')
+
+        self.assertEqual(result['Status'], 'Successful')
+        client_mock.describe_instance_refreshes.assert_called_with(AutoScalingGroupName='group',
+            InstanceRefreshIds=['refresh-1'])
+        # Unchanged progress is not printed again
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            'Instance refresh Pending, 0% complete, 4 instances to go',
+            'Instance refresh InProgress, 0% complete, 4 instances to go',
+            'Instance refresh InProgress, 50% complete, 2 instances to go',
+            'Instance refresh Successful, 100% complete, 0 instances to go'])
+        self.assertEqual(mock_sleep.call_count, 4)
+
+        client_mock.describe_instance_refreshes.side_effect = None
+        client_mock.describe_instance_refreshes.return_value = refresh('InProgress', 10, 3)
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            self.assertIsNone(setobj.wait_for_instance_refresh('group', 'refresh-1', timeout=0))
+
+    @mock.patch('go.sleep')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_wait_for_stack(self, mock_get_session, mock_sleep):
+        t0 = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        def event(event_id, resource, status, seconds):
+            return {'EventId': event_id, 'LogicalResourceId': resource, 'ResourceStatus': status,
+                    'ResourceType': 'AWS::EC2::VPC', 'Timestamp': t0 + timedelta(seconds=seconds)}
+
+        client_mock = mock.MagicMock()
+        client_mock.describe_stack_events.side_effect = [
+            {'StackEvents': [event('1', 'VPC', 'CREATE_IN_PROGRESS', 0)]},
+            {'StackEvents': [event('1', 'VPC', 'CREATE_IN_PROGRESS', 0)]},
+            {'StackEvents': [event('2', 'VPC', 'CREATE_COMPLETE', 42),
+                             event('1', 'VPC', 'CREATE_IN_PROGRESS', 0)]}]
+        client_mock.describe_stacks.side_effect = [
+            {'Stacks':[{'StackStatus':'CREATE_IN_PROGRESS'}]},
+            {'Stacks':[{'StackStatus':'CREATE_IN_PROGRESS'}]},
+            {'Stacks':[{'StackStatus':'CREATE_COMPLETE'}]}]
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        with mock.patch('builtins.print') as mock_print:
+            cf_stack = setobj.wait_for_stack('test-stack', ['CREATE_COMPLETE'])
+
+        self.assertEqual(cf_stack, {'StackStatus': 'CREATE_COMPLETE'})
+        mock_print.assert_any_call('00:00:42 VPC (AWS::EC2::VPC) CREATE_COMPLETE after 42s')
+        # Polls quickly after new events and backs off when there are none
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list],
+            [go.MIN_POLL_INTERVAL, go.MIN_POLL_INTERVAL * go.POLL_BACKOFF])
+
+        # Gives up at the deadline
+        client_mock.describe_stack_events.side_effect = None
+        client_mock.describe_stack_events.return_value = {'StackEvents': []}
+        client_mock.describe_stacks.side_effect = None
+        client_mock.describe_stacks.return_value = {'Stacks':[{'StackStatus':'CREATE_IN_PROGRESS'}]}
+        with mock.patch('go.monotonic', side_effect=[0, 5, 11]):
+            self.assertIsNone(setobj.wait_for_stack('test-stack', ['CREATE_COMPLETE'], timeout=10))
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_get_new_stack_events(self, mock_get_session):
+        stack_id = 'arn:aws:cloudformation:us-east-1:012345678901:stack/test/1'
+        start = {'EventId': 'start', 'ResourceType': 'AWS::CloudFormation::Stack',
+                 'PhysicalResourceId': stack_id, 'ResourceStatus': 'DELETE_IN_PROGRESS',
+                 'ResourceStatusReason': 'User Initiated'}
+        client_mock = mock.MagicMock()
+        client_mock.describe_stack_events.side_effect = [
+            {'StackEvents': [{'EventId': 'b'}, {'EventId': 'a'}], 'NextToken': 'next'},
+            {'StackEvents': [start, {'EventId': 'old'}]},
+            {'StackEvents': [{'EventId': 'c'}, {'EventId': 'b'}, {'EventId': 'a'}]}]
+        mock_get_session().client.return_value = client_mock
+
+        setobj = go.AwsDriver()
+        seen = set()
+        events = setobj.get_new_stack_events(stack_id, seen)
+
+        # History before the operation started is skipped, oldest event first
+        self.assertEqual([e['EventId'] for e in events], ['start', 'a', 'b'])
+        client_mock.describe_stack_events.assert_called_with(StackName=stack_id, NextToken='next')
+
+        events = setobj.get_new_stack_events(stack_id, seen)
+        self.assertEqual([e['EventId'] for e in events], ['c'])
 
     @mock.patch('go.AwsUtil.get_session')
     def test_delete_cf_stack(self, mock_get_session):
@@ -237,17 +819,26 @@ class test_AwsDriver(TestCase):
 
         self.assertTrue(client_mock.delete_stack.called)
 
+    @mock.patch('go.sleep')
     @mock.patch('go.AwsUtil.get_session')
-    def test_wait_for_stack_deletion(self, mock_get_session):
+    def test_wait_for_stack_deletion(self, mock_get_session, mock_sleep):
         client_mock = mock.MagicMock()
-        client_mock.describe_stacks.side_effect = [{'Stacks':[{'StackStatus':'DELETE_IN_PROGRESS'}]},
-            ClientError({'Error': {'Message': 'exist'}}, 'DescribeStacks')]
+        client_mock.describe_stacks.side_effect = [{'Stacks':[{'StackId': 'id-1',
+            'StackStatus':'DELETE_IN_PROGRESS'}]}, {'Stacks':[{'StackStatus':'DELETE_IN_PROGRESS'}]},
+            {'Stacks':[{'StackStatus':'DELETE_COMPLETE'}]}]
+        client_mock.describe_stack_events.return_value = {'StackEvents': []}
         mock_get_session().client.return_value = client_mock
 
         setobj = go.AwsDriver()
         setobj.wait_for_stack_deletion('test-stack')
 
         self.assertTrue(client_mock.describe_stacks.called)
+        client_mock.describe_stacks.assert_called_with(StackName='id-1')
+
+        # Already deleted
+        client_mock.describe_stacks.side_effect = ClientError({'Error': {'Message': 'exist'}},
+            'DescribeStacks')
+        setobj.wait_for_stack_deletion('test-stack')
 
 
 class test_go_functions(TestCase):
@@ -258,16 +849,37 @@ class test_go_functions(TestCase):
         self.args.key_pair = 'test-project'
         self.args.region = 'us-east-1'
         self.args.name = 'test'
-
+        self.args.files = go.DEFAULT_FILES
+        self.args.workers = go.DEFAULT_PHASE_WORKERS
+        self.args.max_pool_connections = go.DEFAULT_MAX_POOL_CONNECTIONS
+        self.args.connect_timeout = go.DEFAULT_CONNECT_TIMEOUT
+        self.args.read_timeout = go.DEFAULT_READ_TIMEOUT
+        self.args.no_cache = True
+        self.args.sessions = None
+        self.args.container = False
+        self.args.validate = False
+        self.args.dry_run = False
+        self.args.min_healthy = go.DEFAULT_MIN_HEALTHY
+        self.args.max_healthy = go.DEFAULT_MAX_HEALTHY
+        self.args.az_count = None
+        self.args.instance_type = None
+        self.args.listener_port = None
+        self.args.app_port = None
+        for name in go.SCALING_PARAMETERS:
+            setattr(self.args, name, None)
+
+    @mock.patch('go.build_artifact', return_value='artifacts/app-123.tar.gz')
     @mock.patch('go.test_api')
     @mock.patch('go.AwsDriver')
-    def test_build(self, mock_driver, mock_test_api):
+    def test_build(self, mock_driver, mock_test_api, mock_build_artifact):
         driver_mock = mock.MagicMock()
         driver_mock.create_bucket.return_value = '012345678901-test'
         driver_mock.upload_files.return_value = True
         driver_mock.verify_key_pair.side_effect = [True, False]
         driver_mock.create_key_pair.return_value = True
         driver_mock.save_key_pair.return_value = True
+        driver_mock.get_latest_ami.return_value = 'ami-123'
+        driver_mock.load_template.return_value = '{}'
         driver_mock.create_cf_stack.return_value = '0123'
         driver_mock.wait_for_stack_completion.return_value = True
         mock_driver.return_value = driver_mock
@@ -275,28 +887,320 @@ class test_go_functions(TestCase):
         go.build(self.args)
 
         self.assertTrue(driver_mock.create_bucket.called)
-        driver_mock.upload_files.assert_called_with(['app.py', 'requirements.txt'], '012345678901-test')
+        mock_build_artifact.assert_called_with(go.DEFAULT_FILES, self.args.artifact_dir,
+            self.args.python_version, self.args.platform)
+        driver_mock.upload_files.assert_called_with('artifacts/app-123.tar.gz',
+            '012345678901-test')
         driver_mock.verify_key_pair.assert_called_with('test-project')
-        driver_mock.create_cf_stack.assert_called_with('test-project', 'test')
+        driver_mock.load_template.assert_called_with('ami-123', az_count=2, instance_type=None,
+            listener_port=None, application_port=None)
+        self.assertFalse(driver_mock.validate_template.called)
+        driver_mock.create_cf_stack.assert_called_with('test-project', 'test', '{}', {
+            'ArtifactBucket': '012345678901-test', 'ArtifactKey': 'artifacts/app-123.tar.gz',
+            'ContainerImage': ''})
+        driver_mock.wait_for_stack_completion.assert_called_with('0123', self.args.timeout)
         self.assertTrue(driver_mock.wait_for_stack_completion.called)
         self.assertFalse(driver_mock.create_key_pair.called)
 
         go.build(self.args)
         self.assertTrue(driver_mock.create_key_pair.called)
 
+    @mock.patch('go.build_image', return_value='message-api:123')
+    @mock.patch('go.build_artifact')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsDriver')
+    def test_build_container(self, mock_driver, mock_test_api, mock_build_artifact,
+                             mock_build_image):
+        driver_mock = mock.MagicMock()
+        driver_mock.push_image.return_value = 'registry/message-api:123'
+        driver_mock.load_template.return_value = '{}'
+        mock_driver.return_value = driver_mock
+        self.args.container = True
+
+        go.build(self.args)
+
+        self.assertFalse(mock_build_artifact.called)
+        self.assertFalse(driver_mock.create_bucket.called)
+        driver_mock.push_image.assert_called_with('message-api:123')
+        driver_mock.create_cf_stack.assert_called_with('test-project', 'test', '{}',
+            {'ContainerImage': 'registry/message-api:123', 'ArtifactBucket': '', 'ArtifactKey': ''})
+
+    @mock.patch('go.build_image', return_value='message-api:123')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsDriver')
+    def test_build_scaling(self, mock_driver, mock_test_api, mock_build_image):
+        driver_mock = mock.MagicMock()
+        driver_mock.push_image.return_value = 'registry/message-api:123'
+        driver_mock.load_template.return_value = '{}'
+        mock_driver.return_value = driver_mock
+        self.args.container = True
+        self.args.min_size = 1
+        self.args.max_size = 10
+        self.args.target_cpu = 50
+
+        go.build(self.args)
+
+        driver_mock.create_cf_stack.assert_called_with('test-project', 'test', '{}', {
+            'ContainerImage': 'registry/message-api:123', 'ArtifactBucket': '', 'ArtifactKey': '',
+            'MinSize': '1', 'MaxSize': '10',
+            'TargetCpuUtilization': '50'})
+
+    @mock.patch('go.build_artifact', return_value='artifacts/app-124.tar.gz')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsDriver')
+    def test_deploy(self, mock_driver, mock_test_api, mock_build_artifact):
+        driver_mock = mock.MagicMock()
+        stack_parameters = ['KeyPairName', 'ArtifactKey', 'PublicSubnet1CIDR', 'PublicSubnet2CIDR']
+        driver_mock.get_cf_stack.return_value = {'Parameters': [
+            {'ParameterKey': key} for key in stack_parameters]}
+        driver_mock.create_bucket.return_value = '012345678901-test'
+        driver_mock.get_latest_ami.return_value = 'ami-123'
+        driver_mock.load_template.return_value = '{}'
+        driver_mock.create_change_set.return_value = 'cs-1'
+        change_set = {'ChangeSetName': 'test-1', 'Changes': []}
+        driver_mock.wait_for_change_set.return_value = change_set
+        driver_mock.execute_change_set.return_value = 'stack-1'
+        driver_mock.wait_for_stack_completion.return_value = 'http://link.com/message'
+        mock_driver.return_value = driver_mock
+        self.args.max_size = 4
+
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            go.deploy(self.args)
+
+        driver_mock.create_change_set.assert_called_with('test', '{}', {
+            'ArtifactBucket': '012345678901-test', 'ArtifactKey': 'artifacts/app-124.tar.gz',
+            'ContainerImage': '', 'MaxSize': '4'}, stack_parameters)
+        driver_mock.load_template.assert_called_with('ami-123', az_count=2, instance_type=None,
+            listener_port=None, application_port=None)
+        driver_mock.wait_for_change_set.assert_called_with('cs-1', self.args.timeout)
+        driver_mock.execute_change_set.assert_called_with(change_set, 'test')
+        driver_mock.wait_for_stack_completion.assert_called_with('stack-1', self.args.timeout,
+            'UPDATE_COMPLETE')
+        mock_test_api.assert_called_with('http://link.com/message')
+        # The stack and its key pair already exist
+        self.assertFalse(driver_mock.create_cf_stack.called)
+        self.assertFalse(driver_mock.verify_key_pair.called)
+
+        # Reviewing only
+        driver_mock.execute_change_set.reset_mock()
+        self.args.dry_run = True
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            go.deploy(self.args)
+        self.assertFalse(driver_mock.execute_change_set.called)
+        self.assertIn('Left change set test-1', stdout.getvalue())
+
+        # Nothing to change
+        self.args.dry_run = False
+        driver_mock.wait_for_change_set.return_value = None
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            go.deploy(self.args)
+        self.assertFalse(driver_mock.execute_change_set.called)
+        self.assertIn('up to date', stdout.getvalue())
+
+        driver_mock.get_cf_stack.return_value = None
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                go.deploy(self.args)
+
+    @mock.patch('go.build_artifact', return_value='artifacts/app-126.tar.gz')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsDriver')
+    def test_deploy_az_count(self, mock_driver, mock_test_api, mock_build_artifact):
+        driver_mock = mock.MagicMock()
+        driver_mock.get_cf_stack.return_value = {'Parameters': [
+            {'ParameterKey': f'{subnet}{zone}CIDR'}
+            for subnet in ['PublicSubnet', 'PrivateSubnet'] for zone in range(1, 4)]}
+        driver_mock.get_latest_ami.return_value = 'ami-123'
+        driver_mock.load_template.return_value = '{}'
+        driver_mock.wait_for_change_set.return_value = None
+        mock_driver.return_value = driver_mock
+
+        # A stack built with --az-count 3 keeps its three zones
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            go.deploy(self.args)
+        driver_mock.load_template.assert_called_with('ami-123', az_count=3, instance_type=None,
+            listener_port=None, application_port=None)
+
+        # Changing the zones is refused rather than deleting one
+        driver_mock.create_change_set.reset_mock()
+        self.args.az_count = 2
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            with self.assertRaises(SystemExit):
+                go.deploy(self.args)
+        self.assertIn('spans 3 Availability Zones', stdout.getvalue())
+        self.assertFalse(driver_mock.create_change_set.called)
+
+    @mock.patch('go.build_image', return_value='message-api:125')
+    @mock.patch('go.build_artifact', return_value='artifacts/app-125.tar.gz')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsUtil.get_session')
+    def test_deploy_switch_mode(self, mock_get_session, mock_test_api, mock_build_artifact,
+                                mock_build_image):
+        template = json.dumps({'Parameters': {'KeyPairName': {}, 'ArtifactBucket': {},
+            'ArtifactKey': {}, 'ContainerImage': {}, 'PublicSubnet1CIDR': {},
+            'PublicSubnet2CIDR': {}}})
+        client_mock = mock.MagicMock()
+        client_mock.create_change_set.return_value = {'Id': 'cs-1'}
+        mock_get_session().client.return_value = client_mock
+        self.args.dry_run = True
+
+        def deploy(container):
+            self.args.container = container
+            with mock.patch.object(go.AwsDriver, 'get_cf_stack', return_value={'Parameters': [
+                    {'ParameterKey': key} for key in json.loads(template)['Parameters']]}), \
+                mock.patch.object(go.AwsDriver, 'create_bucket', return_value='012345678901-test'), \
+                mock.patch.object(go.AwsDriver, 'upload_files'), \
+                mock.patch.object(go.AwsDriver, 'push_image', return_value='registry/message-api:125'), \
+                mock.patch.object(go.AwsDriver, 'get_latest_ami', return_value='ami-123'), \
+                mock.patch.object(go.AwsDriver, 'load_template', return_value=template), \
+                mock.patch.object(go.AwsDriver, 'wait_for_change_set',
+                                  return_value={'ChangeSetName': 'test-1', 'Changes': []}), \
+                mock.patch('sys.stdout', new_callable=io.StringIO):
+                go.deploy(self.args)
+            return {parameter['ParameterKey']: parameter.get('ParameterValue')
+                    for parameter in client_mock.create_change_set.call_args[1]['Parameters']}
+
+        # From a container to the artifact, the image no longer takes precedence
+        zones = {'PublicSubnet1CIDR': None, 'PublicSubnet2CIDR': None}
+        self.assertEqual(deploy(False), {'KeyPairName': None,
+            'ArtifactBucket': '012345678901-test', 'ArtifactKey': 'artifacts/app-125.tar.gz',
+            'ContainerImage': '', **zones})
+        # And back, the artifact is not left behind
+        self.assertEqual(deploy(True), {'KeyPairName': None, 'ArtifactBucket': '',
+            'ArtifactKey': '', 'ContainerImage': 'registry/message-api:125', **zones})
+
+    @mock.patch('go.AwsDriver')
+    def test_refresh(self, mock_driver):
+        driver_mock = mock.MagicMock()
+        driver_mock.get_stack_resource.return_value = 'group'
+        driver_mock.start_instance_refresh.return_value = 'refresh-1'
+        driver_mock.wait_for_instance_refresh.return_value = {'Status': 'Successful'}
+        mock_driver.return_value = driver_mock
+        self.args.min_healthy = 50
+        self.args.instance_warmup = 30
+
+        go.refresh(self.args)
+
+        driver_mock.get_stack_resource.assert_called_with('test', 'AutoScalingGroup')
+        driver_mock.start_instance_refresh.assert_called_with('group', 50,
+            go.DEFAULT_MAX_HEALTHY, 30)
+        driver_mock.wait_for_instance_refresh.assert_called_with('group', 'refresh-1',
+            self.args.timeout)
+
+        for result in [{'Status': 'RollbackSuccessful'}, None]:
+            driver_mock.wait_for_instance_refresh.return_value = result
+            with mock.patch('sys.stdout', new_callable=io.StringIO):
+                with self.assertRaises(SystemExit):
+                    go.refresh(self.args)
+
+        driver_mock.start_instance_refresh.reset_mock()
+        driver_mock.get_stack_resource.return_value = None
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                go.refresh(self.args)
+        self.assertFalse(driver_mock.start_instance_refresh.called)
+
+    def test_print_changes(self):
+        changes = [
+            {'ResourceChange': {'Action': 'Modify', 'LogicalResourceId': 'LaunchConfiguration',
+                'ResourceType': 'AWS::AutoScaling::LaunchConfiguration', 'Replacement': 'True',
+                'Details': [{'Target': {'Attribute': 'Properties', 'Name': 'UserData'}}]}},
+            {'ResourceChange': {'Action': 'Modify', 'LogicalResourceId': 'AutoScalingGroup',
+                'ResourceType': 'AWS::AutoScaling::AutoScalingGroup', 'Replacement': 'False',
+                'Details': [
+                    {'Target': {'Attribute': 'Properties', 'Name': 'LaunchConfigurationName'}},
+                    {'Target': {'Attribute': 'Properties', 'Name': 'MaxSize'}}]}},
+            {'ResourceChange': {'Action': 'Add', 'LogicalResourceId': 'PublicSubnet3',
+                'ResourceType': 'AWS::EC2::Subnet'}},
+        ]
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            go.print_changes(changes)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertRegex(lines[1], r'^Modify +LaunchConfiguration +AWS::AutoScaling::'
+            r'LaunchConfiguration +True +UserData$')
+        self.assertRegex(lines[2], r'AutoScalingGroup .+ False +LaunchConfigurationName, MaxSize$')
+        self.assertRegex(lines[3], r'^Add +PublicSubnet3 +AWS::EC2::Subnet *$')
+
+    @mock.patch('go.build_artifact', return_value='artifacts/app-123.tar.gz')
+    @mock.patch('go.test_api')
+    @mock.patch('go.AwsDriver')
+    def test_build_fails_fast(self, mock_driver, mock_test_api, mock_build_artifact):
+        driver_mock = mock.MagicMock()
+        driver_mock.validate_template.side_effect = SystemExit(1)
+        mock_driver.return_value = driver_mock
+        self.args.validate = True
+
+        with self.assertRaises(SystemExit):
+            go.build(self.args)
+        driver_mock.validate_template.assert_called_with(driver_mock.load_template(), 'test')
+        self.assertFalse(driver_mock.create_cf_stack.called)
+        self.assertFalse(driver_mock.wait_for_stack_completion.called)
+
+    def test_run_phases(self):
+        started = {}
+        release = threading.Event()
+
+        def phase(name, blocking=False):
+            def run(*results):
+                started[name] = results
+                if blocking:
+                    # Only returns if the other independent phase runs at the same time
+                    self.assertTrue(release.wait(5))
+                else:
+                    release.set()
+                return name
+            return run
+
+        results = go.run_phases([
+            ('stack', phase('stack'), ['bucket', 'ami']),
+            ('bucket', phase('bucket', blocking=True), []),
+            ('ami', phase('ami'), []),
+        ])
+        self.assertEqual(results, {'bucket': 'bucket', 'ami': 'ami', 'stack': 'stack'})
+        self.assertEqual(started['stack'], ('bucket', 'ami'))
+
+    def test_run_phases_failure(self):
+        calls = []
+
+        def fail():
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            go.run_phases([
+                ('fail', fail, []),
+                ('after', lambda result: calls.append(result), ['fail']),
+            ])
+        self.assertEqual(calls, [])
+
+        # Independent phases queued behind the failing one are cancelled, except
+        # one the freed worker may already have taken
+        with mock.patch('sys.stdout', new_callable=io.StringIO):
+            with self.assertRaises(ValueError):
+                go.run_phases([('fail', fail, [])] +
+                    [(f'queued-{i}', lambda: calls.append('queued'), []) for i in range(5)],
+                    max_workers=1)
+        self.assertLessEqual(len(calls), 1)
+
+        with self.assertRaises(ValueError):
+            go.run_phases([('a', lambda: None, ['missing'])])
+        with self.assertRaises(ValueError):
+            go.run_phases([('a', lambda b: None, ['b']), ('b', lambda a: None, ['a'])])
+
     @mock.patch('go.AwsDriver')
     def test_destroy(self, mock_driver):
         driver_mock = mock.MagicMock()
         driver_mock.get_bucket_name.return_value = '012345678901-test'
-        driver_mock.delete_files.return_value = True
+        driver_mock.delete_prefix.return_value = True
         driver_mock.delete_cf_stack.return_value = True
         driver_mock.wait_for_stack_deletion.return_value = True
         mock_driver.return_value = driver_mock
+        self.args.prefix = ''
 
         go.destroy(self.args)
 
         self.assertTrue(driver_mock.get_bucket_name.called)
-        driver_mock.delete_files.assert_called_with(['app.py', 'requirements.txt'], '012345678901-test')
+        driver_mock.delete_prefix.assert_called_with('012345678901-test', '')
         driver_mock.delete_cf_stack.assert_called_with('test')
         self.assertTrue(driver_mock.wait_for_stack_deletion.called)
 
@@ -337,5 +1241,623 @@ class test_go_functions(TestCase):
 
         self.assertTrue(driver_mock.get_cf_stack.called)
 
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(go.percentile(values, 50), 50)
+        self.assertEqual(go.percentile(values, 51), 51)
+        self.assertEqual(go.percentile(values, 97), 97)
+        self.assertEqual(go.percentile(values, 99), 99)
+        self.assertEqual(go.percentile(values, 0), 1)
+        self.assertEqual(go.percentile(values, 100), 100)
+        self.assertEqual(go.percentile(values, 90), 90)
+        self.assertEqual(go.percentile(values, 99.9), 100)
+        self.assertEqual(go.percentile([7], 99), 7)
+        self.assertIsNone(go.percentile([], 50))
+
+    def test_summarize_latencies(self):
+        summary = go.summarize_latencies([3.0, 0.5, 1500.0, 7.0])
+
+        self.assertEqual(summary['min'], 0.5)
+        self.assertEqual(summary['max'], 1500.0)
+        self.assertEqual(summary['p50'], 3.0)
+        counts = {bucket['le_ms']: bucket['count'] for bucket in summary['histogram']}
+        self.assertEqual(counts[1], 1)
+        self.assertEqual(counts[5], 1)
+        self.assertEqual(counts[10], 1)
+        self.assertEqual(counts[2000], 1)
+        self.assertEqual(sum(counts.values()), 4)
+
+    @mock.patch('go.requests.Session')
+    def test_run_benchmark(self, mock_session):
+        session = mock_session.return_value.__enter__.return_value
+        ok = mock.MagicMock(status_code=200)
+        failed = mock.MagicMock(status_code=502)
+        session.get.side_effect = [ok, failed, go.requests.ConnectionError(), ok, ok]
+
+        results = go.run_benchmark('http://link.com', connections=2, total_requests=5)
+
+        self.assertEqual(results['requests'], 5)
+        self.assertEqual(results['errors'], {'HTTP 502': 1, 'ConnectionError': 1})
+        self.assertEqual(mock_session.call_count, 2)
+        session.get.assert_called_with('http://link.com', timeout=10)
+
+    @mock.patch('go.print_benchmark')
+    @mock.patch('go.run_benchmark')
+    @mock.patch('go.AwsDriver')
+    def test_bench(self, mock_driver, mock_run_benchmark, mock_print_benchmark):
+        driver_mock = mock.MagicMock()
+        driver_mock.get_cf_stack.return_value = {'Outputs':[{'OutputKey':'URL',
+                                                             'OutputValue':'http://link.com'}]}
+        mock_driver.return_value = driver_mock
+        mock_run_benchmark.return_value = {'requests': 1}
+        self.args.url = None
+        self.args.output = None
+        self.args.connections = 4
+        self.args.duration = 2.0
+        self.args.requests = None
+
+        go.bench(self.args)
+        mock_run_benchmark.assert_called_with('http://link.com', connections=4,
+            duration=2.0, total_requests=None)
+
+        self.args.url = 'http://127.0.0.1:8080/message'
+        with mock.patch('go.open', mock.mock_open()) as mock_open:
+            self.args.output = 'bench.json'
+            go.bench(self.args)
+            mock_open.assert_called_with('bench.json', 'w')
+        mock_run_benchmark.assert_called_with('http://127.0.0.1:8080/message',
+            connections=4, duration=2.0, total_requests=None)
+
+class test_MetadataCache(TestCase):
+
+    def test_get_profile(self):
+        with mock.patch.dict(os.environ, {'AWS_PROFILE': ''}):
+            for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_DEFAULT_PROFILE']:
+                os.environ.pop(name, None)
+            self.assertEqual(go.get_profile(), 'default')
+            self.assertEqual(go.get_profile('AKIA1', 'secret'), 'key:AKIA1')
+            os.environ['AWS_PROFILE'] = 'staging'
+            self.assertEqual(go.get_profile(), 'staging')
+            # Environment keys are cached apart from the profile they override
+            os.environ.update(AWS_ACCESS_KEY_ID='AKIA2', AWS_SECRET_ACCESS_KEY='secret')
+            self.assertEqual(go.get_profile(), 'env:AKIA2')
+            self.assertEqual(go.get_profile('AKIA1', 'secret'), 'key:AKIA1')
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache', 'metadata.json')
+            cache = go.MetadataCache(path)
+            self.assertIsNone(cache.get('default/account'))
+
+            cache.set('default/account', '012345678901', 60)
+            cache.set('default/us-east-1/ami', 'ami-123', 60)
+            cache.set('default/us-east-1/stack/app', {'StackName': 'app'}, 60)
+            # Another run reads what this one stored
+            self.assertEqual(go.MetadataCache(path).get('default/us-east-1/stack/app'),
+                {'StackName': 'app'})
+
+            with mock.patch('go.time', return_value=go.time() + 120):
+                self.assertIsNone(cache.get('default/account'))
+
+            cache.invalidate('default/us-east-1/')
+            self.assertIsNone(cache.get('default/us-east-1/ami'))
+            self.assertEqual(cache.get('default/account'), '012345678901')
+
+            disabled = go.MetadataCache(path, enabled=False)
+            self.assertIsNone(disabled.get('default/account'))
+            disabled.invalidate()
+            self.assertEqual(cache.get('default/account'), '012345678901')
+
+            with open(path, 'w') as f:
+                f.write('{not json')
+            self.assertIsNone(cache.get('default/account'))
+
+    @mock.patch('go.boto3')
+    def test_cached_lookups(self, mock_boto3):
+        session = mock_boto3.Session()
+        session.profile_name = 'default'
+        sts = mock.MagicMock()
+        sts.get_caller_identity.return_value = {'Account': '012345678901'}
+        other = mock.MagicMock()
+        other.get_parameter.return_value = {'Parameter': {'Value': 'ami-123'}}
+        other.describe_stacks.return_value = {'Stacks': [{'StackName': 'app',
+            'StackStatus': 'CREATE_COMPLETE', 'Outputs': [], 'CreationTime': datetime.now()}]}
+        session.client.side_effect = lambda service, **kwargs: sts if service == 'sts' else other
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = go.MetadataCache(os.path.join(tmp, 'metadata.json'))
+            for i in range(2):
+                setobj = go.AwsDriver(cache=cache)
+                self.assertEqual(setobj.account_id, '012345678901')
+                self.assertEqual(setobj.get_latest_ami(), 'ami-123')
+                self.assertEqual(setobj.get_cf_stack('app', cached=True)['StackName'], 'app')
+            self.assertEqual(sts.get_caller_identity.call_count, 1)
+            # The second driver answered everything without creating a session
+            self.assertEqual(mock_boto3.Session.call_count, 2)
+            self.assertEqual(other.get_parameter.call_count, 1)
+            self.assertEqual(other.describe_stacks.call_count, 1)
+
+            # Uncached lookups and changes to the stack go to AWS again
+            setobj.get_cf_stack('app')
+            setobj.delete_cf_stack('app')
+            setobj.get_cf_stack('app', cached=True)
+            self.assertEqual(other.describe_stacks.call_count, 3)
+
+class test_fan_out(TestCase):
+
+    def test_get_targets(self):
+        args = go.argparse.Namespace(manifest=None, region=['us-east-1', 'us-west-2'], name=['a', 'b'])
+        self.assertEqual(go.get_targets(args), [
+            {'region': 'us-east-1', 'name': 'a'}, {'region': 'us-east-1', 'name': 'b'},
+            {'region': 'us-west-2', 'name': 'a'}, {'region': 'us-west-2', 'name': 'b'}])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, 'targets.json')
+            path.write_text(go.json.dumps({'targets': [
+                {'region': 'eu-west-1', 'name': 'app', 'key_pair': 'eu'}]}))
+            args.manifest = str(path)
+            self.assertEqual(go.get_targets(args),
+                [{'region': 'eu-west-1', 'name': 'app', 'key_pair': 'eu'}])
+
+            path.write_text(go.json.dumps({'targets': [{'region': 'eu-west-1'}]}))
+            with self.assertRaises(ValueError):
+                go.get_targets(args)
+
+    def test_fan_out(self):
+        started = threading.Barrier(3, timeout=5)
+
+        def action(args):
+            # Every target has to be running at once to get past the barrier
+            started.wait()
+            print(f"acting on {args.region}/{args.name}")
+            with ThreadPoolExecutor(2) as executor:
+                list(executor.map(go.in_context(lambda i: print(f"worker {i}")), range(2)))
+            if args.region == 'eu-west-1':
+                exit(1)
+
+        args = go.argparse.Namespace(action='info', region=None, name=None)
+        targets = [{'region': region, 'name': 'app'}
+                   for region in ['us-east-1', 'us-west-2', 'eu-west-1']]
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            status = go.fan_out(action, args, targets, max_workers=3)
+
+        self.assertEqual(status, 1)
+        output = stdout.getvalue()
+        blocks = {block.split(' ===')[0]: sorted(block.splitlines()[1:])
+                  for block in output.split('=== info ')[1:]}
+        for region in ['us-east-1', 'us-west-2', 'eu-west-1']:
+            # Output of the target's own workers ends up in its block too
+            self.assertLessEqual({f'acting on {region}/app', 'worker 0', 'worker 1'},
+                set(blocks[f'{region}/app']))
+        self.assertRegex(output, r'eu-west-1/app +exit 1')
+        self.assertIn('2 of 3 targets succeeded', output)
+
+    @mock.patch('go.fan_out')
+    @mock.patch('go.info')
+    def test_main(self, mock_info, mock_fan_out):
+        go.main(['info', '-r', 'us-west-2', '-n', 'my stack'])
+        args = mock_info.call_args[0][0]
+        self.assertEqual((args.region, args.name), ('us-west-2', 'mystack'))
+        self.assertFalse(mock_fan_out.called)
+
+        mock_fan_out.return_value = 1
+        with self.assertRaises(SystemExit):
+            go.main(['info', '-r', 'us-east-1,us-west-2', '-r', 'eu-west-1', '-p', '2'])
+        targets = mock_fan_out.call_args[0][2]
+        self.assertEqual([target['region'] for target in targets],
+            ['us-east-1', 'us-west-2', 'eu-west-1'])
+        self.assertEqual(mock_fan_out.call_args[0][3], 2)
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                go.main(['bench', '-r', 'us-east-1,us-west-2'])
+
+    @mock.patch('go.test')
+    @mock.patch('go.info')
+    def test_main_options_first(self, mock_info, mock_test):
+        # The options do not take the action as one of their values
+        go.main(['-r', 'us-west-2', 'test'])
+        self.assertEqual(mock_test.call_args[0][0].region, 'us-west-2')
+        go.main(['-n', 'app', 'info'])
+        args = mock_info.call_args[0][0]
+        self.assertEqual((args.region, args.name), (go.DEFAULT_REGION, 'app'))
+
+    @mock.patch('go.build')
+    def test_main_scaling(self, mock_build):
+        go.main(['build', '--min-size', '1', '--desired-capacity', '3', '--max-size', '8'])
+        args = mock_build.call_args[0][0]
+        self.assertEqual(go.scaling_parameters(args),
+            {'MinSize': '1', 'DesiredCapacity': '3', 'MaxSize': '8'})
+
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+            with self.assertRaises(SystemExit):
+                go.main(['build', '--min-size', '4', '--max-size', '2'])
+        self.assertIn('--min-size <= --desired-capacity <= --max-size', stderr.getvalue())
+        self.assertEqual(mock_build.call_count, 1)
+
+    @mock.patch('go.refresh')
+    def test_main_refresh(self, mock_refresh):
+        go.main(['refresh', '--min-healthy', '50', '--max-healthy', '150'])
+        args = mock_refresh.call_args[0][0]
+        self.assertEqual((args.min_healthy, args.max_healthy), (50, 150))
+
+        for percentages in [['--min-healthy', '101'], ['--max-healthy', '99'],
+                            ['--min-healthy', '40', '--max-healthy', '150']]:
+            with mock.patch('sys.stderr', new_callable=io.StringIO):
+                with self.assertRaises(SystemExit):
+                    go.main(['refresh'] + percentages)
+        self.assertEqual(mock_refresh.call_count, 1)
+
+class test_template(TestCase):
+    """
+    Checks the rendered CloudFormation template offline.
+    """
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(parentdir)
+        self.addCleanup(os.chdir, cwd)
+        self.template = json.loads(go.AwsDriver().load_template('ami-123'))
+        self.parameters = self.template['Parameters']
+        self.resources = self.template['Resources']
+
+    def references(self, node):
+        # Yields every Ref and Fn::GetAtt target in a template node
+        if isinstance(node, dict):
+            for key, value in node.items():
+                if key == 'Ref':
+                    yield value
+                elif key == 'Fn::GetAtt':
+                    yield value[0]
+                else:
+                    yield from self.references(value)
+        elif isinstance(node, list):
+            for value in node:
+                yield from self.references(value)
+
+    def test_references(self):
+        known = set(self.parameters) | set(self.resources)
+        for name in self.references(self.template['Resources']):
+            if not name.startswith('AWS::'):
+                self.assertIn(name, known)
+        for name, resource in self.resources.items():
+            condition = resource.get('Condition')
+            if condition:
+                self.assertIn(condition, self.template['Conditions'])
+
+    def test_parameter_defaults(self):
+        for name, parameter in self.parameters.items():
+            default = parameter.get('Default')
+            if default is None or parameter['Type'] != 'Number':
+                continue
+            self.assertGreaterEqual(default, parameter.get('MinValue', default), name)
+            self.assertLessEqual(default, parameter.get('MaxValue', default), name)
+        self.assertLessEqual(self.parameters['MinSize']['Default'],
+            self.parameters['MaxSize']['Default'])
+        for parameter in go.SCALING_PARAMETERS.values():
+            self.assertIn(parameter, self.parameters)
+
+    def test_auto_scaling_group(self):
+        group = self.resources['AutoScalingGroup']['Properties']
+        self.assertEqual(group['MinSize'], {'Ref': 'MinSize'})
+        self.assertEqual(group['MaxSize'], {'Ref': 'MaxSize'})
+        # Left out unless set, so stack updates keep the scaled capacity
+        self.assertEqual(group['DesiredCapacity']['Fn::If'],
+            ['HasDesiredCapacity', {'Ref': 'DesiredCapacity'}, {'Ref': 'AWS::NoValue'}])
+        self.assertEqual(self.resources['LaunchConfiguration']['Properties']['ImageId'],
+            'ami-123')
+
+    def test_scaling_policies(self):
+        policies = {resource['Properties']['TargetTrackingConfiguration']
+                    ['PredefinedMetricSpecification']['PredefinedMetricType']: resource['Properties']
+                    for resource in self.resources.values()
+                    if resource['Type'] == 'AWS::AutoScaling::ScalingPolicy'}
+        self.assertEqual(set(policies), {'ALBRequestCountPerTarget', 'ASGAverageCPUUtilization'})
+        for policy in policies.values():
+            self.assertEqual(policy['PolicyType'], 'TargetTrackingScaling')
+            self.assertEqual(policy['AutoScalingGroupName'], {'Ref': 'AutoScalingGroup'})
+            self.assertEqual(policy['EstimatedInstanceWarmup'], {'Ref': 'InstanceWarmup'})
+
+        # The target group must be attached to the load balancer first
+        self.assertEqual(self.resources['RequestCountScalingPolicy']['DependsOn'],
+            'LoadBalancerListener')
+        requests = policies['ALBRequestCountPerTarget']['TargetTrackingConfiguration']
+        self.assertEqual(requests['TargetValue'], {'Ref': 'TargetRequestsPerInstance'})
+        self.assertEqual(requests['PredefinedMetricSpecification']['ResourceLabel'], {'Fn::Join': [
+            '/', [{'Fn::GetAtt': ['ApplicationLoadBalancer', 'LoadBalancerFullName']},
+                  {'Fn::GetAtt': ['TargetGroup', 'TargetGroupFullName']}]]})
+        cpu = policies['ASGAverageCPUUtilization']['TargetTrackingConfiguration']
+        self.assertEqual(cpu['TargetValue'], {'Ref': 'TargetCpuUtilization'})
+
+    def test_rolling_update(self):
+        group = self.resources['AutoScalingGroup']
+        update = group['UpdatePolicy']['AutoScalingRollingUpdate']
+        self.assertTrue(update['WaitOnResourceSignals'])
+        self.assertLess(update['MinInstancesInService'], self.parameters['MinSize']['Default'])
+        # Scaling must not fight the update
+        self.assertIn('AlarmNotification', update['SuspendProcesses'])
+        user_data = self.resources['LaunchConfiguration']['Properties']['UserData']
+        script = ''.join(part if isinstance(part, str) else f"<{part.get('Ref')}>"
+                         for part in user_data['Fn::Base64']['Fn::Join'][1])
+        self.assertIn('cfn-signal --success $healthy --stack <AWS::StackName> '
+            '--resource AutoScalingGroup', script)
+        self.assertIn('http://127.0.0.1:<ApplicationPort><HealthCheckPath>', script)
+
+    def test_artifact_python(self):
+        user_data = self.resources['LaunchConfiguration']['Properties']['UserData']
+        script = ''.join(part if isinstance(part, str) else f"<{part.get('Ref')}>"
+                         for part in user_data['Fn::Base64']['Fn::Join'][1])
+        # The AMI already has python3, booting does not wait on yum
+        self.assertIn('command -v python3 > /dev/null || yum install -y python3\n', script)
+        self.assertNotIn('\n  yum install', script)
+
+    def test_warm_pool(self):
+        warm_pool = self.resources['WarmPool']
+        self.assertEqual(warm_pool['Condition'], 'HasWarmPool')
+        self.assertEqual(self.parameters['WarmPoolMinSize']['Default'], 0)
+        self.assertEqual(self.template['Conditions']['HasWarmPool'],
+            {'Fn::Not': [{'Fn::Equals': [{'Ref': 'WarmPoolMinSize'}, '0']}]})
+        properties = warm_pool['Properties']
+        self.assertEqual(properties['AutoScalingGroupName'], {'Ref': 'AutoScalingGroup'})
+        self.assertEqual(properties['MinSize'], {'Ref': 'WarmPoolMinSize'})
+        self.assertEqual(properties['PoolState'], 'Stopped')
+
+        # Warm pool instances are only stopped once bootstrapped
+        hooks = self.resources['AutoScalingGroup']['Properties']['LifecycleHookSpecificationList']
+        condition, (hook,), no_value = hooks['Fn::If']
+        self.assertEqual((condition, no_value), ('HasWarmPool', {'Ref': 'AWS::NoValue'}))
+        self.assertEqual(hook['LifecycleTransition'], 'autoscaling:EC2_INSTANCE_LAUNCHING')
+        user_data = self.resources['LaunchConfiguration']['Properties']['UserData']
+        script = ''.join(part if isinstance(part, str) else f"<{part.get('Ref')}>"
+                         for part in user_data['Fn::Base64']['Fn::Join'][1])
+        self.assertIn(f"--lifecycle-hook-name {hook['LifecycleHookName']} ", script)
+        statements = self.resources['IamRole']['Properties']['Policies'][0]['PolicyDocument']
+        self.assertIn(['autoscaling:CompleteLifecycleAction'],
+            [statement['Action'] for statement in statements['Statement']])
+        # Instances started from the pool do not run UserData, the unit signals on every boot
+        self.assertIn('systemctl enable app-ready.service', script)
+        signal = script.index('cfn-signal')
+        self.assertLess(script.index('Warmed:*) ;;'), signal)
+        self.assertLess(signal, script.index('EOF\nchmod +x /usr/local/bin/app-ready'))
+
+    def test_check_template(self):
+        self.assertEqual(go.check_template(self.template), [])
+
+        self.template['Resources']['TargetGroup']['Properties']['VpcId'] = {'Ref': 'Vpc'}
+        self.template['Resources']['AutoScalingGroup']['Condition'] = 'Missing'
+        self.template['Resources']['Broken'] = {'Properties': {}}
+        self.template['Parameters']['MinSize']['Default'] = -1
+        self.template['Parameters']['DesiredCapacity']['Default'] = 'two'
+        self.template['Outputs']['URL']['Value'] = {'Fn::Sub': '${LoadBalancer.DNSName}/message'}
+        self.template['Extra'] = {}
+        self.assertEqual(sorted(go.check_template(self.template)), sorted([
+            "Unknown template section Extra",
+            "Parameter MinSize default -1 is out of range",
+            "Parameter DesiredCapacity default 'two' does not match its pattern",
+            "TargetGroup refers to the unknown Vpc with Ref",
+            "AutoScalingGroup uses the unknown condition Missing",
+            "Resource Broken has an invalid Type None",
+            "URL refers to the unknown LoadBalancer with Fn::Sub",
+        ]))
+
+    def test_render_zones(self):
+        template = json.loads(go.render_template('ami-123', az_count=4))
+        resources = template['Resources']
+        for zone in [3, 4]:
+            for name in go.ZONE_RESOURCES:
+                self.assertIn(name.format(zone), resources)
+        self.assertNotIn('PublicSubnet5', resources)
+        self.assertEqual(resources['PrivateSubnet4']['Properties']['AvailabilityZone'],
+            {'Fn::Select': [3, {'Fn::GetAZs': ''}]})
+        self.assertEqual(resources['DefaultPrivateRoute3']['Properties']['NatGatewayId'],
+            {'Ref': 'NatGateway3'})
+        self.assertEqual(resources['NatGateway3']['Properties']['AllocationId'],
+            {'Fn::GetAtt': ['NatGateway3EIP', 'AllocationId']})
+        self.assertEqual(resources['ApplicationLoadBalancer']['Properties']['Subnets'],
+            [{'Ref': f'PublicSubnet{zone}'} for zone in range(1, 5)])
+        self.assertEqual(resources['AutoScalingGroup']['Properties']['VPCZoneIdentifier'],
+            [{'Ref': f'PrivateSubnet{zone}'} for zone in range(1, 5)])
+
+        # Every subnet gets its own range of the VPC
+        cidrs = [parameter['Default'] for name, parameter in template['Parameters'].items()
+                 if 'Subnet' in name and name.endswith('CIDR')]
+        self.assertEqual(len(cidrs), 8)
+        self.assertEqual(len(set(cidrs)), 8)
+        self.assertEqual(template['Parameters']['PrivateSubnet4CIDR']['Default'], '10.0.112.0/20')
+
+        self.assertLess(len(go.render_template('ami-123', az_count=go.MAX_AZ_COUNT)),
+            go.TEMPLATE_BODY_LIMIT)
+        for az_count in [1, go.MAX_AZ_COUNT + 1]:
+            with self.assertRaises(ValueError):
+                go.render_template('ami-123', az_count=az_count)
+
+    def test_render_options(self):
+        template = json.loads(go.render_template('ami-123', instance_type='t3.small',
+            listener_port=8080, application_port=8000))
+        parameters = template['Parameters']
+        self.assertEqual(parameters['InstanceType']['Default'], 't3.small')
+        self.assertEqual(parameters['ListenerPort']['Default'], 8080)
+        self.assertEqual(parameters['ApplicationPort']['Default'], 8000)
+        resources = template['Resources']
+        self.assertEqual(resources['LoadBalancerListener']['Properties']['Port'],
+            {'Ref': 'ListenerPort'})
+        self.assertEqual(resources['TargetGroup']['Properties']['Port'],
+            {'Ref': 'ApplicationPort'})
+        self.assertEqual(parameters, json.loads(go.render_template('ami-123', instance_type='t3.small',
+            listener_port=8080, application_port=8000))['Parameters'])
+
+        with self.assertRaises(ValueError):
+            go.render_template('ami-123', listener_port=70000)
+
+    def test_render_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'app.cf')
+            with open(go.TEMPLATE_FILE) as f:
+                body = f.read()
+            with open(path, 'w') as f:
+                f.write(body)
+
+            first = go.render_template('ami-123', path=path)
+            with mock.patch('go.open') as mock_open:
+                self.assertIs(go.render_template('ami-123', path=path), first)
+            self.assertFalse(mock_open.called)
+
+            # Rendered again once the template changes
+            with open(path, 'w') as f:
+                f.write(body.replace('python-miniproject', 'other-project'))
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+            self.assertIn('other-project', go.render_template('ami-123', path=path))
+
+
+class test_startup(TestCase):
+    # Modules that take most of the startup time and only actions need
+    HEAVY_MODULES = ['boto3', 'botocore', 's3transfer', 'requests', 'urllib3']
+
+    def imported_modules(self, *args):
+        """
+        Runs go.py with -X importtime and lists the modules it imported.
+        """
+        result = subprocess.run([sys.executable, '-X', 'importtime', *args],
+            cwd=parentdir, capture_output=True, text=True, timeout=60)
+        modules = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                self_us, cumulative_us, name = line[len('import time:'):].split('|')
+                if cumulative_us.strip().isdigit():
+                    modules[name.strip()] = int(cumulative_us)
+        return modules
+
+    def assertNoHeavyImports(self, modules):
+        heavy = [name for name in modules if name.split('.')[0] in self.HEAVY_MODULES]
+        self.assertEqual(heavy, [])
+
+    def test_import(self):
+        modules = self.imported_modules('-c', 'import go')
+        self.assertIn('go', modules)
+        self.assertNoHeavyImports(modules)
+
+    def test_help(self):
+        self.assertNoHeavyImports(self.imported_modules('go.py', '--help'))
+        self.assertNoHeavyImports(self.imported_modules('go.py', 'unknown-action'))
+
+    def test_cached_info(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metadata.json')
+            cache = go.MetadataCache(path)
+            cache.set(f'{go.get_profile()}/account', '012345678901', 60)
+            cache.set(f'{go.get_profile()}/us-east-1/stack/app',
+                {'StackName': 'app', 'Parameters': [], 'Outputs': []}, 60)
+            # A cached stack is shown without loading boto3 at all
+            self.assertNoHeavyImports(self.imported_modules(
+                'go.py', 'info', '-n', 'app', '--cache-file', path))
+
+    def test_lazy_module(self):
+        module = go.LazyModule('colorsys')
+        self.assertIsNone(module._module)
+        self.assertEqual(module.rgb_to_hsv(0, 0, 0), (0, 0, 0))
+        self.assertIs(module._module, sys.modules['colorsys'])
+
+class test_Tracer(TestCase):
+
+    def test_span(self):
+        tracer = go.Tracer()
+        with tracer.span('build'):
+            pass
+        with self.assertRaises(SystemExit):
+            with tracer.span('build'):
+                exit(1)
+
+        rows = tracer.summary()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['name'], 'build')
+        self.assertEqual(rows[0]['count'], 2)
+        self.assertEqual(rows[0]['errors'], 1)
+
+    @mock.patch('go.AwsUtil.get_session')
+    def test_traced(self, mock_get_session):
+        with mock.patch('go.TRACER', go.Tracer()) as tracer:
+            driver = go.AwsDriver()
+            driver.delete_cf_stack('stack')
+
+        # Spans are recorded as they end, so nested phases come first
+        self.assertEqual([span['name'] for span in tracer.spans],
+            ['invalidate_stack', 'delete_cf_stack'])
+        self.assertEqual(tracer.spans[0]['category'], 'phase')
+
+    def test_attach(self):
+        tracer = go.Tracer()
+        session = go.boto3.Session(aws_access_key_id='id', aws_secret_access_key='secret',
+                                   region_name='us-east-1')
+        tracer.attach(session)
+        client = session.client('cloudformation')
+        with Stubber(client) as stubber:
+            stubber.add_response('describe_stacks', {'Stacks': []})
+            stubber.add_client_error('describe_stacks', 'Throttling', http_status_code=400)
+            client.describe_stacks()
+            with self.assertRaises(ClientError):
+                client.describe_stacks()
+
+        rows = tracer.summary()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['category'], 'api')
+        self.assertEqual(rows[0]['name'], 'cloudformation.DescribeStacks')
+        self.assertEqual(rows[0]['count'], 2)
+        self.assertEqual(rows[0]['errors'], 1)
+
+    def test_needs_retry(self):
+        tracer = go.Tracer()
+        session = mock.MagicMock()
+        tracer.attach(session)
+        handlers = {call[0][0]: call[0][1] for call in session.events.register.call_args_list}
+        context = {}
+        model = mock.MagicMock()
+        model.name = 'DescribeStacks'
+        model.service_model.service_name = 'cloudformation'
+        handlers['before-parameter-build'](model=model, context=context)
+        for code in ['Throttling', 'InternalError']:
+            handlers['needs-retry'](response=(None, {'Error': {'Code': code}}),
+                caught_exception=None, request_dict={'context': context})
+        handlers['after-call'](model=model, context=context,
+            parsed={'ResponseMetadata': {'RetryAttempts': 2}})
+
+        rows = tracer.summary()
+        self.assertEqual(rows[0]['retries'], 2)
+        self.assertEqual(rows[0]['throttles'], 1)
+        self.assertEqual(rows[0]['errors'], 0)
+
+    def test_connection_error(self):
+        # A port nothing listens on
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            port = listener.getsockname()[1]
+        tracer = go.Tracer()
+        session = go.boto3.Session(aws_access_key_id='id', aws_secret_access_key='secret',
+                                   region_name='us-east-1')
+        tracer.attach(session)
+        client = session.client('s3', endpoint_url=f'http://127.0.0.1:{port}',
+            config=Config(retries={'max_attempts': 0}, connect_timeout=1))
+
+        with self.assertRaises(EndpointConnectionError):
+            client.list_buckets()
+
+        rows = tracer.summary()
+        self.assertEqual(rows[0]['name'], 's3.ListBuckets')
+        self.assertEqual(rows[0]['errors'], 1)
+
+    def test_save(self):
+        tracer = go.Tracer()
+        with tracer.span('destroy', 'action'):
+            with tracer.span('delete_prefix'):
+                pass
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, 'trace.json')
+            tracer.save(str(path))
+            trace = go.json.loads(path.read_text())
+
+        events = trace['traceEvents']
+        self.assertEqual([event['name'] for event in events], ['delete_prefix', 'destroy'])
+        self.assertTrue(all(event['ph'] == 'X' for event in events))
+        self.assertLessEqual(events[1]['ts'], events[0]['ts'])
+        self.assertGreaterEqual(events[1]['dur'], events[0]['dur'])
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir) 
+
+import importlib
+import logging
+from unittest import TestCase, mock, main
+import app
+import gunicorn_conf
+
+class test_gunicorn_conf(TestCase):
+    def test_env_int(self):
+        with mock.patch.dict(os.environ, {'APP_TEST_VALUE': '8'}):
+            self.assertEqual(gunicorn_conf.env_int('APP_TEST_VALUE', 2), 8)
+        with mock.patch.dict(os.environ, {'APP_TEST_VALUE': ''}):
+            self.assertEqual(gunicorn_conf.env_int('APP_TEST_VALUE', 2), 2)
+        self.assertEqual(gunicorn_conf.env_int('APP_TEST_UNSET', 3), 3)
+
+    def test_keepalive(self):
+        # The server must outlive the ALB's idle connections
+        self.assertGreater(gunicorn_conf.keepalive, gunicorn_conf.ALB_IDLE_TIMEOUT)
+
+    def test_settings(self):
+        self.assertEqual(gunicorn_conf.wsgi_app, 'app:app')
+        self.assertEqual(gunicorn_conf.worker_class, 'gthread')
+        self.assertGreaterEqual(gunicorn_conf.workers, 1)
+        self.assertGreaterEqual(gunicorn_conf.threads, 1)
+        self.assertGreater(gunicorn_conf.graceful_timeout, 0)
+
+    def test_health_check_path(self):
+        self.assertEqual(gunicorn_conf.HEALTH_CHECK_PATH, app.HEALTH_CHECK_PATH)
+
+    def test_access_logger(self):
+        with mock.patch('gunicorn.glogging.Logger.__init__', return_value=None), \
+            mock.patch('gunicorn.glogging.Logger.access') as mock_access:
+            logger = gunicorn_conf.AccessLogger(mock.MagicMock())
+            logger.access(None, None, {'PATH_INFO': '/healthz'}, None)
+            self.assertFalse(mock_access.called)
+            logger.access(None, None, {'PATH_INFO': '/message'}, None)
+            self.assertTrue(mock_access.called)
+
+    def test_health_check_filter(self):
+        log_filter = gunicorn_conf.HealthCheckFilter()
+        record = logging.LogRecord('uvicorn.access', logging.INFO, '', 0,
+            '%s - "%s %s HTTP/%s" %d', ('127.0.0.1:1', 'GET', '/healthz', '1.1', 200), None)
+        self.assertFalse(log_filter.filter(record))
+        record.args = ('127.0.0.1:1', 'GET', '/message', '1.1', 200)
+        self.assertTrue(log_filter.filter(record))
+
+    def test_metrics_dir(self):
+        with mock.patch.dict(os.environ, {'APP_METRICS_DIR': ''}):
+            gunicorn_conf.on_starting(None)
+            directory = os.environ['APP_METRICS_DIR']
+            self.assertTrue(os.path.isdir(directory))
+            gunicorn_conf.on_exit(None)
+            self.assertFalse(os.path.exists(directory))
+        gunicorn_conf.created_metrics_dir = None
+
+        with mock.patch.dict(os.environ, {'APP_METRICS_DIR': '/var/lib/app-metrics'}):
+            gunicorn_conf.on_starting(None)
+            self.assertEqual(os.environ['APP_METRICS_DIR'], '/var/lib/app-metrics')
+            self.assertIsNone(gunicorn_conf.created_metrics_dir)
+
+    @mock.patch('gunicorn_conf.archive_metrics')
+    def test_child_exit(self, mock_archive_metrics):
+        worker = mock.MagicMock(pid=1234)
+        with mock.patch.dict(os.environ, {'APP_METRICS_DIR': '/tmp/app-metrics'}):
+            gunicorn_conf.child_exit(None, worker)
+        mock_archive_metrics.assert_called_once_with('/tmp/app-metrics', 1234)
+
+        mock_archive_metrics.reset_mock()
+        with mock.patch.dict(os.environ, {'APP_METRICS_DIR': ''}):
+            gunicorn_conf.child_exit(None, worker)
+        self.assertFalse(mock_archive_metrics.called)
+
+    def test_server_mode(self):
+        with mock.patch.dict(os.environ, {'APP_SERVER_MODE': 'async'}):
+            conf = importlib.reload(gunicorn_conf)
+            self.assertEqual(conf.wsgi_app, 'async_app:create_app()')
+            self.assertEqual(conf.worker_class, 'uvicorn.workers.UvicornWorker')
+        with mock.patch.dict(os.environ, {'APP_SERVER_MODE': 'bogus'}):
+            self.assertRaises(ValueError, importlib.reload, gunicorn_conf)
+        importlib.reload(gunicorn_conf)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+import os
+import sys
+import inspect
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import shutil
+import tempfile
+import threading
+from time import perf_counter
+from unittest import TestCase, main, skipUnless
+import metrics
+
+PATHS = ('/message', '/healthz')
+
+def sample(exposition, name):
+    """
+    Reads a sample's value from a Prometheus text exposition.
+    """
+    for line in exposition.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    raise KeyError(name)
+
+def fork(target):
+    """
+    Runs a function in a forked child process, which exits after it.
+    """
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = target() or 0
+        finally:
+            os._exit(status)
+    return pid
+
+class test_metrics(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open_metrics(self):
+        instance = metrics.Metrics(self.directory, PATHS)
+        self.addCleanup(instance.close)
+        return instance
+
+    def test_record(self):
+        instance = metrics.Metrics(paths=PATHS)
+        instance.end('/message', 200, instance.begin())
+        instance.end('/message', 304, instance.begin())
+        instance.end('/bogus', 404, instance.begin())
+        instance.end('/message', 999, instance.begin())
+        instance.begin()
+        exposition = instance.render()
+
+        self.assertEqual(sample(exposition, 'http_requests_in_flight'), 1)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="2xx"}'), 1)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="3xx"}'), 1)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="5xx"}'), 1)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="other",status="4xx"}'), 1)
+        self.assertEqual(sample(exposition,
+            'http_request_duration_seconds_count{path="/message"}'), 3)
+        self.assertEqual(sample(exposition,
+            'http_request_duration_seconds_bucket{path="/message",le="+Inf"}'), 3)
+        self.assertGreater(sample(exposition,
+            'http_request_duration_seconds_sum{path="/message"}'), 0)
+
+    def test_buckets(self):
+        instance = metrics.Metrics(paths=PATHS)
+        instance.end('/message', 200, perf_counter() - 0.03)
+        exposition = instance.render()
+
+        self.assertEqual(sample(exposition,
+            'http_request_duration_seconds_bucket{path="/message",le="0.025"}'), 0)
+        self.assertEqual(sample(exposition,
+            'http_request_duration_seconds_bucket{path="/message",le="0.05"}'), 1)
+
+    def test_threads(self):
+        instance = self.open_metrics()
+
+        def record():
+            for i in range(1000):
+                instance.end('/message', 200, instance.begin())
+
+        threads = [threading.Thread(target=record) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        exposition = instance.render()
+
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="2xx"}'), 8000)
+        self.assertEqual(sample(exposition, 'http_requests_in_flight'), 0)
+
+    @skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_processes(self):
+        instance = self.open_metrics()
+        instance.end('/message', 200, instance.begin())
+
+        def record():
+            # The child starts from zero in a file of its own
+            if instance.values[0] != 0 or instance.pid != os.getpid():
+                return 1
+            for j in range(500):
+                instance.end('/message', 200, instance.begin())
+            # Left in flight by an exited process
+            instance.begin()
+
+        pids = [fork(record) for i in range(3)]
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        exposition = instance.render()
+
+        self.assertEqual(len(os.listdir(self.directory)), 5)
+        self.assertEqual(sample(exposition,
+            'http_requests_total{path="/message",status="2xx"}'), 1501)
+        self.assertEqual(sample(exposition, 'http_requests_in_flight'), 0)
+
+        # Archiving the exited processes leaves the totals as they were
+        for pid in pids:
+            metrics.archive_metrics(self.directory, pid)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+            sorted([metrics.ARCHIVE_NAME, f'metrics-{os.getpid()}.db']))
+        self.assertEqual(instance.render(), exposition)
+
+    @skipUnless(hasattr(os, 'waitid'), 'needs waitid')
+    def test_exited_unreaped(self):
+        instance = self.open_metrics()
+
+        def record():
+            instance.begin()
+
+        pid = fork(record)
+        try:
+            # Waits for the child to exit but leaves it a zombie
+            os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+            self.assertEqual(instance.collect()[0], 0)
+        finally:
+            os.waitpid(pid, 0)
+
+    @skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_archive_in_use(self):
+        instance = self.open_metrics()
+        ready_read, ready_write = os.pipe()
+        done_read, done_write = os.pipe()
+
+        def record():
+            instance.begin()
+            os.write(ready_write, b'x')
+            os.read(done_read, 1)
+
+        pid = fork(record)
+        try:
+            os.read(ready_read, 1)
+            metrics.archive_metrics(self.directory, pid)
+            self.assertIn(f'metrics-{pid}.db', os.listdir(self.directory))
+            self.assertEqual(instance.collect()[0], 1)
+        finally:
+            os.write(done_write, b'x')
+            os.waitpid(pid, 0)
+            for fd in (ready_read, ready_write, done_read, done_write):
+                os.close(fd)
+
+    def test_reused_pid(self):
+        earlier = metrics.Metrics(self.directory, PATHS)
+        for i in range(5):
+            earlier.end('/message', 200, earlier.begin())
+        earlier.begin()
+        earlier.close()
+
+        # A later process with the same pid keeps the earlier counts
+        instance = self.open_metrics()
+        totals = instance.collect()
+        self.assertEqual(totals[0], 0)
+        self.assertEqual(totals[1 + 1], 5)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_partial_file(self):
+        instance = self.open_metrics()
+        with open(os.path.join(self.directory, 'metrics-1.db'), 'wb') as f:
+            f.write(b'\0' * 8)
+        self.assertEqual(instance.collect(), [0.0] * instance.size)
+
+    def test_overhead(self):
+        instance = self.open_metrics()
+        iterations = 10000
+        best = None
+        for i in range(5):
+            start = perf_counter()
+            for j in range(iterations):
+                instance.end('/message', 200, instance.begin())
+            elapsed = (perf_counter() - start) / iterations
+            best = elapsed if best is None else min(best, elapsed)
+        # A few microseconds, against hundreds for a request
+        self.assertLess(best, 20e-6)
+
+if __name__ == '__main__':
+    main()